@@ -16,7 +16,19 @@ if 'bpy' in locals():
     import importlib
     reloadable_modules = [
         'util',
+        'image_store',
+        'image_stats',
+        'image_sampling',
+        'pixel_eval',
+        'profiling',
+        'tree_plan',
+        'live_sync',
         'node_eval',
+        'vector_eval',
+        'fingerprint',
+        'results',
+        'snapshot_eval',
+        'snapshot',
         'custom_node_eval',
         'config',
         'operator',
@@ -28,7 +40,8 @@ if 'bpy' in locals():
 
 import bpy
 
-from . import config, node_eval, custom_node_eval, operator, panel, util
+from . import (config, node_eval, custom_node_eval, fingerprint, image_sampling, image_stats, image_store, live_sync,
+               operator, panel, pixel_eval, profiling, results, snapshot, snapshot_eval, tree_plan, util, vector_eval)
 
 
 
@@ -49,7 +62,14 @@ addon_classes = [
     operator.SelectedObjectsOperator,
     operator.ActiveMaterialOperator,
     operator.ActiveMaterialNodeOperator,
+    operator.ExportProfileOperator,
+    operator.VerifySnapshotsOperator,
+    operator.VerifyImageStoreOperator,
+    operator.PurgeImageStoreOperator,
     panel.CM_PT_ObjectColorFromMaterial,
+    panel.CM_PT_LastRun,
+    panel.CM_PT_MaterialProfile,
+    panel.CM_PT_ImageStore,
 ]
 
 
@@ -66,19 +86,133 @@ def register():
         description='Detects potential values for viewport material\'s roughness property',
         default=True,
     )
+    bpy.types.WindowManager.cfm_statistic = bpy.props.EnumProperty(
+        name='Texture Color',
+        description='What each texture is reduced to',
+        items=image_stats.STATISTICS,
+        default=image_stats.MEAN,
+    )
+    bpy.types.WindowManager.cfm_per_pixel = bpy.props.BoolProperty(
+        name='Per-Pixel Textures',
+        description='Runs color ramp, hue/saturation, invert, gamma and mix nodes fed by textures on every pixel '
+                    'before averaging, instead of on the texture\'s average color. Slower, but more accurate',
+        default=False,
+    )
+    bpy.types.WindowManager.cfm_estimate = bpy.props.BoolProperty(
+        name='Fast Estimate',
+        description='Estimates each texture\'s average color from a random sample of its pixels, '
+                    'within the tolerance. Much faster on large textures',
+        default=False,
+    )
+    bpy.types.WindowManager.cfm_estimate_tolerance = bpy.props.FloatProperty(
+        name='Tolerance',
+        description='Largest error allowed in each color channel of an estimate, at 95% confidence',
+        default=0.005,
+        min=0.0001,
+        max=0.1,
+        precision=4,
+    )
+    bpy.types.WindowManager.cfm_estimate_seed = bpy.props.IntProperty(
+        name='Seed',
+        description='Seed of the random sample, so the same pixels are sampled each run',
+        default=0,
+        min=0,
+    )
+    bpy.types.WindowManager.cfm_force = bpy.props.BoolProperty(
+        name='Force',
+        description='Sets every material, including those that have not changed since they were last set. '
+                    'Without it, materials whose viewport display was edited by hand are still set again',
+        default=False,
+    )
+    bpy.types.WindowManager.cfm_dry_run = bpy.props.BoolProperty(
+        name='Dry Run',
+        description='Evaluates materials without setting them, and prints the values that would change '
+                    'to the system console',
+        default=False,
+    )
+    bpy.types.WindowManager.cfm_parallel = bpy.props.BoolProperty(
+        name='Worker Processes',
+        description='Evaluates materials in worker processes on several cores, from snapshots of their node trees. '
+                    'Faster on many materials with large node trees',
+        default=False,
+    )
+    bpy.types.WindowManager.cfm_live_sync = bpy.props.BoolProperty(
+        name='Live Sync',
+        description='Updates the viewport display of materials affected by each edit to materials, node groups and images',
+        default=False,
+    )
+    bpy.types.WindowManager.cfm_profile = bpy.props.BoolProperty(
+        name='Profile',
+        description='Records where evaluation time goes for each material, listed in the panel afterwards',
+        default=False,
+    )
+    bpy.types.WindowManager.cfm_profile_sort = bpy.props.EnumProperty(
+        name='Sort By',
+        description='Measurement to rank the slowest materials by',
+        items=profiling.SORT_KEYS,
+        default='seconds',
+    )
+    bpy.types.WindowManager.cfm_profile_rows = bpy.props.IntProperty(
+        name='Rows',
+        description='Number of materials listed',
+        default=10,
+        min=1,
+        max=100,
+    )
 
     for cls in addon_classes:
         bpy.utils.register_class(cls)
 
+    bpy.app.handlers.load_post.append(image_stats.clear_on_load)
+    bpy.app.handlers.load_post.append(tree_plan.clear_on_load)
+    bpy.app.handlers.load_post.append(live_sync.reset_on_load)
+    bpy.app.handlers.load_post.append(profiling.clear_on_load)
+    bpy.app.handlers.load_post.append(pixel_eval.clear_on_load)
+    bpy.app.handlers.load_post.append(image_sampling.clear_on_load)
+    bpy.app.handlers.load_post.append(results.clear_on_load)
+    bpy.app.handlers.depsgraph_update_post.append(live_sync.on_depsgraph_update)
+
 
 def unregister():
     """Unregisters operators and properties."""
 
+    if live_sync.on_depsgraph_update in bpy.app.handlers.depsgraph_update_post:
+        bpy.app.handlers.depsgraph_update_post.remove(live_sync.on_depsgraph_update)
+    if bpy.app.timers.is_registered(live_sync.flush):
+        bpy.app.timers.unregister(live_sync.flush)
+    live_sync.reset()
+
+    for handler in (image_stats.clear_on_load, tree_plan.clear_on_load, live_sync.reset_on_load,
+                    profiling.clear_on_load, pixel_eval.clear_on_load, image_sampling.clear_on_load,
+                    results.clear_on_load):
+        if handler in bpy.app.handlers.load_post:
+            bpy.app.handlers.load_post.remove(handler)
+    image_stats.CACHE.invalidate()
+    image_stats.release_buffer()
+    pixel_eval.CACHE.clear()
+    image_sampling.CACHE.invalidate()
+    image_store.STORE.close()
+    tree_plan.invalidate()
+    profiling.clear()
+    results.clear()
+
     for cls in addon_classes[::-1]:
         bpy.utils.unregister_class(cls)
 
     del bpy.types.WindowManager.cfm_analyze_metallic
     del bpy.types.WindowManager.cfm_analyze_roughness
+    del bpy.types.WindowManager.cfm_statistic
+    del bpy.types.WindowManager.cfm_per_pixel
+    del bpy.types.WindowManager.cfm_estimate
+    del bpy.types.WindowManager.cfm_estimate_tolerance
+    del bpy.types.WindowManager.cfm_estimate_seed
+    del bpy.types.WindowManager.cfm_force
+    del bpy.types.WindowManager.cfm_dry_run
+    del bpy.types.WindowManager.cfm_parallel
+    del bpy.types.WindowManager.cfm_live_sync
+    del bpy.types.WindowManager.cfm_profile
+    del bpy.types.WindowManager.cfm_profile_sort
+    del bpy.types.WindowManager.cfm_profile_rows
 
 
 if __name__ == '__main__':
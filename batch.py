@@ -0,0 +1,174 @@
+# Copyright (C) 2024 Spencer Magnusson
+# semagnum@gmail.com
+# Created by Spencer Magnusson
+#     This program is free software: you can redistribute it and/or modify
+#     it under the terms of the GNU General Public License as published by
+#     the Free Software Foundation, either version 3 of the License, or
+#     (at your option) any later version.
+#     This program is distributed in the hope that it will be useful,
+#     but WITHOUT ANY WARRANTY; without even the implied warranty of
+#     MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#     GNU General Public License for more details.
+#     You should have received a copy of the GNU General Public License
+#     along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Sets viewport display properties of every material in many .blend files.
+
+Run it with a regular Python interpreter, which starts one background Blender process per file:
+
+    python batch.py --blender /path/to/blender --jobs 8 --save --report report.json "library/**/*.blend"
+
+Each Blender process runs this same script in worker mode on one file.
+A failure in one file is recorded in the report and does not stop the others.
+"""
+
+import os
+import sys
+
+# run as a script, this add-on's directory comes first on the path, and its operator.py would shadow the standard library
+_addon_dir = os.path.dirname(os.path.abspath(__file__))
+sys.path = [path for path in sys.path if os.path.abspath(path or os.curdir) != _addon_dir]
+
+import argparse
+import glob
+import importlib
+import json
+import subprocess
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+
+def expand_files(patterns) -> list:
+    """Expands file paths and glob patterns into a sorted list of unique .blend files."""
+    files = set()
+    for pattern in patterns:
+        matches = glob.glob(pattern, recursive=True) if glob.has_magic(pattern) else [pattern]
+        files.update(os.path.abspath(match) for match in matches if match.endswith('.blend'))
+    return sorted(files)
+
+
+def _import_addon():
+    """Imports this add-on as a package, from inside a Blender process that did not enable it."""
+    sys.path.insert(0, os.path.dirname(_addon_dir))
+    return importlib.import_module(os.path.basename(_addon_dir))
+
+
+def run_worker(args):
+    """Sets every material of the currently open file, and writes a report of each to args.output."""
+    import bpy
+
+    addon = _import_addon()
+    report = {'file': bpy.data.filepath, 'materials': []}
+    channels = addon.operator.get_channels(args.metallic, args.roughness)
+    table = addon.results.ResultTable(channels)
+    entries = {}
+
+    with addon.image_stats.statistic(args.statistic), addon.node_eval.evaluation_run():
+        addon.image_stats.prefetch(addon.util.find_images(bpy.data.materials))
+
+        for material in bpy.data.materials:
+            entry = {'material': material.name_full, 'values': None, 'changed': None, 'seconds': 0.0, 'error': None}
+            report['materials'].append(entry)
+
+            if material.library is not None:
+                entry['error'] = 'linked from a library'
+                continue
+
+            start = time.perf_counter()
+            try:
+                table.add(material, None, addon.operator.evaluate_material(material, args.metallic, args.roughness))
+                entries[material.name_full] = entry
+            except Exception as e:
+                entry['error'] = '{}: {}'.format(type(e).__name__, e)
+            entry['seconds'] = time.perf_counter() - start
+
+    # every material is evaluated before any is set, and files are only changed when saving them
+    for row in table.to_dicts():
+        entries[row['material']].update(values=row['values'], changed=row['changed'])
+    if args.save:
+        table.commit()
+        bpy.ops.wm.save_mainfile()
+
+    with open(args.output, 'w') as f:
+        json.dump(report, f)
+
+
+def run_file(args, filepath: str) -> dict:
+    """Runs a background Blender process on one file and returns its report."""
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        output = os.path.join(tmp_dir, 'report.json')
+        command = [args.blender, '--background', '--factory-startup', filepath,
+                   '--python-exit-code', '1', '--python', os.path.abspath(__file__), '--',
+                   '--worker', '--output', output]
+        if args.save:
+            command.append('--save')
+        if not args.metallic:
+            command.append('--no-metallic')
+        if not args.roughness:
+            command.append('--no-roughness')
+        command += ['--statistic', args.statistic]
+
+        start = time.perf_counter()
+        try:
+            process = subprocess.run(command, capture_output=True, text=True, timeout=args.timeout)
+        except (OSError, subprocess.TimeoutExpired) as e:
+            return {'file': filepath, 'materials': [], 'seconds': time.perf_counter() - start,
+                    'error': '{}: {}'.format(type(e).__name__, e)}
+
+        seconds = time.perf_counter() - start
+        if process.returncode != 0 or not os.path.exists(output):
+            return {'file': filepath, 'materials': [], 'seconds': seconds,
+                    'error': 'Blender exited with code {}: {}'.format(process.returncode, process.stderr[-2000:])}
+
+        with open(output) as f:
+            report = json.load(f)
+
+    report.update(file=filepath, seconds=seconds, error=None)
+    return report
+
+
+def run_batch(args) -> int:
+    files = expand_files(args.files)
+
+    with ThreadPoolExecutor(max_workers=args.jobs) as pool:
+        reports = list(pool.map(lambda filepath: run_file(args, filepath), files))
+
+    failed = [report for report in reports if report['error'] is not None]
+    with open(args.report, 'w') as f:
+        json.dump({'files': reports}, f, indent=2)
+
+    print('Processed {} files, {} failed, report written to {}'.format(len(files), len(failed), args.report))
+    return 1 if failed else 0
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('files', nargs='*', help='.blend files or glob patterns')
+    parser.add_argument('--blender', default=os.environ.get('BLENDER', 'blender'), help='Blender executable')
+    parser.add_argument('--jobs', type=int, default=os.cpu_count() or 1, help='Blender processes to run at once')
+    parser.add_argument('--timeout', type=float, default=None, help='seconds before a file is abandoned')
+    parser.add_argument('--report', default='viewport_colors_report.json', help='JSON report path')
+    parser.add_argument('--save', action='store_true', help='save each file after setting its materials')
+    parser.add_argument('--no-metallic', dest='metallic', action='store_false', help='do not set metallic')
+    parser.add_argument('--no-roughness', dest='roughness', action='store_false', help='do not set roughness')
+    parser.add_argument('--statistic', choices=['MEAN', 'DOMINANT'], default='MEAN',
+                        help='reduce textures to their average or their dominant color')
+    parser.add_argument('--worker', action='store_true', help=argparse.SUPPRESS)
+    parser.add_argument('--output', help=argparse.SUPPRESS)
+    return parser.parse_args(argv)
+
+
+def main():
+    # inside Blender, script arguments follow "--"
+    argv = sys.argv[sys.argv.index('--') + 1:] if '--' in sys.argv else sys.argv[1:]
+    args = parse_args(argv)
+
+    if args.worker:
+        run_worker(args)
+    else:
+        sys.exit(run_batch(args))
+
+
+if __name__ == '__main__':
+    main()
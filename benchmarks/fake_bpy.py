@@ -0,0 +1,244 @@
+# Copyright (C) 2024 Spencer Magnusson
+# semagnum@gmail.com
+# Created by Spencer Magnusson
+#     This program is free software: you can redistribute it and/or modify
+#     it under the terms of the GNU General Public License as published by
+#     the Free Software Foundation, either version 3 of the License, or
+#     (at your option) any later version.
+#     This program is distributed in the hope that it will be useful,
+#     but WITHOUT ANY WARRANTY; without even the implied warranty of
+#     MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#     GNU General Public License for more details.
+#     You should have received a copy of the GNU General Public License
+#     along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Lightweight stand-in for the parts of bpy and mathutils the add-on uses.
+
+Only node trees, sockets, links, images and materials behave like Blender's.
+Everything else (operators, panels, properties, handlers) exists just so the add-on imports.
+"""
+
+import sys
+import types
+from itertools import count
+
+import numpy as np
+
+
+_pointers = count(1)
+
+
+class StructRNA:
+    """Base of fake data, providing a stable pointer like bpy_struct.as_pointer()."""
+
+    def as_pointer(self) -> int:
+        try:
+            return self._pointer
+        except AttributeError:
+            self._pointer = next(_pointers)
+            return self._pointer
+
+
+class Vector(tuple):
+    """Immutable stand-in for mathutils.Vector, compared by value."""
+
+    def __new__(cls, seq=(0.0, 0.0, 0.0)):
+        return super().__new__(cls, (float(v) for v in seq))
+
+    def __repr__(self):
+        return 'Vector({})'.format(tuple(self))
+
+
+class NodeSocket(StructRNA):
+    def __init__(self, node, index: int, is_output: bool, default_value=None):
+        self.node = node
+        self.index = index
+        self.is_output = is_output
+        self.links = []
+        if default_value is not None:
+            self.default_value = default_value
+
+    @property
+    def id_data(self):
+        return self.node.id_data
+
+    @property
+    def is_linked(self) -> bool:
+        return bool(self.links)
+
+    def path_from_id(self) -> str:
+        return 'nodes["{}"].{}[{}]'.format(self.node.name, 'outputs' if self.is_output else 'inputs', self.index)
+
+
+class NodeLink(StructRNA):
+    def __init__(self, from_socket: NodeSocket, to_socket: NodeSocket):
+        self.from_socket = from_socket
+        self.to_socket = to_socket
+        self.from_node = from_socket.node
+        self.to_node = to_socket.node
+
+
+class Node(StructRNA):
+    def __init__(self, id_data, bl_idname: str, inputs=(), outputs: int = 1, **attributes):
+        self.id_data = id_data
+        self.bl_idname = bl_idname
+        self.name = '{}.{:03d}'.format(bl_idname, len(id_data.nodes))
+        self.select = False
+        self.inputs = [NodeSocket(self, index, False, val) for index, val in enumerate(inputs)]
+        self.outputs = [NodeSocket(self, index, True) for index in range(outputs)]
+        for name, val in attributes.items():
+            setattr(self, name, val)
+        id_data.nodes.append(self)
+
+
+class Nodes(list):
+    active = None
+
+
+class NodeTree(StructRNA):
+    def __init__(self, name: str, is_embedded_data: bool = False):
+        self.name = self.name_full = name
+        self.is_embedded_data = is_embedded_data
+        self.nodes = Nodes()
+        self.links = []
+
+    def link(self, from_socket: NodeSocket, to_socket: NodeSocket) -> NodeLink:
+        link = NodeLink(from_socket, to_socket)
+        from_socket.links.append(link)
+        to_socket.links.append(link)
+        self.links.append(link)
+        return link
+
+
+class ImagePixels:
+    """Image pixel buffer supporting len() and foreach_get() like bpy's, backed by float32."""
+
+    def __init__(self, data: np.ndarray):
+        self._data = data
+
+    def __len__(self):
+        return self._data.size
+
+    def __iter__(self):
+        return iter(self._data.tolist())
+
+    def foreach_get(self, buffer):
+        buffer[:] = self._data
+
+
+class Image(StructRNA):
+    def __init__(self, name: str, pixels: np.ndarray, width: int, height: int):
+        self.name = self.name_full = name
+        self.filepath = '//textures/{}.png'.format(name)
+        self.size = (width, height)
+        self.pixels = ImagePixels(pixels)
+        self.is_dirty = False
+        self.packed_file = None
+        self.source = 'FILE'
+        self.generated_width = self.generated_height = 1024
+        self.tiles = [types.SimpleNamespace(number=1001, size=(width, height))]
+        self.colorspace_settings = types.SimpleNamespace(name='sRGB')
+        self.alpha_mode = 'STRAIGHT'
+        self.library = None
+
+
+class Material(StructRNA):
+    def __init__(self, name: str):
+        self.name = self.name_full = name
+        self.use_nodes = True
+        self.node_tree = NodeTree(name, is_embedded_data=True)
+        self.library = None
+        self.diffuse_color = (0.8, 0.8, 0.8, 1.0)
+        self.roughness = 0.4
+        self.metallic = 0.0
+        self._id_properties = {}
+
+    def get(self, key, default=None):
+        return self._id_properties.get(key, default)
+
+    def __getitem__(self, key):
+        return self._id_properties[key]
+
+    def __setitem__(self, key, val):
+        self._id_properties[key] = val
+
+    def update_tag(self):
+        pass
+
+
+class BlendDataCollection(list):
+    def get(self, name, default=None):
+        return next((item for item in self if item.name == name), default)
+
+    def foreach_get(self, name, buffer):
+        values = [getattr(item, name) for item in self]
+        buffer[:] = np.ravel(values)
+
+    def foreach_set(self, name, buffer):
+        width = len(buffer) // len(self) if self else 0
+        for index, item in enumerate(self):
+            if hasattr(getattr(item, name), '__len__'):
+                setattr(item, name, tuple(float(v) for v in buffer[index * width:(index + 1) * width]))
+            else:
+                setattr(item, name, float(buffer[index]))
+
+    def __contains__(self, name):
+        return self.get(name) is not None
+
+
+class _Anything:
+    """Accepts any attribute access or call, for APIs only touched at registration."""
+
+    def __init__(self, *_args, **_kwargs):
+        pass
+
+    def __getattr__(self, _name):
+        return _Anything()
+
+    def __call__(self, *_args, **_kwargs):
+        return _Anything()
+
+
+class _Types(types.SimpleNamespace):
+    def __getattr__(self, name):
+        # any other bpy.types class becomes a plain base class
+        cls = type(name, (), {})
+        setattr(self, name, cls)
+        return cls
+
+
+def _persistent(func):
+    return func
+
+
+def make_modules() -> tuple:
+    """Creates fresh bpy and mathutils modules."""
+    bpy = types.ModuleType('bpy')
+    bpy.app = types.SimpleNamespace(
+        version=(4, 2, 0),
+        background=True,
+        handlers=types.SimpleNamespace(persistent=_persistent, load_post=[], depsgraph_update_post=[]),
+        timers=types.SimpleNamespace(register=lambda *args, **kwargs: None,
+                                     unregister=lambda func: None,
+                                     is_registered=lambda func: False),
+    )
+    bpy.types = _Types(Node=Node, NodeTree=NodeTree, NodeSocket=NodeSocket, Image=Image, Material=Material)
+    bpy.data = types.SimpleNamespace(materials=BlendDataCollection(), node_groups=BlendDataCollection(),
+                                     images=BlendDataCollection(), filepath='')
+    bpy.context = types.SimpleNamespace(window_manager=None)
+    bpy.path = types.SimpleNamespace(abspath=lambda path, library=None: path)
+    bpy.props = _Anything()
+    bpy.utils = _Anything()
+    bpy.ops = _Anything()
+    bpy.msgbus = _Anything()
+
+    mathutils = types.ModuleType('mathutils')
+    mathutils.Vector = Vector
+    return bpy, mathutils
+
+
+def install():
+    """Installs the stand-in as the bpy and mathutils modules, unless real ones are already imported."""
+    if 'bpy' not in sys.modules:
+        sys.modules['bpy'], sys.modules['mathutils'] = make_modules()
+    return sys.modules['bpy']
@@ -0,0 +1,440 @@
+# Copyright (C) 2024 Spencer Magnusson
+# semagnum@gmail.com
+# Created by Spencer Magnusson
+#     This program is free software: you can redistribute it and/or modify
+#     it under the terms of the GNU General Public License as published by
+#     the Free Software Foundation, either version 3 of the License, or
+#     (at your option) any later version.
+#     This program is distributed in the hope that it will be useful,
+#     but WITHOUT ANY WARRANTY; without even the implied warranty of
+#     MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#     GNU General Public License for more details.
+#     You should have received a copy of the GNU General Public License
+#     along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Benchmarks the evaluator on synthetic materials, without Blender.
+
+    python benchmarks/run.py --materials 500 --depth 8
+    python benchmarks/run.py --compare benchmarks/results/<older commit>.json
+
+Results are saved to benchmarks/results/<commit>.json.
+Comparing against an older result prints the ratio of each measurement and exits with 1 on a regression.
+"""
+
+import os
+import sys
+
+_benchmark_dir = os.path.dirname(os.path.abspath(__file__))
+_addon_dir = os.path.dirname(_benchmark_dir)
+# keep the add-on's operator.py from shadowing the standard library
+sys.path = [path for path in sys.path if os.path.abspath(path or os.curdir) != _addon_dir]
+
+import argparse
+import gc
+import importlib.util
+import json
+import subprocess
+import time
+import tracemalloc
+
+import fake_bpy
+import synthetic
+
+ADDON_NAME = 'cfm_addon'
+
+# measurements where a higher value is better, the rest are better lower
+HIGHER_IS_BETTER = {'materials_per_second', 'megapixels_per_second', 'batched_share', 'dedup_ratio',
+                    'skipped_share', 'changed_share', 'snapshot_share', 'speedup',
+                    'bulk_materials_per_second'}
+
+
+def import_addon():
+    """Imports the add-on as a package against the fake bpy."""
+    fake_bpy.install()
+    if ADDON_NAME in sys.modules:
+        return sys.modules[ADDON_NAME]
+
+    spec = importlib.util.spec_from_file_location(ADDON_NAME, os.path.join(_addon_dir, '__init__.py'),
+                                                  submodule_search_locations=[_addon_dir])
+    addon = importlib.util.module_from_spec(spec)
+    sys.modules[ADDON_NAME] = addon
+    spec.loader.exec_module(addon)
+
+    # measure decoding images, not reading statistics stored by earlier runs
+    addon.config.IMAGE_STORE_ENABLED = False
+    return addon
+
+
+def clear_caches(addon):
+    addon.image_stats.CACHE.invalidate()
+    addon.tree_plan.invalidate()
+    addon.pixel_eval.CACHE.clear()
+    addon.image_sampling.CACHE.invalidate()
+
+
+def measure(func, repeat: int) -> dict:
+    """Runs a function repeat times, returning the best time and the peak memory traced over one extra run.
+    A function returning a number of seconds is timed by that instead, such as to leave out its setup.
+    """
+    seconds = []
+    for _ in range(repeat):
+        gc.collect()
+        start = time.perf_counter()
+        elapsed = func()
+        seconds.append(time.perf_counter() - start if elapsed is None else elapsed)
+
+    gc.collect()
+    tracemalloc.start()
+    func()
+    _current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return {'seconds': min(seconds), 'peak_mb': peak / (1 << 20)}
+
+
+def bench_traversal(addon, materials, repeat: int) -> dict:
+    """Evaluates every material with image statistics and tree plans already cached."""
+    operator = addon.operator
+    addon.image_stats.prefetch(addon.util.find_images(materials), workers=1)
+
+    def run():
+        with addon.node_eval.evaluation_run():
+            for material in materials:
+                operator.evaluate_material(material, True, True)
+
+    result = measure(run, repeat)
+    result['materials_per_second'] = len(materials) / result['seconds']
+    return result
+
+
+def bench_image_reduction(addon, images, repeat: int) -> dict:
+    """Averages every image's pixels, as if none were cached."""
+    def run():
+        for image in images:
+            addon.image_stats.compute_mean(image)
+
+    result = measure(run, repeat)
+    megapixels = sum(image.size[0] * image.size[1] for image in images) / 1e6
+    result['megapixels_per_second'] = megapixels / result['seconds'] if images else 0.0
+    return result
+
+
+def bench_prefetch(addon, materials, repeat: int) -> dict:
+    """Prefetches the statistics of every texture the materials use, as if none were cached,
+    on config.IMAGE_WORKERS threads and on one. Compare seconds with serial_seconds.
+    """
+    images = addon.util.find_images(materials)
+
+    def run(workers):
+        addon.image_stats.CACHE.invalidate()
+        start = time.perf_counter()
+        addon.image_stats.prefetch(images, workers=workers)
+        return time.perf_counter() - start
+
+    serial = measure(lambda: run(1), repeat)
+    result = measure(lambda: run(addon.config.IMAGE_WORKERS), repeat)
+    result['serial_seconds'] = serial['seconds']
+    result['speedup'] = serial['seconds'] / result['seconds']
+    result['workers'] = addon.config.IMAGE_WORKERS
+    result['images'] = len(set(image.name_full for image in images))
+    return result
+
+
+def bench_dominant(addon, images, repeat: int) -> dict:
+    """Reduces every image to its dominant color, as if none were cached. Compare with image_reduction."""
+    image_stats = addon.image_stats
+
+    def run():
+        for image in images:
+            image_stats.dominant_from_pixels(image_stats.read_pixels(image))
+
+    result = measure(run, repeat)
+    megapixels = sum(image.size[0] * image.size[1] for image in images) / 1e6
+    result['megapixels_per_second'] = megapixels / result['seconds'] if images else 0.0
+    return result
+
+
+def bench_estimate(addon, images, repeat: int, tolerance: float = 0.005) -> dict:
+    """Estimates every image's mean from a sample of its pixels, as if none were cached,
+    and measures the largest difference from the exact mean."""
+    image_sampling = addon.image_sampling
+    samplers = []
+
+    def run():
+        image_sampling.CACHE.invalidate()
+        sampler = image_sampling.Sampler(tolerance, 0)
+        for image in images:
+            sampler.mean(image)
+        samplers.append(sampler)
+
+    result = measure(run, repeat)
+    megapixels = sum(image.size[0] * image.size[1] for image in images) / 1e6
+    result['megapixels_per_second'] = megapixels / result['seconds'] if images else 0.0
+
+    sampler = samplers[-1]
+    result['sampled_share'] = (sum(samples for samples, _total, _error in sampler.estimates.values())
+                               / max(1, sum(total for _samples, total, _error in sampler.estimates.values())))
+    result['max_error'] = 0.0
+    for image in images:
+        exact = addon.image_stats.compute_mean(image)
+        estimate = sampler.mean(image)
+        if exact is not None and estimate is not None:
+            result['max_error'] = max(result['max_error'], max(abs(a - b) for a, b in zip(exact, estimate)))
+    return result
+
+
+def bench_end_to_end(addon, materials, repeat: int) -> dict:
+    """Sets every material from cold caches, like the All Materials operator."""
+    operator = addon.operator
+
+    def run():
+        clear_caches(addon)
+        with addon.node_eval.evaluation_run():
+            for material in materials:
+                operator.set_material(material, True, True)
+
+    result = measure(run, repeat)
+    result['materials_per_second'] = len(materials) / result['seconds']
+    return result
+
+
+def bench_batched(addon, materials, repeat: int) -> dict:
+    """Sets every material from cold caches like the batch operators, evaluating identical materials once
+    and the others together where possible."""
+    operator = addon.operator
+    channels = operator.get_channels(True, True)
+    runs = []
+
+    def run():
+        clear_caches(addon)
+        with addon.node_eval.evaluation_run():
+            material_run = operator.MaterialRun(channels)
+            material_run.set(materials)
+        material_run.commit()
+        runs.append(material_run)
+
+    result = measure(run, repeat)
+    result['materials_per_second'] = len(materials) / result['seconds']
+    result['batched_share'] = runs[-1].batched / len(materials) if materials else 0.0
+    result['dedup_ratio'] = runs[-1].dedup_ratio
+    return result
+
+
+def bench_snapshot(addon, materials, repeat: int) -> dict:
+    """Sets every material from cold caches like the batch operators with worker processes, evaluating snapshots
+    of the distinct materials there, then checks the snapshots against the node-by-node evaluator."""
+    operator = addon.operator
+    channels = operator.get_channels(True, True)
+    runs = []
+
+    def run():
+        clear_caches(addon)
+        with addon.node_eval.evaluation_run():
+            material_run = operator.MaterialRun(channels, workers=addon.config.SNAPSHOT_WORKERS)
+            material_run.set(materials)
+        material_run.commit()
+        runs.append(material_run)
+
+    result = measure(run, repeat)
+    result['materials_per_second'] = len(materials) / result['seconds']
+    result['snapshot_share'] = runs[-1].in_workers / runs[-1].evaluated if runs[-1].evaluated else 0.0
+    with addon.node_eval.evaluation_run():
+        _snapshotted, mismatches = operator.verify_snapshots(materials, channels)
+    result['mismatches'] = len(mismatches)
+    return result
+
+
+def bench_pixel_chains(addon, materials, repeat: int) -> dict:
+    """Evaluates every texture-fed node chain per pixel, as if none were cached.
+    Compare megapixels_per_second with image_reduction, which only averages the pixels."""
+    pixel_eval = addon.pixel_eval
+    chains = {}
+    for material in materials:
+        plan = addon.node_eval.get_tree_plan(material.node_tree)
+        for link in plan.links.values():
+            if link.from_node.bl_idname in pixel_eval.CHAIN_NODES:
+                chain = pixel_eval.compile_chain(plan, link.from_node, link.from_socket_index)
+                if chain is not None:
+                    chains[chain.key] = chain
+
+    def run():
+        for chain in chains.values():
+            pixel_eval.run_chain(chain)
+
+    result = measure(run, repeat)
+    megapixels = sum(chain.images[0].size[0] * chain.images[0].size[1] for chain in chains.values()) / 1e6
+    result['megapixels_per_second'] = megapixels / result['seconds'] if chains else 0.0
+    result['chains'] = len(chains)
+    return result
+
+
+def bench_unchanged(addon, materials, repeat: int) -> dict:
+    """Sets every material again after they were all set, skipping those that have not changed.
+    Materials reading the synthetic textures are recomputed, as the textures have no files to recognize them by."""
+    operator = addon.operator
+    channels = operator.get_channels(True, True)
+    with addon.node_eval.evaluation_run():
+        material_run = operator.MaterialRun(channels)
+        material_run.set(materials)
+    material_run.commit()
+    runs = []
+
+    def run():
+        clear_caches(addon)
+        with addon.node_eval.evaluation_run():
+            material_run = operator.MaterialRun(channels, force=False)
+            material_run.set(materials)
+        material_run.commit()
+        runs.append(material_run)
+
+    result = measure(run, repeat)
+    result['materials_per_second'] = len(materials) / result['seconds']
+    result['skipped_share'] = runs[-1].skipped / len(materials) if materials else 0.0
+    return result
+
+
+def bench_commit(addon, materials, repeat: int) -> dict:
+    """Sets evaluated values on materials whose values were reset, every other one to its evaluated values,
+    so half of the materials change, one material at a time and in bulk. Only the write-back is timed,
+    not the evaluation. Setting in bulk is off by default, see config.BULK_WRITE_ENABLED."""
+    operator = addon.operator
+    channels = operator.get_channels(True, True)
+    with addon.node_eval.evaluation_run():
+        material_run = operator.MaterialRun(channels)
+        material_run.set(materials)
+    rows = material_run.table.rows
+    changed = []
+
+    def run():
+        for index, (material, _key, values) in enumerate(rows):
+            for name, (_config, default) in channels.items():
+                setattr(material, name, values.get(name, default) if index % 2 else default)
+        table = addon.results.ResultTable(channels)
+        table.rows = list(rows)
+        start = time.perf_counter()
+        changed.append(table.commit())
+        return time.perf_counter() - start
+
+    config = addon.config
+    bulk_enabled = config.BULK_WRITE_ENABLED
+    try:
+        config.BULK_WRITE_ENABLED = False
+        result = measure(run, repeat)
+        config.BULK_WRITE_ENABLED = True
+        bulk = measure(run, repeat)
+    finally:
+        config.BULK_WRITE_ENABLED = bulk_enabled
+    result['materials_per_second'] = len(materials) / result['seconds']
+    result['bulk_materials_per_second'] = len(materials) / bulk['seconds']
+    result['changed_share'] = changed[-1] / len(materials) if materials else 0.0
+    return result
+
+
+def git_commit() -> str:
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=_addon_dir, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+
+def run_benchmarks(spec: synthetic.SceneSpec, repeat: int) -> dict:
+    addon = import_addon()
+    bpy = sys.modules['bpy']
+
+    start = time.perf_counter()
+    materials = synthetic.build_scene(spec, bpy)
+    print('Built {} materials in {:.2f}s'.format(len(materials), time.perf_counter() - start))
+
+    clear_caches(addon)
+    results = {
+        'traversal': bench_traversal(addon, materials, repeat),
+        'image_reduction': bench_image_reduction(addon, list(bpy.data.images), repeat),
+        'prefetch': bench_prefetch(addon, materials, repeat),
+        'estimate': bench_estimate(addon, list(bpy.data.images), repeat),
+        'dominant': bench_dominant(addon, list(bpy.data.images), repeat),
+        'end_to_end': bench_end_to_end(addon, materials, repeat),
+        'batched': bench_batched(addon, materials, repeat),
+        'snapshot': bench_snapshot(addon, materials, repeat),
+        'unchanged': bench_unchanged(addon, materials, repeat),
+        'commit': bench_commit(addon, materials, repeat),
+        'pixel_chains': bench_pixel_chains(addon, materials, repeat),
+    }
+    clear_caches(addon)
+    return results
+
+
+def compare(results: dict, baseline: dict, threshold: float) -> bool:
+    """Prints each measurement against a baseline, returning whether any regressed by more than the threshold."""
+    regressed = False
+    print('{:<16} {:<22} {:>12} {:>12} {:>8}'.format('suite', 'measurement', 'baseline', 'current', 'ratio'))
+    for suite, measurements in results.items():
+        for name, val in measurements.items():
+            old = baseline.get(suite, {}).get(name)
+            if not old:
+                continue
+
+            ratio = val / old
+            worse = ratio < 1 - threshold if name in HIGHER_IS_BETTER else ratio > 1 + threshold
+            regressed = regressed or worse
+            print('{:<16} {:<22} {:>12.4g} {:>12.4g} {:>7.2f}x{}'.format(
+                suite, name, old, val, ratio, '  REGRESSION' if worse else ''))
+    return regressed
+
+
+def parse_args(argv):
+    defaults = synthetic.SceneSpec()
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--materials', type=int, default=defaults.materials)
+    parser.add_argument('--depth', type=int, default=defaults.depth)
+    parser.add_argument('--fan-out', type=float, default=defaults.fan_out,
+                        help='probability of each input being linked to another node')
+    parser.add_argument('--groups', type=int, default=defaults.groups)
+    parser.add_argument('--group-nesting', type=int, default=defaults.group_nesting)
+    parser.add_argument('--node-mix', type=json.loads, default=None,
+                        help='JSON object of node kind weights, for example \'{"image": 5, "mix_color": 1}\'')
+    parser.add_argument('--textures', type=int, default=defaults.textures)
+    parser.add_argument('--texture-size', type=int, default=defaults.texture_size)
+    parser.add_argument('--layouts', type=int, default=defaults.layouts,
+                        help='distinct node layouts shared by materials, 0 for a layout per material')
+    parser.add_argument('--distinct', type=int, default=defaults.distinct,
+                        help='distinct materials, the others being copies of them, 0 for no copies')
+    parser.add_argument('--seed', type=int, default=defaults.seed)
+    parser.add_argument('--repeat', type=int, default=3, help='runs per suite, keeping the fastest')
+    parser.add_argument('--output', default=None, help='result path, defaults to benchmarks/results/<commit>.json')
+    parser.add_argument('--compare', default=None, help='earlier result to compare against')
+    parser.add_argument('--threshold', type=float, default=0.1, help='relative change counted as a regression')
+    return parser.parse_args(argv)
+
+
+def main():
+    args = parse_args(sys.argv[1:])
+    spec = synthetic.SceneSpec(materials=args.materials, depth=args.depth, fan_out=args.fan_out, groups=args.groups,
+                               group_nesting=args.group_nesting, node_mix=args.node_mix, textures=args.textures,
+                               texture_size=args.texture_size, layouts=args.layouts,
+                               distinct=args.distinct, seed=args.seed)
+
+    commit = git_commit()
+    results = run_benchmarks(spec, args.repeat)
+    for suite, measurements in results.items():
+        print('{:<16} {}'.format(suite, ', '.join('{} {:.4g}'.format(name, val)
+                                                  for name, val in measurements.items())))
+
+    output = args.output or os.path.join(_benchmark_dir, 'results', '{}.json'.format(commit))
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, 'w') as f:
+        json.dump({'commit': commit, 'python': sys.version.split()[0], 'params': spec.to_dict(),
+                   'repeat': args.repeat, 'results': results}, f, indent=2)
+    print('Results written to {}'.format(output))
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        if baseline.get('params') != spec.to_dict():
+            print('Warning: {} was measured with different parameters'.format(args.compare))
+        if compare(results, baseline['results'], args.threshold):
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
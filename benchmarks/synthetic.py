@@ -0,0 +1,226 @@
+# Copyright (C) 2024 Spencer Magnusson
+# semagnum@gmail.com
+# Created by Spencer Magnusson
+#     This program is free software: you can redistribute it and/or modify
+#     it under the terms of the GNU General Public License as published by
+#     the Free Software Foundation, either version 3 of the License, or
+#     (at your option) any later version.
+#     This program is distributed in the hope that it will be useful,
+#     but WITHOUT ANY WARRANTY; without even the implied warranty of
+#     MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#     GNU General Public License for more details.
+#     You should have received a copy of the GNU General Public License
+#     along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Generates synthetic materials built from fake_bpy data."""
+
+import random
+import types
+
+import numpy as np
+
+import fake_bpy
+
+# relative weight of each node kind when a socket gets linked
+DEFAULT_NODE_MIX = {
+    'mix_color': 3,
+    'mix_float': 2,
+    'clamp': 2,
+    'map_range': 2,
+    'invert': 1,
+    'hue_saturation': 1,
+    'color_ramp': 2,
+    'rgb': 1,
+    'value': 1,
+    'image': 2,
+    'math': 1,
+    'principled': 1,
+    'group': 2,
+}
+
+
+class ColorRamp:
+    """Color ramp with two or three stops, standing in for bpy's ColorRamp."""
+
+    def __init__(self, rng: random.Random):
+        positions = sorted(rng.random() for _ in range(rng.choice((2, 3))))
+        self.elements = [types.SimpleNamespace(position=position,
+                                               color=tuple(rng.random() for _ in range(3)) + (1.0,))
+                         for position in positions]
+        self.interpolation = 'LINEAR'
+        self.color_mode = 'RGB'
+
+    def evaluate(self, position: float) -> tuple:
+        elements = self.elements
+        if position <= elements[0].position:
+            return elements[0].color
+        for start, end in zip(elements, elements[1:]):
+            if position < end.position:
+                t = (position - start.position) / (end.position - start.position)
+                return tuple(a * (1.0 - t) + b * t for a, b in zip(start.color, end.color))
+        return elements[-1].color
+
+
+class SceneSpec:
+    """Parameters of a synthetic scene.
+
+    :param materials: number of materials.
+    :param depth: maximum number of nodes between a material output and a leaf.
+    :param fan_out: probability of each traversed input socket being linked to another node.
+    :param groups: number of node groups shared between materials.
+    :param group_nesting: how many groups deep a group may nest other groups.
+    :param node_mix: relative weight of each node kind, see DEFAULT_NODE_MIX.
+    :param textures: number of distinct images.
+    :param texture_size: width and height of each image in pixels.
+    :param layouts: number of distinct node layouts materials are built from, differing only in values.
+        Zero gives every material its own layout.
+    :param distinct: number of distinct materials, the others being exact copies of them like duplicated
+        materials. Zero makes every material distinct.
+    :param seed: random seed, so the same spec always builds the same scene.
+    """
+
+    def __init__(self, materials=200, depth=6, fan_out=0.7, groups=4, group_nesting=2, node_mix=None,
+                 textures=8, texture_size=256, layouts=0, distinct=0, seed=0):
+        self.materials = materials
+        self.depth = depth
+        self.fan_out = fan_out
+        self.groups = groups
+        self.group_nesting = group_nesting
+        self.node_mix = dict(DEFAULT_NODE_MIX if node_mix is None else node_mix)
+        self.textures = textures
+        self.texture_size = texture_size
+        self.layouts = layouts
+        self.distinct = distinct
+        self.seed = seed
+
+    def to_dict(self) -> dict:
+        return dict(vars(self))
+
+
+def make_image(name: str, size: int, rng: np.random.Generator) -> fake_bpy.Image:
+    pixels = rng.random(size * size * 4, dtype=np.float32)
+    return fake_bpy.Image(name, pixels, size, size)
+
+
+class SceneBuilder:
+    def __init__(self, spec: SceneSpec):
+        self.spec = spec
+        # structure and values are drawn separately, so materials can share a layout with different values
+        self.rng = random.Random(spec.seed)
+        self.values = random.Random(spec.seed + 1)
+        self.kinds = list(spec.node_mix)
+        self.weights = [spec.node_mix[kind] for kind in self.kinds]
+
+        pixel_rng = np.random.default_rng(spec.seed)
+        self.images = [make_image('Texture{:03d}'.format(i), spec.texture_size, pixel_rng)
+                       for i in range(spec.textures)]
+
+        # groups[level] holds the groups that nest at most `level` groups deep
+        self.groups = []
+        for i in range(spec.groups):
+            level = min(i * (spec.group_nesting + 1) // max(spec.groups, 1), spec.group_nesting)
+            self.groups.append((level, self.make_group('Group{:03d}'.format(i), level)))
+
+    def color(self) -> fake_bpy.Vector:
+        return fake_bpy.Vector((self.values.random(), self.values.random(), self.values.random(), 1.0))
+
+    def add_node(self, tree: fake_bpy.NodeTree, kind: str, group_level: int) -> tuple:
+        """Adds a node of a kind, returning it and the indices of its inputs worth linking."""
+        rng = self.values
+        Node = fake_bpy.Node
+        if kind == 'mix_color':
+            node = Node(tree, 'ShaderNodeMix', [rng.random(), 0.0, 0.0, 0.0, None, None, self.color(), self.color()],
+                        data_type='RGBA')
+            return node, (0, 6, 7)
+        if kind == 'mix_float':
+            node = Node(tree, 'ShaderNodeMix', [rng.random(), 0.0, rng.random(), rng.random(), None, None,
+                                                self.color(), self.color()],
+                        data_type='FLOAT')
+            return node, (0, 2, 3)
+        if kind == 'clamp':
+            node = Node(tree, 'ShaderNodeClamp', [rng.random() * 2.0 - 0.5, rng.random(), rng.random()],
+                        clamp_type=self.rng.choice(('MINMAX', 'RANGE')))
+            return node, (0, 1, 2)
+        if kind == 'map_range':
+            return Node(tree, 'ShaderNodeMapRange', [rng.random(), 0.0, 1.0, 0.0, 1.0]), (0,)
+        if kind == 'invert':
+            return Node(tree, 'ShaderNodeInvert', [1.0, self.color()]), (1,)
+        if kind == 'hue_saturation':
+            return Node(tree, 'ShaderNodeHueSaturation', [0.5, 1.0, 1.0, 1.0, self.color()]), (4,)
+        if kind == 'color_ramp':
+            return Node(tree, 'ShaderNodeValToRGB', [rng.random()], color_ramp=ColorRamp(rng)), (0,)
+        if kind == 'rgb':
+            node = Node(tree, 'ShaderNodeRGB')
+            node.outputs[0].default_value = self.color()
+            return node, ()
+        if kind == 'value':
+            node = Node(tree, 'ShaderNodeValue')
+            node.outputs[0].default_value = rng.random()
+            return node, ()
+        if kind == 'image':
+            image = rng.choice(self.images) if self.images else None
+            return Node(tree, 'ShaderNodeTexImage', [None], image=image), ()
+        if kind == 'math':
+            return Node(tree, 'ShaderNodeMath', [rng.random(), rng.random()]), (0, 1)
+        if kind == 'principled':
+            return Node(tree, 'ShaderNodeBsdfPrincipled', [self.color(), rng.random(), rng.random(), 1.45]), (0, 1, 2)
+        if kind == 'group':
+            candidates = [group for level, group in getattr(self, 'groups', ()) if level < group_level]
+            if not candidates:
+                return self.add_node(tree, 'value', group_level)
+            node = Node(tree, 'ShaderNodeGroup', [rng.random(), self.color()], outputs=2,
+                        node_tree=self.rng.choice(candidates))
+            return node, (0, 1)
+        raise ValueError('Unknown node kind: {}'.format(kind))
+
+    def fill(self, tree: fake_bpy.NodeTree, sockets, depth: int, group_level: int, group_input=None):
+        """Links random nodes into sockets, down to the given depth."""
+        stack = [(socket, depth) for socket in sockets]
+        while stack:
+            socket, depth = stack.pop()
+            if depth <= 0 or self.rng.random() >= self.spec.fan_out:
+                if group_input is not None and self.rng.random() < 0.5:
+                    tree.link(group_input.outputs[self.rng.randrange(2)], socket)
+                continue
+
+            kind = self.rng.choices(self.kinds, self.weights)[0]
+            node, linkable = self.add_node(tree, kind, group_level)
+            tree.link(node.outputs[self.rng.randrange(len(node.outputs))], socket)
+            stack.extend((node.inputs[i], depth - 1) for i in linkable)
+
+    def make_group(self, name: str, level: int) -> fake_bpy.NodeTree:
+        tree = fake_bpy.NodeTree(name)
+        group_input = fake_bpy.Node(tree, 'NodeGroupInput', outputs=2)
+        group_output = fake_bpy.Node(tree, 'NodeGroupOutput', [None, None])
+        self.fill(tree, group_output.inputs, max(self.spec.depth // 2, 1), level, group_input)
+        return tree
+
+    def make_material(self, name: str, index: int) -> fake_bpy.Material:
+        if self.spec.distinct:
+            index %= self.spec.distinct
+            self.values = random.Random((self.spec.seed + 1) * 1000003 + index)
+            if not self.spec.layouts:
+                self.rng = random.Random(self.spec.seed * 1000003 + index)
+        if self.spec.layouts:
+            self.rng = random.Random(self.spec.seed * 1000003 + index % self.spec.layouts)
+
+        material = fake_bpy.Material(name)
+        tree = material.node_tree
+        output = fake_bpy.Node(tree, 'ShaderNodeOutputMaterial', [None, None, None])
+        principled = fake_bpy.Node(tree, 'ShaderNodeBsdfPrincipled', [self.color(), 0.0, 0.5, 1.45])
+        tree.link(principled.outputs[0], output.inputs[0])
+        self.fill(tree, principled.inputs[:3], self.spec.depth - 1, self.spec.group_nesting + 1)
+        return material
+
+
+def build_scene(spec: SceneSpec, bpy=None) -> list:
+    """Builds the materials of a spec, registering them and their groups and images in bpy.data if given."""
+    builder = SceneBuilder(spec)
+    materials = [builder.make_material('Material{:05d}'.format(i), i) for i in range(spec.materials)]
+
+    if bpy is not None:
+        bpy.data.materials[:] = materials
+        bpy.data.node_groups[:] = [group for _level, group in builder.groups]
+        bpy.data.images[:] = builder.images
+
+    return materials
@@ -14,11 +14,58 @@
 
 from . import custom_node_eval as custom
 
+import os
+
 import bpy
 IS_BPY_V3 = bpy.app.version < (4, 0, 0)
 
 ALPHA_THRESHOLD = 0.7
 
+# maximum number of images whose statistics are kept in the session cache, and the most memory they may hold,
+# also bounding the cache of per-pixel chain values
+IMAGE_CACHE_MAX_ENTRIES = 256
+IMAGE_CACHE_MAX_BYTES = 16 << 20
+
+# whether image statistics are kept on disk between sessions, and the most images kept there
+IMAGE_STORE_ENABLED = True
+IMAGE_STORE_MAX_ENTRIES = 100000
+
+# number of pixels reduced at a time when averaging an image
+PIXEL_CHUNK_SIZE = 1 << 16
+
+# histogram bins per color channel when reducing textures to their dominant color,
+# which is found in the fullest block of 2 bins per channel
+DOMINANT_BINS = 16
+
+# worker threads reducing images before a batch run, 1 to reduce them one at a time during traversal
+IMAGE_WORKERS = min(4, os.cpu_count() or 1)
+
+# maximum number of nested evaluation steps before a traversal gives up and uses default values
+MAX_EVAL_DEPTH = 10000
+
+# whether operators on many materials evaluate them together with NumPy, where their nodes allow it,
+# and the longest chain of nodes evaluated that way
+VECTORIZED_EVALUATION = True
+VECTOR_MAX_DEPTH = 200
+
+# whether operators on many materials evaluate materials with identical node setups once, see fingerprint.py
+DEDUPLICATE_MATERIALS = True
+
+# worker processes evaluating snapshots of materials when operators run in worker processes, see snapshot.py
+SNAPSHOT_WORKERS = min(4, os.cpu_count() or 1)
+
+# whether a property changed on many materials is set on all of them at once, see results.py, and the fewest
+# materials changing it for that. Off until measured in Blender, as it skips the property's update callbacks
+BULK_WRITE_ENABLED = False
+BULK_WRITE_MIN_MATERIALS = 32
+
+# seconds without further edits before live sync re-evaluates changed materials
+LIVE_SYNC_DELAY = 0.5
+
+# seconds of work per time slice, and seconds between slices, when batch operators run from the UI
+BATCH_SLICE_SECONDS = 0.05
+BATCH_TIMER_INTERVAL = 0.01
+
 FIRST_INPUT = ('inputs', 0)
 
 UNIVERSAL_MAP = {
@@ -1,69 +1,83 @@
-from . import node_eval
+from . import image_sampling, node_eval
 
 from mathutils import Vector
-import numpy as np
 
 
-def color_ramp(*args):
-    """Calculates the mean RGB in the image, excluding pixels below an alpha threshold.
+def color_ramp(*args) -> dict:
+    """Evaluates the color ramp at the factor socket's value.
 
-    :param curr_node: Image-like node
+    :param node: Color ramp node
     """
 
-    node, node_key, default_val = args
-    factor_val = node_eval.assert_float(node_eval.get_from_socket(node.inputs[0], node_key, 0.5))
-    return node_eval.assert_color(node.color_ramp.evaluate(factor_val))
+    node, channels = args
+    factors = yield node_eval.socket_request(node.inputs[0], node_eval.with_default(channels, 0.5))
+
+    results = {}
+    for name, factor_val in factors.items():
+        if node_eval.is_group_input(factor_val):
+            results[name] = factor_val
+        else:
+            results[name] = node_eval.assert_color(node.color_ramp.evaluate(node_eval.assert_float(factor_val)))
+    return results
 
 
-def image_node(*args) -> Vector:
-    """Calculates the mean RGB in the image, excluding pixels below an alpha threshold.
+def image_node(*args) -> dict:
+    """Reduces the image to its mean or dominant RGB, excluding pixels below an alpha threshold.
 
     :param curr_node: Image-like node
     """
-    curr_node, _, default_val = args
+    curr_node, channels = args
     if not hasattr(curr_node, 'image') or curr_node.image is None:
-        return Vector((1.0, 0.0, 1.0, 1.0))  # typical "cannot find the texture" color
-
-    pixels = np.array(curr_node.image.pixels).reshape(-1, 4)
+        return {name: Vector((1.0, 0.0, 1.0, 1.0))  # typical "cannot find the texture" color
+                for name in channels}
 
-    # slice the pixels into the RGB channels, filter out transparent pixels, get mean
-    ch_a = pixels[:, 3]
-    pixels = pixels[(ch_a >= 0.7)]
-    pixels = np.delete(pixels, 3, axis=1)
+    color_mean = image_sampling.get_stat(curr_node.image)
 
-    color_mean = pixels.mean(axis=0)
+    if color_mean is None:
+        return node_eval.defaults(channels)
 
-    if not np.all(np.isfinite(color_mean)):
-        return default_val
+    return {name: Vector(tuple(list(color_mean) + [1.0])) for name in channels}
 
-    return Vector(tuple(list(color_mean) + [1.0]))
 
-
-def clamp_node(*args):
-    node, node_key, default_val = args
+def clamp_node(*args) -> dict:
+    node, channels = args
 
     value_socket = node.inputs[0]
     min_socket = node.inputs[1]
     max_socket = node.inputs[2]
 
-    value_socket_val = node_eval.assert_float(node_eval.get_from_socket(value_socket, node_key, default_val))
-    min_socket_val = node_eval.assert_float(node_eval.get_from_socket(min_socket, node_key, 0.0))
-    max_socket_val = node_eval.assert_float(node_eval.get_from_socket(max_socket, node_key, 1.0))
+    value_socket_vals = yield node_eval.socket_request(value_socket, channels)
+    min_socket_vals = yield node_eval.socket_request(min_socket, node_eval.with_default(channels, 0.0))
+    max_socket_vals = yield node_eval.socket_request(max_socket, node_eval.with_default(channels, 1.0))
+
+    results = {}
+    for name in channels:
+        group_input = node_eval.first_group_input(value_socket_vals[name], min_socket_vals[name],
+                                                  max_socket_vals[name])
+        if group_input is not None:
+            results[name] = group_input
+            continue
+
+        value_socket_val = node_eval.assert_float(value_socket_vals[name])
+        min_socket_val = node_eval.assert_float(min_socket_vals[name])
+        max_socket_val = node_eval.assert_float(max_socket_vals[name])
 
-    if node.clamp_type == 'RANGE':
-        new_min_socket_val = min(min_socket_val, max_socket_val)
-        new_max_socket_val = max(min_socket_val, max_socket_val)
-        min_socket_val, max_socket_val = new_min_socket_val, new_max_socket_val
+        if node.clamp_type == 'RANGE':
+            new_min_socket_val = min(min_socket_val, max_socket_val)
+            new_max_socket_val = max(min_socket_val, max_socket_val)
+            min_socket_val, max_socket_val = new_min_socket_val, new_max_socket_val
 
-    return min(max(value_socket_val, min_socket_val), max_socket_val)
+        results[name] = min(max(value_socket_val, min_socket_val), max_socket_val)
 
+    return results
 
-def mix_node(*args) -> Vector:
+
+def mix_node(*args) -> dict:
     # We're just going to mix the two socket values based on factor.
-    node, node_key, default_val = args
+    node, channels = args
 
     data_type = node.data_type
-    factor_value = node_eval.assert_float(node_eval.get_from_socket(node.inputs[0], node_key, 0.0))
+    factor_values = yield node_eval.socket_request(node.inputs[0], node_eval.with_default(channels, 0.0))
 
     if data_type == 'RGBA':
         a_socket = node.inputs[6]
@@ -75,17 +89,27 @@ def mix_node(*args) -> Vector:
         a_socket = node.inputs[2]
         b_socket = node.inputs[3]
 
-    a_factor = 1 - factor_value
-    if data_type == 'FLOAT':
-        a_val = node_eval.assert_float(node_eval.get_from_socket(node.inputs[2], node_key, default_val))
-        b_val = node_eval.assert_float(node_eval.get_from_socket(node.inputs[3], node_key, default_val))
-        val = (b_val * factor_value) + (a_val * a_factor)
-    else:
-        a_factor = 1 - factor_value
-        a_val = [v * a_factor
-                 for v in node_eval.assert_color(node_eval.get_from_socket(a_socket, node_key, default_val))]
-        b_val = [v * factor_value
-                 for v in node_eval.assert_color(node_eval.get_from_socket(b_socket, node_key, default_val))]
-        val = Vector([a + b for a,b in zip(a_val, b_val)])
+    a_vals = yield node_eval.socket_request(a_socket, channels)
+    b_vals = yield node_eval.socket_request(b_socket, channels)
 
-    return val
+    results = {}
+    for name in channels:
+        group_input = node_eval.first_group_input(factor_values[name], a_vals[name], b_vals[name])
+        if group_input is not None:
+            results[name] = group_input
+            continue
+
+        factor_value = node_eval.assert_float(factor_values[name])
+        a_factor = 1 - factor_value
+        if data_type == 'FLOAT':
+            a_val = node_eval.assert_float(a_vals[name])
+            b_val = node_eval.assert_float(b_vals[name])
+            val = (b_val * factor_value) + (a_val * a_factor)
+        else:
+            a_val = [v * a_factor for v in node_eval.assert_color(a_vals[name])]
+            b_val = [v * factor_value for v in node_eval.assert_color(b_vals[name])]
+            val = Vector([a + b for a,b in zip(a_val, b_val)])
+
+        results[name] = val
+
+    return results
@@ -0,0 +1,294 @@
+# Copyright (C) 2024 Spencer Magnusson
+# semagnum@gmail.com
+# Created by Spencer Magnusson
+#     This program is free software: you can redistribute it and/or modify
+#     it under the terms of the GNU General Public License as published by
+#     the Free Software Foundation, either version 3 of the License, or
+#     (at your option) any later version.
+#     This program is distributed in the hope that it will be useful,
+#     but WITHOUT ANY WARRANTY; without even the implied warranty of
+#     MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#     GNU General Public License for more details.
+#     You should have received a copy of the GNU General Public License
+#     along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Fingerprints of everything a material's evaluation depends on, so identical materials are evaluated once,
+and materials that have not changed since they were last set are skipped.
+"""
+
+import hashlib
+import os
+
+import bpy
+
+from . import custom_node_eval as custom, image_stats, image_store, node_eval, pixel_eval, tree_plan
+
+# ID property keeping the fingerprint of a material when it was last set, with the values set
+PROPERTY = 'cfm_fingerprint'
+
+# changes whenever the same fingerprint may evaluate to different values, so stored fingerprints are out of date
+STORED_VERSION = 1
+
+
+def _handler_inputs(handler, node) -> tuple:
+    """Returns the input indices a custom_node_eval handler reads, or None if unknown."""
+    if handler is custom.clamp_node:
+        return 0, 1, 2
+    if handler is custom.color_ramp:
+        return 0,
+    if handler is custom.image_node:
+        return ()
+    if handler is custom.mix_node:
+        data_type = node.data_type
+        if data_type == 'RGBA':
+            return 0, 6, 7
+        if data_type == 'VECTOR':
+            return 0, 4, 5
+        return 0, 2, 3
+    return None
+
+
+def _value(val):
+    try:
+        return tuple(val)
+    except TypeError:
+        return val
+
+
+def _ramp(ramp) -> tuple:
+    return (ramp.interpolation, ramp.color_mode, getattr(ramp, 'hue_interpolation', None),
+            tuple((element.position, tuple(element.color)) for element in ramp.elements))
+
+
+# node properties the evaluation reads besides sockets, when a node has them
+_PROPERTIES = ('data_type', 'clamp_type', 'image', 'color_ramp', 'node_tree')
+
+# properties each node type has, and sockets read from each kind of node by each set of channels,
+# which only depend on the node types and the config, so are shared by fingerprinters
+_node_properties = {}
+_relevant_sockets = {}
+
+
+class _Skeleton:
+    """What a fingerprint reads from a tree, which only changes with its structure and so is kept in its plan.
+
+    :param nodes: reachable nodes in the order they are reached, as (node plan, data type, properties,
+        unlinked input sockets and output sockets read).
+    :param digest: hash of the node types, links and socket indices read.
+    """
+
+    __slots__ = ('nodes', 'digest')
+
+    def __init__(self, nodes: tuple, digest: str):
+        self.nodes = nodes
+        self.digest = digest
+
+
+def _digest(parts) -> str:
+    return hashlib.blake2b(repr(parts).encode(), digest_size=16).hexdigest()
+
+
+def image_identity(image: bpy.types.Image) -> str:
+    """Returns what an image's pixels are recognized by in any session, like the persistent store,
+    or None if they may differ from the saved files.
+    """
+    if image.source == 'TILED' and image.packed_file is None and not image.is_dirty:
+        filepath = bpy.path.abspath(image.filepath, library=image.library)
+        settings = image_store.image_settings(image)
+        keys = [image_store.file_key(image_stats.tile_path(filepath, tile.number), settings) for tile in image.tiles]
+        if None in keys:
+            return None
+        return _digest(tuple(key.digest for key in keys))
+
+    key = image_store.image_key(image)
+    return None if key is None else key.digest
+
+
+def stored_value(material: bpy.types.Material, fingerprint: str, names) -> str:
+    """Returns what is stored on a material once set: its fingerprint and the values it was set to,
+    so later edits to either make it out of date.
+
+    :param names: names of the channels set.
+    """
+    return _digest((STORED_VERSION, fingerprint, tuple(_value(getattr(material, name)) for name in names)))
+
+
+def is_up_to_date(material: bpy.types.Material, fingerprint: str, names) -> bool:
+    """Returns whether a material was last set from the same fingerprint, and still has the values it was set to."""
+    stored = material.get(PROPERTY)
+    return stored is not None and stored == stored_value(material, fingerprint, names)
+
+
+def store(material: bpy.types.Material, fingerprint: str, names):
+    """Keeps a material's fingerprint after setting it, only writing it if it changed."""
+    stored = stored_value(material, fingerprint, names)
+    if material.get(PROPERTY) != stored:
+        material[PROPERTY] = stored
+
+
+class Fingerprinter:
+    """Fingerprints materials for one set of channels, from the values evaluating them would read.
+
+    Node names and pointers are left out, so copies of a material get the same fingerprint,
+    and the fingerprint is stable across sessions. Images are identified by their files, see image_identity(),
+    and images with unsaved changes by a token of this fingerprinter, so no later fingerprint matches.
+    Node group and image fingerprints are shared between materials,
+    so a fingerprinter must not outlive changes to them, like an evaluation run.
+
+    :param channels: channel names mapped to their config key and default value.
+    :param per_pixel: whether texture chains are evaluated per pixel, reading every input of their nodes.
+    :param estimate: tolerance and seed texture means are estimated with, or None if they are exact.
+    :param statistic: statistic textures are reduced to, see image_stats.STATISTICS.
+    """
+
+    def __init__(self, channels: dict, per_pixel: bool = False, estimate: tuple = None,
+                 statistic: str = image_stats.MEAN):
+        self.names = tuple((name, _value(default_val)) for name, (_node_key, default_val) in channels.items())
+        self.node_keys = [node_key for node_key, _default_val in channels.values()]
+        self.per_pixel = per_pixel
+        self.estimate = estimate
+        self.statistic = statistic
+        self._key = (__name__, self.names, tuple(id(node_key) for node_key in self.node_keys), per_pixel)
+        self._token = os.urandom(8).hex()
+        self._groups = {}
+        self._images = {}
+
+    def material(self, material: bpy.types.Material) -> str:
+        """Returns a material's fingerprint, or None if it has no nodes to evaluate."""
+        if not material.use_nodes or material.node_tree is None:
+            return None
+
+        plan = node_eval.get_tree_plan(material.node_tree)
+        if plan.output is None:
+            return None
+
+        return _digest((self.names, self.per_pixel, self.estimate, self.statistic, self._tree(plan, False)))
+
+    def _image(self, image: bpy.types.Image) -> tuple:
+        key = image.name_full
+        if key not in self._images:
+            identity = image_identity(image)
+            self._images[key] = ('UNSAVED', key, self._token) if identity is None else identity
+        return self._images[key]
+
+    def _group(self, node_tree: bpy.types.NodeTree) -> str:
+        key = node_tree.as_pointer()
+        if key not in self._groups:
+            self._groups[key] = None  # a group nested in itself
+            plan = node_eval.get_tree_plan(node_tree)
+            self._groups[key] = _digest(None if plan.output is None else self._tree(plan, True))
+        return self._groups[key]
+
+    def _skeleton(self, plan: tree_plan.TreePlan, group: bool, rebuild: bool = False) -> _Skeleton:
+        key = self._key + (group,)
+        skeleton = None if rebuild else plan.derived.get(key)
+        if skeleton is None:
+            skeleton = plan.derived[key] = self._walk(plan, group)
+        return skeleton
+
+    def _tree(self, plan: tree_plan.TreePlan, group: bool) -> tuple:
+        """Returns the structure and values a tree's evaluation reads, from its output node."""
+        skeleton = self._skeleton(plan, group)
+        values = self._values(skeleton)
+        if values is None:
+            skeleton = self._skeleton(plan, group, rebuild=True)
+            values = self._values(skeleton)
+        return skeleton.digest, values
+
+    def _values(self, skeleton: _Skeleton) -> tuple:
+        """Reads the values of a skeleton's nodes, or returns None if a data type changed what they read."""
+        values = []
+        for node_plan, data_type, properties, sockets in skeleton.nodes:
+            if not properties:
+                values.append(tuple([_value(getattr(socket, 'default_value', None)) for socket in sockets]))
+                continue
+
+            node = node_plan.node
+            data = []
+            for name in properties:
+                val = getattr(node, name)
+                if name == 'data_type':
+                    if val != data_type:
+                        return None
+                elif val is not None:
+                    if name == 'image':
+                        val = self._image(val)
+                    elif name == 'color_ramp':
+                        val = _ramp(val)
+                    elif name == 'node_tree':
+                        val = self._group(val)
+                data.append(val)
+
+            data.extend([_value(getattr(socket, 'default_value', None)) for socket in sockets])
+            values.append(tuple(data))
+
+        return tuple(values)
+
+    def relevant(self, node_plan: tree_plan.NodePlan) -> tuple:
+        """Returns the input and output indices whose values the channels may read from a node."""
+        if node_plan.is_group or (self.per_pixel and node_plan.bl_idname in pixel_eval.CHAIN_NODES):
+            return tuple(range(len(node_plan.inputs))), ()
+
+        # which sockets are read only varies by node type, socket count and, for mix nodes, data type
+        key = (self._key, node_plan.bl_idname, len(node_plan.inputs), len(node_plan.outputs),
+               getattr(node_plan.node, 'data_type', None))
+        if key not in _relevant_sockets:
+            inputs = set()
+            outputs = set()
+            for node_key in self.node_keys:
+                entry = node_key.get(node_plan.bl_idname)
+                if entry is None:
+                    if len(node_plan.inputs) == 1:
+                        inputs.add(0)
+                elif callable(entry):
+                    handler_inputs = _handler_inputs(entry, node_plan.node)
+                    inputs.update(range(len(node_plan.inputs)) if handler_inputs is None else handler_inputs)
+                elif not isinstance(entry, float):
+                    direction, idx = entry
+                    (inputs if direction == 'inputs' else outputs).add(idx)
+
+            _relevant_sockets[key] = (tuple(sorted(idx for idx in inputs if idx < len(node_plan.inputs))),
+                                        tuple(sorted(idx for idx in outputs if idx < len(node_plan.outputs))))
+        return _relevant_sockets[key]
+
+    def _walk(self, plan: tree_plan.TreePlan, group: bool) -> _Skeleton:
+        """Walks the nodes reachable from a tree's output, numbered in the order they are reached.
+
+        A group's output node may be read from any of its inputs, depending on the group node's output used.
+        """
+        index = {plan.output: 0}
+        stack = [plan.output]
+        nodes = []
+        structure = []
+        while stack:
+            node_plan = stack.pop()
+            node = node_plan.node
+            input_indices, output_indices = self.relevant(node_plan)
+            if group and node_plan is plan.output:
+                input_indices = tuple(range(len(node_plan.inputs)))
+
+            sockets = []
+            reads = [node_plan.bl_idname]
+            for idx in input_indices:
+                socket = node_plan.inputs[idx]
+                link = plan.links.get(socket.as_pointer())
+                if link is None:
+                    sockets.append(socket)
+                    reads.append(idx)
+                    continue
+
+                if link.from_node not in index:
+                    index[link.from_node] = len(index)
+                    stack.append(link.from_node)
+                reads.append((idx, index[link.from_node], link.from_socket_index))
+            reads.append(output_indices)
+
+            properties = _node_properties.get(node_plan.bl_idname)
+            if properties is None:
+                properties = _node_properties[node_plan.bl_idname] = tuple(name for name in _PROPERTIES
+                                                                           if hasattr(node, name))
+            sockets.extend(node_plan.outputs[idx] for idx in output_indices)
+            nodes.append((node_plan, getattr(node, 'data_type', None), properties, tuple(sockets)))
+            structure.append((index[node_plan], properties, tuple(reads)))
+
+        return _Skeleton(tuple(nodes), _digest(structure))
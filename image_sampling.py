@@ -0,0 +1,202 @@
+# Copyright (C) 2024 Spencer Magnusson
+# semagnum@gmail.com
+# Created by Spencer Magnusson
+#     This program is free software: you can redistribute it and/or modify
+#     it under the terms of the GNU General Public License as published by
+#     the Free Software Foundation, either version 3 of the License, or
+#     (at your option) any later version.
+#     This program is distributed in the hope that it will be useful,
+#     but WITHOUT ANY WARRANTY; without even the implied warranty of
+#     MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#     GNU General Public License for more details.
+#     You should have received a copy of the GNU General Public License
+#     along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Estimates of image means from random samples of their pixels.
+
+A viewport color does not need the exact mean of every pixel. In fast estimate mode, an image's pixels are split
+into horizontal bands, and each band is sampled at random until the 95% confidence interval of the
+alpha-filtered mean is narrower than a tolerance. Only the sampled pixels are reduced.
+"""
+
+import zlib
+from contextlib import contextmanager
+
+import bpy
+import numpy as np
+
+from . import config, image_stats, image_store
+
+# number of bands sampled separately, and pixels first sampled from each
+STRATA = 64
+FIRST_SAMPLES = 16
+
+# share of an image's pixels sampled before reducing all of them is cheaper,
+# as gathering a random pixel costs about as much as reducing 30 in order
+EXACT_SHARE = 1 / 50
+
+# half-width of a confidence interval holding all three channels with 95% confidence, in standard errors
+_Z = 2.39
+
+
+def estimate_stats(pixels: np.ndarray, threshold: float, tolerance: float, seed) -> tuple:
+    """Estimates the mean RGB of pixels at or above the alpha threshold from a stratified random sample.
+
+    The sample grows until the confidence interval of every channel is within the tolerance,
+    to the size the error so far suggests, and at least doubling. Every pixel is reduced instead
+    once the sample would be a large share of them, or holds a counted color that is NaN or infinite.
+
+    :param pixels: (N, 4) array of RGBA pixels.
+    :param threshold: minimum alpha for a pixel to be counted.
+    :param tolerance: largest error allowed in any channel, at 95% confidence.
+    :param seed: seed of the random generator, so the same pixels are sampled each time.
+    :return: RGB mean as a tuple (None if no pixels pass the threshold), pixels sampled, and the error.
+    """
+    total = len(pixels)
+    strata = min(STRATA, total)
+    if strata == 0:
+        return None, 0, 0.0
+
+    bounds = np.linspace(0, total, strata + 1).astype(np.int64)
+    starts = bounds[:-1, None]
+    sizes = np.diff(bounds)[:, None]
+    band_weights = sizes[:, 0] / total
+
+    rng = np.random.default_rng(seed)
+    samples = 0
+    passed = np.zeros(strata)
+    rgb_sum = np.zeros((strata, 3))
+    rgb_square_sum = np.zeros((strata, 3))
+
+    per_stratum = FIRST_SAMPLES
+    while (samples + per_stratum * strata) <= total * EXACT_SHARE:
+        indices = starts + (rng.random((strata, per_stratum)) * sizes).astype(np.int64)
+        sample = pixels[indices.ravel()].reshape(strata, per_stratum, 4)
+        counted = sample[..., 3] >= threshold
+        if not np.all(np.isfinite(sample[counted, :3])):
+            break  # NaN or infinite colors, as in HDR textures, are reduced exactly like reduce_pixels does
+        rgb = np.where(counted[..., None], sample[..., :3], 0.0)  # not weighted, as NaN * 0 is NaN
+
+        passed += np.count_nonzero(counted, axis=1)
+        rgb_sum += rgb.sum(axis=1, dtype=np.float64)
+        rgb_square_sum += np.square(rgb).sum(axis=1, dtype=np.float64)
+        samples += per_stratum * strata
+        per_stratum = samples // strata  # doubling the sample
+
+        # ratio of the estimated sum of counted colors to the estimated share of counted pixels
+        band_samples = samples // strata
+        passed_share = band_weights @ (passed / band_samples)
+        if passed_share == 0.0:
+            continue
+        mean = (band_weights @ (rgb_sum / band_samples)) / passed_share
+
+        # variance of each band's residuals from the ratio, where x is 1 for a counted pixel and 0 otherwise:
+        # sum((y - mean * x)^2) = sum(y^2) - 2 * mean * sum(y) + mean^2 * sum(x)
+        residual_sum = rgb_sum - mean * passed[:, None]
+        residual_square_sum = rgb_square_sum - 2.0 * mean * rgb_sum + np.square(mean) * passed[:, None]
+        band_variance = np.maximum(residual_square_sum - np.square(residual_sum) / band_samples, 0.0) / (
+            band_samples - 1)
+        variance = np.square(band_weights) @ (band_variance / band_samples) / passed_share ** 2
+
+        error = float(_Z * np.sqrt(variance.max()))
+        if not np.isfinite(error):
+            break
+        if error <= tolerance:
+            if not np.all(np.isfinite(mean)):
+                return None, samples, error
+            return tuple(float(v) for v in mean), samples, error
+
+        # the error shrinks with the square root of the sample size, so grow it to what would likely be enough
+        needed = samples * (error / tolerance) ** 2 * 1.2
+        per_stratum = max(per_stratum, int(np.ceil(needed / strata)) - band_samples)
+
+    return image_stats.stats_from_pixels(pixels)[0], total, 0.0
+
+
+class Sampler:
+    """Fast estimate settings for a run, and the estimates it used, for its report.
+
+    :param tolerance: largest error allowed in any channel, at 95% confidence.
+    :param seed: seed of the random generator, combined with each image's name.
+    """
+
+    def __init__(self, tolerance: float, seed: int):
+        self.tolerance = tolerance
+        self.seed = seed
+        self.estimates = {}
+
+    def image_seed(self, image: bpy.types.Image) -> tuple:
+        """Seed for one image, so its estimate does not depend on the order images are read in."""
+        return self.seed, zlib.crc32(image.name_full.encode())
+
+    def mean(self, image: bpy.types.Image):
+        """Returns an image's estimated mean, reusing an earlier estimate with the same settings.
+        An exact mean in the persistent store is used instead of estimating.
+        """
+        estimates = CACHE.get(image, lambda _image: {})
+        settings = (self.tolerance, self.seed)
+        if settings not in estimates:
+            key = image_stats.store_key(image)
+            stats = None if key is None else image_store.STORE.get(key)
+            if stats is not None:
+                image_stats.CACHE.store(image, stats[0])
+                return stats[0]
+
+            pixels = image_stats.read_pixels(image)
+            estimates[settings] = estimate_stats(pixels, config.ALPHA_THRESHOLD, self.tolerance,
+                                                 self.image_seed(image)) + (len(pixels),)
+            CACHE.store(image, estimates)  # measures the new estimate
+
+        mean, samples, error, total = estimates[settings]
+        self.estimates[image.name_full] = samples, total, error
+        return mean
+
+    def summary(self) -> str:
+        if not self.estimates:
+            return 'no textures estimated'
+        samples = sum(samples for samples, _total, _error in self.estimates.values())
+        total = sum(total for _samples, total, _error in self.estimates.values())
+        error = max(error for _samples, _total, error in self.estimates.values())
+        return '{} textures estimated from {} of {} pixels ({:.2%}), error at most {:.4f}'.format(
+            len(self.estimates), samples, total, samples / total if total else 0.0, error)
+
+
+# estimates of each image, keyed by their sampler settings
+CACHE = image_stats.ImageStatsCache()
+
+_sampler = None
+
+
+def active() -> Sampler:
+    """Returns the sampler of the current block, or None if image means are exact."""
+    return _sampler
+
+
+@contextmanager
+def sampling(sampler: Sampler = None):
+    """Estimates image means with the sampler inside the block, or computes them exactly if it is None."""
+    global _sampler
+    outer = _sampler
+    _sampler = sampler
+    try:
+        yield sampler
+    finally:
+        _sampler = outer
+
+
+def get_stat(image: bpy.types.Image):
+    """Returns the active alpha-filtered RGB statistic of an image, see image_stats.get_stat.
+    Its mean is estimated instead if a sampler is active.
+
+    Exact means already in the session cache are used instead of estimating.
+    Tiled images, and statistics other than the mean, are always exact.
+    """
+    if (_sampler is None or image_stats.active_statistic() != image_stats.MEAN or image.source == 'TILED'
+            or image_stats.CACHE.contains(image)):
+        return image_stats.get_stat(image)
+    return _sampler.mean(image)
+
+
+@bpy.app.handlers.persistent
+def clear_on_load(_dummy):
+    CACHE.invalidate()
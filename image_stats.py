@@ -0,0 +1,636 @@
+# Copyright (C) 2024 Spencer Magnusson
+# semagnum@gmail.com
+# Created by Spencer Magnusson
+#     This program is free software: you can redistribute it and/or modify
+#     it under the terms of the GNU General Public License as published by
+#     the Free Software Foundation, either version 3 of the License, or
+#     (at your option) any later version.
+#     This program is distributed in the hope that it will be useful,
+#     but WITHOUT ANY WARRANTY; without even the implied warranty of
+#     MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#     GNU General Public License for more details.
+#     You should have received a copy of the GNU General Public License
+#     along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import sys
+from collections import OrderedDict
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from contextlib import contextmanager
+
+import bpy
+import numpy as np
+
+from . import config, image_store, profiling
+
+# statistics a texture can be reduced to, as (identifier, name, description) for an EnumProperty
+MEAN = 'MEAN'
+DOMINANT = 'DOMINANT'
+STATISTICS = [
+    (MEAN, 'Average', 'Average color of the texture\'s pixels'),
+    (DOMINANT, 'Dominant', 'Average color of the most common group of similar colors in the texture, '
+                           'which ignores sparse details such as mortar between bricks'),
+]
+
+_statistic = MEAN
+
+
+def active_statistic() -> str:
+    """Returns the statistic textures are reduced to in the current block."""
+    return _statistic
+
+
+@contextmanager
+def statistic(name: str = MEAN):
+    """Reduces textures to the statistic inside the block, see STATISTICS."""
+    global _statistic
+    outer = _statistic
+    _statistic = name
+    try:
+        yield name
+    finally:
+        _statistic = outer
+
+
+# advanced by every evaluation run, so images with unsaved edits are reduced again once per run
+_edit_epoch = 0
+
+
+def next_edit_epoch():
+    """Starts a new evaluation run, invalidating the statistics of images with unsaved edits, such as
+    texture painting. Their is_dirty flag stays set across strokes, so it cannot tell edits apart by itself.
+    """
+    global _edit_epoch
+    _edit_epoch += 1
+
+
+def cached_bytes(value) -> int:
+    """Approximate memory held by a cached value, including the arrays and items it contains."""
+    size = sys.getsizeof(value)
+    if isinstance(value, np.ndarray):
+        return max(size, value.nbytes)
+    if isinstance(value, dict):
+        size += sum(cached_bytes(key) + cached_bytes(val) for key, val in value.items())
+    elif isinstance(value, (tuple, list)):
+        size += sum(cached_bytes(val) for val in value)
+    return size
+
+
+class ImageStatsCache:
+    """Least-recently-used cache of image statistics, bounded by entries and bytes.
+
+    Entries are keyed by the image's full name and stored alongside a validity stamp,
+    holding the value of each kind of statistic computed for the image so far.
+    A lookup whose stamp no longer matches the image is treated as a miss and recomputed.
+    """
+
+    def __init__(self, max_entries: int = None, max_bytes: int = None):
+        self._max_entries = max_entries
+        self._max_bytes = max_bytes
+        self.generation = 0
+        self.hits = 0
+        self.misses = 0
+        self.bytes = 0
+        self._entries = OrderedDict()
+        self._sizes = {}
+
+    @property
+    def max_entries(self) -> int:
+        """Entry cap, read from the config unless one was given explicitly."""
+        if self._max_entries is None:
+            return config.IMAGE_CACHE_MAX_ENTRIES
+        return self._max_entries
+
+    @property
+    def max_bytes(self) -> int:
+        """Memory cap, read from the config unless one was given explicitly."""
+        if self._max_bytes is None:
+            return config.IMAGE_CACHE_MAX_BYTES
+        return self._max_bytes
+
+    def __len__(self):
+        return len(self._entries)
+
+    def stamp(self, image: bpy.types.Image) -> tuple:
+        """Returns the values that must be unchanged for a cached entry to remain valid."""
+        # not the image size, as reading it loads and decodes the image
+        return (
+            image.filepath,
+            image.source,
+            image.generated_width,
+            image.generated_height,
+            len(image.tiles),
+            _edit_epoch if image.is_dirty else None,
+            image.packed_file is not None,
+            self.generation,
+        )
+
+    def get(self, image: bpy.types.Image, compute, kind: str = MEAN):
+        """Returns the cached statistics of an image, computing and storing them on a miss.
+
+        :param image: image data-block.
+        :param compute: callable taking the image and returning its statistics.
+        :param kind: kind of statistic, cached separately for the same image.
+        """
+        key = image.name_full
+        entry = self._entries.get(key)
+        if entry is not None and entry[0] == self.stamp(image) and kind in entry[1]:
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1][kind]
+
+        self.misses += 1
+        value = compute(image)
+        self.store(image, value, kind)
+        return value
+
+    def contains(self, image: bpy.types.Image, kind: str = MEAN) -> bool:
+        """Returns whether the image has a valid entry, without counting a hit or miss."""
+        entry = self._entries.get(image.name_full)
+        return entry is not None and entry[0] == self.stamp(image) and kind in entry[1]
+
+    def store(self, image: bpy.types.Image, value, kind: str = MEAN):
+        """Stores statistics computed elsewhere, evicting the least recently used entries over the caps.
+        A value changed in place is measured again by storing it again.
+        """
+        key = image.name_full
+        stamp = self.stamp(image)
+        entry = self._entries.get(key)
+        if entry is None or entry[0] != stamp:
+            entry = self._entries[key] = (stamp, {})
+        entry[1][kind] = value
+        self._entries.move_to_end(key)
+
+        size = cached_bytes(entry)
+        self.bytes += size - self._sizes.get(key, 0)
+        self._sizes[key] = size
+        while len(self._entries) > 1 and (len(self._entries) > self.max_entries or self.bytes > self.max_bytes):
+            self.bytes -= self._sizes.pop(self._entries.popitem(last=False)[0])
+
+    def invalidate(self, image: bpy.types.Image = None):
+        """Drops a single image's entry, or every entry if no image is given,
+        along with the hash of its packed data, see image_store.image_key.
+        """
+        image_store.forget_packed(image)
+        if image is None:
+            self._entries.clear()
+            self._sizes.clear()
+            self.bytes = 0
+            self.generation += 1
+        elif self._entries.pop(image.name_full, None) is not None:
+            self.bytes -= self._sizes.pop(image.name_full)
+
+    def reset_counters(self):
+        self.hits = 0
+        self.misses = 0
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            'entries': len(self._entries),
+            'bytes': self.bytes,
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / total if total else 0.0,
+        }
+
+
+CACHE = ImageStatsCache()
+
+
+_pixel_buffers = []
+
+
+def read_pixels(image: bpy.types.Image, slot: int = 0) -> np.ndarray:
+    """Reads an image's pixels in bulk into a reusable float32 buffer.
+
+    The buffer only grows, so repeated reads do not allocate, until release_buffer() frees it after each run.
+    Blender only hands out an image's pixels all at once, so it holds the largest image read in the run.
+    The returned array is a view into the shared buffer and is overwritten by the next read into the same slot.
+
+    :param slot: buffer to read into, so several images can be held at once, such as by a per-pixel chain.
+    :return: (N, 4) array of RGBA pixels.
+    """
+    while len(_pixel_buffers) <= slot:
+        _pixel_buffers.append(np.empty(0, dtype=np.float32))
+
+    count = len(image.pixels)
+    if _pixel_buffers[slot].size < count:
+        _pixel_buffers[slot] = np.empty(count, dtype=np.float32)
+
+    view = _pixel_buffers[slot][:count]
+    image.pixels.foreach_get(view)
+    profiling.record_image_read(view.nbytes)
+    return view.reshape(-1, 4)
+
+
+def release_buffer():
+    """Frees the shared pixel buffers."""
+    _pixel_buffers.clear()
+
+
+def reduce_pixels(pixels: np.ndarray, threshold: float, chunk_size: int = None) -> tuple:
+    """Sums the RGB of all pixels at or above the alpha threshold, in fixed-size chunks.
+
+    Only chunk-sized scratch arrays are allocated, regardless of image size.
+    Pixels below the threshold may have NaN colors, which a chunk's weighted sum would carry over.
+
+    :param pixels: (N, 4) array of RGBA pixels.
+    :param threshold: minimum alpha for a pixel to be counted.
+    :param chunk_size: number of pixels reduced at a time.
+    :return: RGB sum as a float64 array, and the number of pixels counted.
+    """
+    if chunk_size is None:
+        chunk_size = config.PIXEL_CHUNK_SIZE
+
+    rgb_sum = np.zeros(3, dtype=np.float64)
+    count = 0
+
+    mask = np.empty(min(chunk_size, len(pixels)), dtype=bool)
+    weights = np.empty(len(mask), dtype=pixels.dtype)
+
+    for start in range(0, len(pixels), chunk_size):
+        chunk = pixels[start:start + chunk_size]
+        chunk_mask = mask[:len(chunk)]
+        chunk_weights = weights[:len(chunk)]
+
+        np.greater_equal(chunk[:, 3], threshold, out=chunk_mask)
+        chunk_weights[:] = chunk_mask
+
+        # masked sum as a dot product, which avoids copying the passing pixels out,
+        # unless a NaN makes it NaN, as it may be in a pixel weighted by zero
+        chunk_sum = chunk_weights @ chunk[:, :3]
+        if not np.all(np.isfinite(chunk_sum)):
+            chunk_sum = chunk[chunk_mask, :3].sum(axis=0, dtype=np.float64)
+        rgb_sum += chunk_sum
+        count += int(np.count_nonzero(chunk_mask))
+
+    return rgb_sum, count
+
+
+def stats_from_pixels(pixels: np.ndarray) -> tuple:
+    """Calculates the mean RGB of pixels, excluding pixels below the alpha threshold.
+
+    :param pixels: (N, 4) array of RGBA pixels.
+    :return: RGB mean as a tuple (None if no pixels pass the threshold), pixels counted, and total pixels.
+    """
+    rgb_sum, count = reduce_pixels(pixels, config.ALPHA_THRESHOLD)
+
+    if count == 0:
+        return None, 0, len(pixels)
+
+    color_mean = rgb_sum / count
+    if not np.all(np.isfinite(color_mean)):
+        return None, count, len(pixels)
+
+    return tuple(float(v) for v in color_mean), count, len(pixels)
+
+
+def mean_from_pixels(pixels: np.ndarray):
+    """Calculates the mean RGB of pixels, excluding pixels below the alpha threshold.
+
+    :param pixels: (N, 4) array of RGBA pixels.
+    :return: RGB mean as a tuple, or None if no pixels pass the threshold.
+    """
+    return stats_from_pixels(pixels)[0]
+
+
+def _bin_positions(rgb: np.ndarray, bins: int) -> np.ndarray:
+    """Returns the histogram bin of each color as a float32 array, with bins equally wide in each channel
+    from 0 to 1. Colors outside that range fall into the outermost bins.
+    """
+    # quantized in float32, which is faster than converting the strided channels to integers
+    quantized = np.multiply(rgb, bins, dtype=np.float32)
+    np.floor(quantized, out=quantized)
+    # unlike clip, fmax and fmin also move NaN into a bin
+    np.fmax(quantized, 0.0, out=quantized)
+    np.fmin(quantized, bins - 1, out=quantized)
+    return quantized @ np.array([bins * bins, bins, 1], dtype=np.float32)
+
+
+def _block_sums(grid: np.ndarray) -> np.ndarray:
+    """Sums each block of 2 by 2 by 2 neighboring bins of a (bins, bins, bins) histogram."""
+    grid = grid[:-1] + grid[1:]
+    grid = grid[:, :-1] + grid[:, 1:]
+    return grid[:, :, :-1] + grid[:, :, 1:]
+
+
+class ColorHistogram:
+    """Counts colors into quantized bins, keeping the sum of each bin's colors, one chunk of pixels at a time.
+
+    The dominant color is that of the fullest block of 2 by 2 by 2 bins, as blocks overlap by a bin,
+    so a group of similar colors on the edge of two bins still falls in a single block.
+
+    :param bins: bins per channel, config.DOMINANT_BINS by default, at least 2.
+    """
+
+    def __init__(self, bins: int = None):
+        self.bins = config.DOMINANT_BINS if bins is None else bins
+        # one more bin collects the pixels below the alpha threshold
+        self._size = self.bins ** 3
+        self.counts = np.zeros(self._size + 1, dtype=np.int64)
+        self.sums = np.zeros((3, self._size + 1), dtype=np.float64)
+
+    def add(self, rgb: np.ndarray, mask: np.ndarray):
+        """Counts the colors of a chunk whose mask is set.
+
+        :param rgb: (N, 3) array of colors.
+        :param mask: (N,) boolean array of the pixels to count.
+        """
+        positions = _bin_positions(rgb, self.bins)
+        np.copyto(positions, self._size, where=~mask)
+        indices = positions.astype(np.intp)
+        self.counts += np.bincount(indices, minlength=self._size + 1)
+        for channel in range(3):
+            self.sums[channel] += np.bincount(indices, weights=rgb[:, channel], minlength=self._size + 1)
+
+    def dominant(self) -> tuple:
+        """Returns the mean color of the fullest block of bins as a tuple (None if no pixels were counted),
+        and the pixels in it.
+        """
+        shape = (self.bins,) * 3
+        blocks = _block_sums(self.counts[:self._size].reshape(shape))
+        r, g, b = np.unravel_index(int(np.argmax(blocks)), blocks.shape)
+        count = int(blocks[r, g, b])
+        if count == 0:
+            return None, 0
+
+        sums = self.sums[:, :self._size].reshape((3,) + shape)
+        color = sums[:, r:r + 2, g:g + 2, b:b + 2].sum(axis=(1, 2, 3)) / count
+        if not np.all(np.isfinite(color)):
+            return None, 0
+        return tuple(float(v) for v in color), count
+
+
+def dominant_from_pixels(pixels: np.ndarray, chunk_size: int = None) -> tuple:
+    """Calculates the dominant RGB of pixels, excluding pixels below the alpha threshold, in one pass.
+
+    Colors are counted in a histogram of quantized bins, and the result is the mean color of the fullest bin,
+    so a texture with a strong main color and sparse highlights gives the main color instead of a blend.
+
+    :param pixels: (N, 4) array of RGBA pixels.
+    :param chunk_size: number of pixels counted at a time.
+    :return: RGB of the dominant color as a tuple (None if no pixels pass the threshold), pixels in its bin,
+        and total pixels.
+    """
+    if chunk_size is None:
+        chunk_size = config.PIXEL_CHUNK_SIZE
+
+    histogram = ColorHistogram()
+    for start in range(0, len(pixels), chunk_size):
+        chunk = pixels[start:start + chunk_size]
+        histogram.add(chunk[:, :3], chunk[:, 3] >= config.ALPHA_THRESHOLD)
+
+    color, count = histogram.dominant()
+    return color, count, len(pixels)
+
+
+# functions reducing (N, 4) pixels to each statistic, as (RGB tuple or None, pixels counted, total pixels)
+REDUCERS = {
+    MEAN: stats_from_pixels,
+    DOMINANT: dominant_from_pixels,
+}
+
+
+def compute_mean(image: bpy.types.Image):
+    """Calculates the mean RGB of an image, excluding pixels below the alpha threshold.
+
+    :return: RGB mean as a tuple, or None if no pixels pass the threshold.
+    """
+    return mean_from_pixels(read_pixels(image))
+
+
+def store_key(image: bpy.types.Image, kind: str = MEAN) -> image_store.StoreKey:
+    """Returns the image's key in the persistent store for a statistic, or None if it should not be stored."""
+    if not config.IMAGE_STORE_ENABLED:
+        return None
+    return statistic_key(image_store.image_key(image), kind)
+
+
+def statistic_key(key: image_store.StoreKey, kind: str) -> image_store.StoreKey:
+    """Returns the store key of a statistic of the pixels a mean's store key identifies."""
+    if key is None or kind == MEAN:
+        return key
+    return image_store.variant_key(key, kind, config.DOMINANT_BINS)
+
+
+def tile_path(filepath: str, number: int) -> str:
+    """Returns the file path of one UDIM tile, from an image path containing a <UDIM> or <UVTILE> token."""
+    u, v = (number - 1001) % 10 + 1, (number - 1001) // 10 + 1
+    return filepath.replace('<UDIM>', str(number)).replace('<UVTILE>', 'u{}_v{}'.format(u, v))
+
+
+def load_tile_stats(image: bpy.types.Image, path: str, kind: str = MEAN) -> tuple:
+    """Reads one tile file as a temporary image, removed again before returning so only one tile is held.
+
+    :return: RGB of the statistic as a tuple (None if no pixels pass the threshold), pixels counted,
+        and total pixels.
+    """
+    tile = bpy.data.images.load(path, check_existing=False)
+    try:
+        tile.colorspace_settings.name = image.colorspace_settings.name
+        tile.alpha_mode = image.alpha_mode
+        return REDUCERS[kind](read_pixels(tile))
+    finally:
+        bpy.data.images.remove(tile)
+
+
+def _combine_dominant(tile_stats: list):
+    """Returns the dominant color of tiles from the dominant color of each, pooling tiles whose dominant colors
+    are within a block of histogram bins of each other. This approximates the dominant color over all tiles,
+    as a color that is common in every tile but dominant in none is missed.
+    """
+    width = 2.0 / config.DOMINANT_BINS
+    pooled = []  # color of the group's first tile, sum of colors and pixels
+    for color, count in sorted(tile_stats, key=lambda item: item[1], reverse=True):
+        for group in pooled:
+            if all(abs(a - b) <= width for a, b in zip(group[0], color)):
+                group[1] += np.multiply(color, count)
+                group[2] += count
+                break
+        else:
+            pooled.append([color, np.multiply(color, count), count])
+
+    if not pooled:
+        return None
+    _color, rgb_sum, count = max(pooled, key=lambda group: group[2])
+    return tuple(float(v) for v in rgb_sum / count)
+
+
+def load_tiled_stat(image: bpy.types.Image, kind: str = MEAN):
+    """Returns the statistic over every UDIM tile, reading one tile at a time.
+    The mean is weighted by the pixels counted in each tile.
+
+    Each tile's statistics are kept in the persistent store on their own,
+    so editing one tile of a texture set only reads that tile again.
+    Tiles whose file cannot be loaded are skipped.
+    """
+    filepath = bpy.path.abspath(image.filepath, library=image.library)
+    settings = image_store.image_settings(image)
+
+    tile_stats = []
+    for tile in image.tiles:
+        path = tile_path(filepath, tile.number)
+        key = statistic_key(image_store.file_key(path, settings), kind) if config.IMAGE_STORE_ENABLED else None
+
+        stats = None if key is None else image_store.STORE.get(key)
+        if stats is None:
+            try:
+                stats = load_tile_stats(image, path, kind)
+            except RuntimeError:  # missing or unreadable tile
+                continue
+            if key is not None:
+                image_store.STORE.put(key, *stats)
+
+        tile_color, tile_count, _total = stats
+        if tile_color is not None:
+            tile_stats.append((tile_color, tile_count))
+
+    if kind == DOMINANT:
+        return _combine_dominant(tile_stats)
+
+    count = sum(tile_count for _color, tile_count in tile_stats)
+    if count == 0:
+        return None
+    rgb_sum = sum(np.multiply(tile_color, tile_count) for tile_color, tile_count in tile_stats)
+    return tuple(float(v) for v in rgb_sum / count)
+
+
+def load_stat(image: bpy.types.Image, kind: str = MEAN):
+    """Returns a statistic from the persistent store, only decoding the image if it is not stored yet."""
+    # pixels of a tiled image only hold its first tile
+    if image.source == 'TILED' and image.packed_file is None:
+        return load_tiled_stat(image, kind)
+
+    key = store_key(image, kind)
+    if key is not None:
+        stats = image_store.STORE.get(key)
+        if stats is not None:
+            return stats[0]
+
+    color, counted, total = REDUCERS[kind](read_pixels(image))
+    if key is not None:
+        image_store.STORE.put(key, color, counted, total)
+    return color
+
+
+def load_mean(image: bpy.types.Image):
+    """Returns the mean from the persistent store, only decoding the image if it is not stored yet."""
+    return load_stat(image, MEAN)
+
+
+def load_dominant(image: bpy.types.Image):
+    """Returns the dominant color from the persistent store, only decoding the image if it is not stored yet."""
+    return load_stat(image, DOMINANT)
+
+
+_LOADERS = {
+    MEAN: load_mean,
+    DOMINANT: load_dominant,
+}
+
+
+def get_stat(image: bpy.types.Image, kind: str = None):
+    """Returns the alpha-filtered RGB statistic of an image, reusing the session cache and the persistent store.
+
+    :param kind: statistic, see STATISTICS, or None for the active one.
+    """
+    if kind is None:
+        kind = _statistic
+
+    if profiling.current() is None:
+        return CACHE.get(image, _LOADERS[kind], kind)
+
+    misses = CACHE.misses
+    color = CACHE.get(image, _LOADERS[kind], kind)
+    profiling.record_image_lookup(hit=CACHE.misses == misses)
+    return color
+
+
+def get_mean(image: bpy.types.Image):
+    """Returns the alpha-filtered RGB mean of an image, reusing the session cache and the persistent store."""
+    return get_stat(image, MEAN)
+
+
+def prefetch(images, workers: int = None, kind: str = None):
+    """Computes the statistics of images missing from the cache on a pool of worker threads.
+    Images already in the persistent store are loaded from it instead.
+
+    Pixels are read on the calling thread, as bpy must only be accessed from the main thread.
+    Workers only run the NumPy reduction, which releases the GIL for each chunk.
+    At most one image per worker is held in memory at a time.
+
+    :param images: images to compute, duplicates and cached images are skipped.
+    :param workers: number of worker threads, from the config by default.
+    :param kind: statistic, see STATISTICS, or None for the active one.
+    """
+    for _done, _total in prefetch_steps(images, workers, kind):
+        pass
+
+
+def prefetch_steps(images, workers: int = None, kind: str = None):
+    """Computes the statistics of images missing from the cache like prefetch(), one image at a time,
+    so the caller can spread them over time slices. Closing it waits for the images already being reduced.
+
+    :return: generator of the number of images read so far and the number of images missing from the cache,
+        yielded after each image is read. The statistics are all cached once it is exhausted.
+    """
+    if workers is None:
+        workers = config.IMAGE_WORKERS
+    if kind is None:
+        kind = _statistic
+
+    missing = {image.name_full: image for image in images if not CACHE.contains(image, kind)}
+    total = len(missing)
+    if workers <= 1 or total <= 1:
+        for done, image in enumerate(missing.values(), 1):
+            get_stat(image, kind)
+            yield done, total
+        return
+
+    # tiles are loaded as temporary images, which must happen on this thread too
+    done = 0
+    for name, image in list(missing.items()):
+        if image.source == 'TILED':
+            get_stat(missing.pop(name), kind)
+            done += 1
+            yield done, total
+
+    def store_done(done):
+        for future in done:
+            image, key = pending.pop(future)
+            color, counted, total = future.result()
+            CACHE.misses += 1
+            CACHE.store(image, color, kind)
+            if key is not None:
+                image_store.STORE.put(key, color, counted, total)
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        pending = {}
+        for image in missing.values():
+            key = store_key(image, kind)
+            stats = None if key is None else image_store.STORE.get(key)
+            done += 1
+            if stats is not None:
+                CACHE.misses += 1
+                CACHE.store(image, stats[0], kind)
+                yield done, total
+                continue
+
+            if len(pending) >= workers:
+                finished, _not_finished = wait(pending, return_when=FIRST_COMPLETED)
+                store_done(finished)
+
+            pixels = np.empty(len(image.pixels), dtype=np.float32)
+            image.pixels.foreach_get(pixels)
+            profiling.record_image_read(pixels.nbytes)
+            pending[pool.submit(REDUCERS[kind], pixels.reshape(-1, 4))] = image, key
+            yield done, total
+
+        store_done(list(pending))
+
+
+@bpy.app.handlers.persistent
+def clear_on_load(_dummy):
+    """Image names are only unique within a file, so drop everything when a new file is loaded."""
+    CACHE.invalidate()
+    release_buffer()
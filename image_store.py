@@ -0,0 +1,272 @@
+# Copyright (C) 2024 Spencer Magnusson
+# semagnum@gmail.com
+# Created by Spencer Magnusson
+#     This program is free software: you can redistribute it and/or modify
+#     it under the terms of the GNU General Public License as published by
+#     the Free Software Foundation, either version 3 of the License, or
+#     (at your option) any later version.
+#     This program is distributed in the hope that it will be useful,
+#     but WITHOUT ANY WARRANTY; without even the implied warranty of
+#     MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#     GNU General Public License for more details.
+#     You should have received a copy of the GNU General Public License
+#     along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Image statistics kept on disk between sessions, so reopened files do not decode their textures again."""
+
+import hashlib
+import os
+import sqlite3
+import time
+
+import bpy
+
+from . import config
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS image_stats (
+    key TEXT PRIMARY KEY,
+    path TEXT,
+    file_size INTEGER,
+    mtime_ns INTEGER,
+    r REAL,
+    g REAL,
+    b REAL,
+    counted INTEGER NOT NULL,
+    total INTEGER NOT NULL,
+    last_used REAL NOT NULL
+)
+"""
+
+
+class StoreKey:
+    """Identifies an image's pixels on disk, or in a packed file.
+
+    :param digest: hash of everything the statistics depend on.
+    :param path: absolute file path, or None for packed images.
+    :param file_size: file size in bytes when the statistics were stored.
+    :param mtime_ns: file modification time when the statistics were stored.
+    """
+
+    __slots__ = ('digest', 'path', 'file_size', 'mtime_ns')
+
+    def __init__(self, digest: str, path: str = None, file_size: int = None, mtime_ns: int = None):
+        self.digest = digest
+        self.path = path
+        self.file_size = file_size
+        self.mtime_ns = mtime_ns
+
+
+# hash of each packed image's data by image name, with the packed file and size it was computed from,
+# as hashing a large packed texture on every lookup costs about as much as reducing it
+_packed_digests = {}
+
+
+def _packed_digest(image: bpy.types.Image) -> str:
+    packed_file = image.packed_file
+    stamp = packed_file.as_pointer(), packed_file.size
+    entry = _packed_digests.get(image.name_full)
+    if entry is None or entry[0] != stamp:
+        entry = stamp, hashlib.blake2b(packed_file.data, digest_size=16).hexdigest()
+        _packed_digests[image.name_full] = entry
+    return entry[1]
+
+
+def forget_packed(image: bpy.types.Image = None):
+    """Drops the hash of a single image's packed data, or of every image's, so it is computed again."""
+    if image is None:
+        _packed_digests.clear()
+    else:
+        _packed_digests.pop(image.name_full, None)
+
+
+def image_key(image: bpy.types.Image) -> StoreKey:
+    """Returns the store key of an image, or None if its pixels may differ from what is saved.
+
+    Packed images are keyed by a hash of their packed data, computed once until the packed file changes
+    or image statistics are invalidated, other images by file path, size and modification time.
+    The color space, alpha mode and alpha threshold are part of the key, as the mean depends on them.
+    Images edited in this session, generated images and sequences are not stored.
+    Tiled images are not stored as a whole, but each of their tiles is, see file_key().
+    """
+    if image.is_dirty or image.source != 'FILE':
+        return None
+
+    if image.packed_file is not None:
+        return StoreKey(_digest(('PACKED', _packed_digest(image)) + image_settings(image)))
+
+    return file_key(bpy.path.abspath(image.filepath, library=image.library), image_settings(image))
+
+
+def image_settings(image: bpy.types.Image) -> tuple:
+    """Returns the image settings its statistics depend on, besides its pixels."""
+    return image.colorspace_settings.name, image.alpha_mode, config.ALPHA_THRESHOLD
+
+
+def file_key(path: str, settings: tuple) -> StoreKey:
+    """Returns the store key of an image file, such as one UDIM tile, or None if it cannot be read.
+
+    :param path: absolute file path.
+    :param settings: image settings, see image_settings().
+    """
+    path = os.path.normcase(os.path.abspath(path))
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+
+    return StoreKey(_digest(('FILE', path, stat.st_size, stat.st_mtime_ns) + settings),
+                    path, stat.st_size, stat.st_mtime_ns)
+
+
+def variant_key(key: StoreKey, *parts) -> StoreKey:
+    """Returns the key of other statistics of the same pixels, such as another way of reducing them,
+    which is verified against the same file.
+    """
+    return StoreKey(_digest((key.digest,) + parts), key.path, key.file_size, key.mtime_ns)
+
+
+def _digest(parts: tuple) -> str:
+    return hashlib.blake2b(repr(parts).encode(), digest_size=16).hexdigest()
+
+
+def default_path() -> str:
+    """Returns the store's path in the user's data directory for this add-on."""
+    try:
+        directory = bpy.utils.extension_path_user(__package__, create=True)
+    except (AttributeError, ValueError):  # Blender before 4.2, or installed as a legacy add-on
+        directory = bpy.utils.user_resource('DATAFILES', path='material_viewport_color', create=True)
+    return os.path.join(directory, 'image_stats.sqlite')
+
+
+class ImageStore:
+    """SQLite store of image statistics, shared by every Blender session and process.
+
+    The store is only an optimization: if it cannot be opened or written, lookups miss and writes are dropped.
+    """
+
+    def __init__(self, path: str = None):
+        self._path = path
+        self._connection = None
+        self._failed = False
+        self._writes = 0
+
+    @property
+    def path(self) -> str:
+        if self._path is None:
+            self._path = default_path()
+        return self._path
+
+    def _connect(self):
+        if self._connection is None and not self._failed:
+            try:
+                connection = sqlite3.connect(self.path, timeout=5.0, isolation_level=None)
+                connection.execute('PRAGMA journal_mode=WAL')
+                connection.execute('PRAGMA synchronous=NORMAL')
+                connection.execute(_SCHEMA)
+                self._connection = connection
+            except (OSError, sqlite3.Error) as e:
+                print('Image statistics store unavailable at {}: {}'.format(self._path, e))
+                self._failed = True
+        return self._connection
+
+    def close(self):
+        if self._connection is not None:
+            self._connection.close()
+        self._connection = None
+        self._failed = False
+
+    def get(self, key: StoreKey) -> tuple:
+        """Looks up stored statistics.
+
+        :return: None if not stored, otherwise the RGB mean (None if no pixels passed the alpha threshold),
+            pixels counted and total pixels.
+        """
+        connection = self._connect()
+        if connection is None:
+            return None
+
+        try:
+            row = connection.execute('SELECT r, g, b, counted, total FROM image_stats WHERE key = ?',
+                                     (key.digest,)).fetchone()
+            if row is None:
+                return None
+            connection.execute('UPDATE image_stats SET last_used = ? WHERE key = ?', (time.time(), key.digest))
+        except sqlite3.Error:
+            return None
+
+        r, g, b, counted, total = row
+        return None if r is None else (r, g, b), counted, total
+
+    def put(self, key: StoreKey, mean, counted: int, total: int):
+        """Stores an image's statistics, evicting the least recently used entries every so often."""
+        connection = self._connect()
+        if connection is None:
+            return
+
+        r, g, b = (None, None, None) if mean is None else mean
+        try:
+            connection.execute('INSERT OR REPLACE INTO image_stats VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                               (key.digest, key.path, key.file_size, key.mtime_ns, r, g, b, counted, total,
+                                time.time()))
+            self._writes += 1
+            if self._writes % 64 == 0:
+                self.evict()
+        except sqlite3.Error:
+            pass
+
+    def evict(self, max_entries: int = None) -> int:
+        """Drops the least recently used entries over the entry cap, returning how many were dropped."""
+        if max_entries is None:
+            max_entries = config.IMAGE_STORE_MAX_ENTRIES
+
+        connection = self._connect()
+        if connection is None:
+            return 0
+
+        cursor = connection.execute(
+            'DELETE FROM image_stats WHERE key IN '
+            '(SELECT key FROM image_stats ORDER BY last_used DESC LIMIT -1 OFFSET ?)', (max_entries,))
+        return cursor.rowcount
+
+    def verify(self) -> tuple:
+        """Drops entries whose file was deleted or changed since, and entries over the cap.
+
+        Entries of packed images are kept, as their key already changes with their content.
+
+        :return: number of entries checked and number dropped.
+        """
+        connection = self._connect()
+        if connection is None:
+            return 0, 0
+
+        rows = connection.execute('SELECT key, path, file_size, mtime_ns FROM image_stats WHERE path IS NOT NULL')
+        stale = []
+        checked = 0
+        for digest, path, file_size, mtime_ns in rows.fetchall():
+            checked += 1
+            try:
+                stat = os.stat(path)
+            except OSError:
+                stale.append((digest,))
+                continue
+            if stat.st_size != file_size or stat.st_mtime_ns != mtime_ns:
+                stale.append((digest,))
+
+        connection.executemany('DELETE FROM image_stats WHERE key = ?', stale)
+        removed = len(stale) + self.evict()
+        connection.execute('VACUUM')
+        return checked, removed
+
+    def purge(self) -> int:
+        """Drops every entry, returning how many there were."""
+        connection = self._connect()
+        if connection is None:
+            return 0
+
+        removed = connection.execute('DELETE FROM image_stats').rowcount
+        connection.execute('VACUUM')
+        return removed
+
+
+STORE = ImageStore()
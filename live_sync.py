@@ -0,0 +1,197 @@
+# Copyright (C) 2024 Spencer Magnusson
+# semagnum@gmail.com
+# Created by Spencer Magnusson
+#     This program is free software: you can redistribute it and/or modify
+#     it under the terms of the GNU General Public License as published by
+#     the Free Software Foundation, either version 3 of the License, or
+#     (at your option) any later version.
+#     This program is distributed in the hope that it will be useful,
+#     but WITHOUT ANY WARRANTY; without even the implied warranty of
+#     MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#     GNU General Public License for more details.
+#     You should have received a copy of the GNU General Public License
+#     along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import time
+from collections import defaultdict
+
+import bpy
+
+from . import config, image_sampling, image_stats, node_eval, operator, pixel_eval, results, tree_plan
+
+
+def tree_references(node_tree: bpy.types.NodeTree) -> set:
+    """Returns the node groups and images used directly by a node tree, as ('GROUP' or 'IMAGE', full name)."""
+    references = set()
+    for node in node_tree.nodes:
+        if getattr(node, 'node_tree', None) is not None:
+            references.add(('GROUP', node.node_tree.name_full))
+        if getattr(node, 'image', None) is not None:
+            references.add(('IMAGE', node.image.name_full))
+    return references
+
+
+class DependencyIndex:
+    """Which materials use which node groups and images, including through nested groups."""
+
+    def __init__(self):
+        self._group_references = {}
+        self._material_references = {}
+        self._users = defaultdict(set)
+
+    def _group_closure(self, group_name: str, closure: set):
+        if ('GROUP', group_name) in closure:
+            return
+        closure.add(('GROUP', group_name))
+
+        references = self._group_references.get(group_name)
+        if references is None:
+            # name_full includes the library of linked groups, which looking up a name does not match
+            group = next((group for group in bpy.data.node_groups if group.name_full == group_name), None)
+            references = tree_references(group) if group is not None else set()
+            self._group_references[group_name] = references
+
+        for reference in references:
+            if reference[0] == 'GROUP':
+                self._group_closure(reference[1], closure)
+            else:
+                closure.add(reference)
+
+    def update_material(self, material: bpy.types.Material):
+        """Re-indexes the groups and images a material uses."""
+        self.remove_material(material.name_full)
+
+        closure = set()
+        if material.use_nodes and material.node_tree is not None:
+            for reference in tree_references(material.node_tree):
+                if reference[0] == 'GROUP':
+                    self._group_closure(reference[1], closure)
+                else:
+                    closure.add(reference)
+
+        self._material_references[material.name_full] = closure
+        for reference in closure:
+            self._users[reference].add(material.name_full)
+
+    def remove_material(self, material_name: str):
+        for reference in self._material_references.pop(material_name, ()):
+            self._users[reference].discard(material_name)
+
+    def forget_group(self, group_name: str):
+        """Drops a group's cached references, so they are read again when materials using it are re-indexed."""
+        self._group_references.pop(group_name, None)
+
+    def users(self, reference: tuple) -> set:
+        """Returns the names of materials that use a node group or image."""
+        return set(self._users.get(reference, ()))
+
+    def __contains__(self, material_name: str):
+        return material_name in self._material_references
+
+
+_index = None
+_dirty_materials = set()
+_last_update = 0.0
+
+
+def _get_index() -> DependencyIndex:
+    global _index
+    if _index is None:
+        _index = DependencyIndex()
+        for material in bpy.data.materials:
+            _index.update_material(material)
+    return _index
+
+
+def _is_enabled() -> bool:
+    window_manager = bpy.context.window_manager
+    return window_manager is not None and window_manager.cfm_live_sync
+
+
+@bpy.app.handlers.persistent
+def on_depsgraph_update(_scene, depsgraph):
+    """Collects the materials affected by changed materials, node groups and images."""
+    global _last_update
+
+    if not _is_enabled():
+        return
+
+    index = _get_index()
+    changed = False
+    for update in depsgraph.updates:
+        data = update.id.original
+
+        if isinstance(data, bpy.types.Material):
+            index.update_material(data)
+            _dirty_materials.add(data.name_full)
+            changed = True
+        elif isinstance(data, bpy.types.NodeTree) and not data.is_embedded_data:  # a group, not a material's tree
+            tree_plan.invalidate(data)
+            index.forget_group(data.name_full)
+            users = index.users(('GROUP', data.name_full))
+            for material_name in users:
+                material = bpy.data.materials.get(material_name)
+                if material is not None:
+                    index.update_material(material)
+            _dirty_materials.update(users)
+            changed = changed or bool(users)
+        elif isinstance(data, bpy.types.Image):
+            image_stats.CACHE.invalidate(data)
+            image_sampling.CACHE.invalidate(data)
+            users = index.users(('IMAGE', data.name_full))
+            _dirty_materials.update(users)
+            changed = changed or bool(users)
+
+    if changed:
+        _last_update = time.monotonic()
+        if not bpy.app.timers.is_registered(flush):
+            bpy.app.timers.register(flush, first_interval=config.LIVE_SYNC_DELAY)
+
+
+def flush():
+    """Re-evaluates the dirty materials once edits have settled for the debounce delay."""
+    remaining = config.LIVE_SYNC_DELAY - (time.monotonic() - _last_update)
+    if remaining > 0:
+        return remaining
+
+    if not _is_enabled():
+        _dirty_materials.clear()
+        return None
+
+    window_manager = bpy.context.window_manager
+    materials = [bpy.data.materials.get(name) for name in _dirty_materials]
+    _dirty_materials.clear()
+
+    sampler = None
+    if window_manager.cfm_estimate:
+        sampler = image_sampling.Sampler(window_manager.cfm_estimate_tolerance, window_manager.cfm_estimate_seed)
+
+    table = results.ResultTable(operator.get_channels(window_manager.cfm_analyze_metallic,
+                                                      window_manager.cfm_analyze_roughness))
+    with pixel_eval.per_pixel(window_manager.cfm_per_pixel), image_stats.statistic(window_manager.cfm_statistic):
+        with image_sampling.sampling(sampler), node_eval.evaluation_run():
+            for material in materials:
+                if material is None or material.library is not None:
+                    continue
+
+                table.add(material, None, operator.evaluate_material(material, window_manager.cfm_analyze_metallic,
+                                                                     window_manager.cfm_analyze_roughness))
+
+    image_stats.release_buffer()
+
+    # only changes are written, so the update that the write itself causes settles on the next evaluation
+    table.commit()
+    results.record(table)
+    return None
+
+
+def reset():
+    """Forgets the dependency index and pending work, such as when another file is loaded."""
+    global _index
+    _index = None
+    _dirty_materials.clear()
+
+
+@bpy.app.handlers.persistent
+def reset_on_load(_dummy):
+    reset()
@@ -12,10 +12,13 @@
 #     You should have received a copy of the GNU General Public License
 #     along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+from contextlib import contextmanager
+from itertools import count
+
 import bpy
 from mathutils import Vector
 
-from . import util
+from . import config, image_stats, pixel_eval, profiling, tree_plan, util
 
 
 def assert_float(val) -> float:
@@ -36,71 +39,358 @@ def assert_color(val) -> Vector:
         return val
 
 
-def get_from_socket(curr_socket, node_key: dict, default_val):
-    """Get value from node socket - either evaluating the default value or following the link.
+def is_group_input(val) -> bool:
+    return isinstance(val, util.GroupInputRef)
 
-    :param curr_socket: node socket object.
-    :param node_key: config key of node ids and which sockets to retrieve the float value.
-    :param default_val: default float value if no nodes match.
-    :return: value from socket
+
+def first_group_input(*vals):
+    """Returns the first group input reference among the values, if any."""
+    return next((val for val in vals if is_group_input(val)), None)
+
+
+def with_default(channels: dict, default_val) -> dict:
+    """Returns the same channels, all sharing a different default value."""
+    return {name: (node_key, default_val) for name, (node_key, _default_val) in channels.items()}
+
+
+def defaults(channels: dict) -> dict:
+    """Returns the default value of each channel."""
+    return {name: default_val for name, (_node_key, default_val) in channels.items()}
+
+
+class EvaluationMemo:
+    """Channel values of already evaluated node outputs, shared by every material in one run.
+
+    Entries are keyed by the linked output socket, the channel's config key and default value.
+    Group input context is not part of the key: a traversal inside a group returns a group input reference
+    instead of the outer value, and the reference is only resolved by the group node that entered the group.
+    So a subgraph inside a shared node group is evaluated once, whichever material or group node reaches it.
     """
-    if curr_socket.is_linked and not curr_socket.is_output:
-        next_node = curr_socket.links[0].from_node
 
-        if next_node.bl_idname == 'NodeGroupInput':
-            socket_index = util.get_socket_index(curr_socket.links[0].from_socket)
-            raise util.GroupInputException(input_socket_index=socket_index)
+    _run_ids = count()
 
-        # if a group node, use the right socket index
-        if hasattr(next_node, 'node_tree'):
-            output = next(util.find_outputs(next_node.node_tree), None)
-            socket_index = util.get_socket_index(curr_socket.links[0].from_socket)
+    def __init__(self):
+        self.run_id = next(self._run_ids)
+        image_stats.next_edit_epoch()
+        self.hits = 0
+        self.misses = 0
+        self._values = {}
 
-            try:
-                return get_from_socket(output.inputs[socket_index], node_key, default_val)
-            except util.GroupInputException as gie:
-                input_node_socket_index = gie.input_socket_index
-                return get_from_socket(next_node.inputs[input_node_socket_index], node_key, default_val)
+    @staticmethod
+    def _channel_key(channel) -> tuple:
+        node_key, default_val = channel
+        try:
+            default_val = tuple(default_val)
+        except TypeError:
+            pass
+        return id(node_key), default_val
 
-        return get_from_node(curr_socket.links[0].from_node, node_key, default_val)
-    elif hasattr(curr_socket, 'default_value'):
-        return curr_socket.default_value
+    def lookup(self, socket_key, channels: dict) -> tuple:
+        """Splits channels into cached values and the channels left to evaluate."""
+        cached = {}
+        missing = {}
+        for name, channel in channels.items():
+            key = (socket_key, self._channel_key(channel))
+            if key in self._values:
+                cached[name] = self._values[key]
+            else:
+                missing[name] = channel
 
-    return default_val
+        self.hits += len(cached)
+        self.misses += len(missing)
+        return cached, missing
 
+    def store(self, socket_key, channels: dict, results: dict):
+        for name, channel in channels.items():
+            self._values[(socket_key, self._channel_key(channel))] = results[name]
 
-def get_from_node(curr_node: bpy.types.Node, node_key: dict, default_val) -> float:
-    """Find first float value found within node tree.
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            'entries': len(self._values),
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / total if total else 0.0,
+        }
 
-    :param curr_node: current node in recursive traversal.
-    :param node_key: config key of node ids and which sockets to retrieve the float value.
-    :param default_val: default float value if no nodes match.
+
+_memo = None
+
+
+@contextmanager
+def evaluation_run(memo: EvaluationMemo = None):
+    """Shares one evaluation memo across every evaluation inside the block.
+
+    Node trees must not change inside the block, as cached values are never invalidated.
+
+    :param memo: memo to continue with, such as across the time slices of one batch. A new memo by default.
+    """
+    global _memo
+    outer_memo = _memo
+    if memo is None:
+        memo = EvaluationMemo() if outer_memo is None else outer_memo
+    _memo = memo
+    try:
+        yield _memo
+    finally:
+        _memo = outer_memo
+
+
+def get_tree_plan(node_tree: bpy.types.NodeTree) -> tree_plan.TreePlan:
+    """Returns the evaluation plan of a node tree, checked against the tree at most once per run."""
+    return tree_plan.get_plan(node_tree, None if _memo is None else _memo.run_id)
+
+
+# evaluation request kinds
+_SOCKET = 0
+_NODE = 1
+
+
+def socket_request(curr_socket, channels: dict) -> tuple:
+    """Request for the evaluator to get channels from a socket.
+    Handlers yield it and are sent back the value of each channel.
+    """
+    return _SOCKET, curr_socket, channels
+
+
+def _finish(memo: EvaluationMemo, memo_key, cached: dict, channels: dict, value: dict) -> dict:
+    """Memoizes the values of a socket request, and merges them with the values that were already memoized."""
+    if memo_key is None:
+        return value
+
+    memo.store(memo_key, channels, value)
+    cached.update(value)
+    return cached
+
+
+def _open(request: tuple, plan: tree_plan.TreePlan, memo: EvaluationMemo) -> tuple:
+    """Answers a request directly if possible, otherwise creates the stack frame that will evaluate it.
+
+    :return: channel values and None, or None and a frame of
+        (generator, tree plan, node plan, memo key, memoized values, channels left to evaluate).
+    """
+    kind, arg, channels = request[:3]
+    if len(request) > 3:  # entering another tree
+        plan = request[3]
+
+    if kind == _NODE:
+        if arg is None:
+            return defaults(channels), None
+        if pixel_eval.active() and arg.bl_idname in pixel_eval.CHAIN_NODES:  # such as the active node
+            value = pixel_eval.chain_value(plan, arg, 0)
+            if value is not None:
+                return {name: value for name in channels}, None
+        return None, (_eval_node(arg, channels), plan, arg, None, None, channels)
+
+    link = plan.links.get(arg.as_pointer())
+    if link is None:
+        if hasattr(arg, 'default_value'):
+            return {name: arg.default_value for name in channels}, None
+        return defaults(channels), None
+
+    memo_key = None
+    cached = None
+    if memo is not None:
+        memo_key = link.from_socket_key
+        cached, channels = memo.lookup(memo_key, channels)
+        if not channels:
+            return cached, None
+
+    node_plan = link.from_node
+    if node_plan.bl_idname == 'NodeGroupInput':
+        group_input = util.GroupInputRef(link.from_socket_index)
+        return _finish(memo, memo_key, cached, channels, {name: group_input for name in channels}), None
+
+    if pixel_eval.active() and node_plan.bl_idname in pixel_eval.CHAIN_NODES:
+        value = pixel_eval.chain_value(plan, node_plan, link.from_socket_index)
+        if value is not None:
+            return _finish(memo, memo_key, cached, channels, {name: value for name in channels}), None
+
+    if node_plan.is_group:
+        generator = _eval_group_output(node_plan, link.from_socket_index, channels)
+    else:
+        generator = _eval_node(node_plan, channels)
+
+    return None, (generator, plan, node_plan, memo_key, cached, channels)
+
+
+def _run(request: tuple, plan: tree_plan.TreePlan) -> dict:
+    """Runs an evaluation request with an explicit stack instead of recursion.
+
+    Requests are (kind, socket or node plan, channels), with a tree plan appended when entering another tree.
+    Socket requests are answered directly if the socket is unlinked or memoized.
+    Otherwise, the node the link comes from is pushed as a generator,
+    which yields more requests and is sent back the channel values of each.
+    A node already on the stack (a cycle), or a stack at the configured maximum depth,
+    gets the channel default values instead.
     """
+    memo = _memo
+    profile = profiling.current()
+    stack = []
+    visiting = set()
+
+    value, frame = _open(request, plan, memo)
+    while True:
+        if frame is not None:
+            _generator, _plan, node_plan, _memo_key, cached, channels = frame
+            if len(stack) >= config.MAX_EVAL_DEPTH or node_plan in visiting:
+                value = dict(cached or {})
+                value.update(defaults(channels))
+            else:
+                stack.append(frame)
+                visiting.add(node_plan)
+                if profile is not None:
+                    profile.visit(node_plan)
+                value = None
+
+        if not stack:
+            return value
+
+        top = stack[-1]
+        try:
+            request = top[0].send(value)
+        except StopIteration as done:
+            stack.pop()
+            _generator, _plan, node_plan, memo_key, cached, channels = top
+            visiting.discard(node_plan)
+            value = _finish(memo, memo_key, cached, channels, done.value)
+            frame = None
+            continue
+
+        value, frame = _open(request, top[1], memo)
+
+
+def _resolve_group_inputs(group_node: tree_plan.NodePlan, results: dict, channels: dict):
+    """Continues the channels that ran into a group input node from the group node's own inputs.
+
+    :param group_node: plan of the group node whose node tree was evaluated.
+    :param results: channel values from inside the group, updated in place.
+    :param channels: channels that were evaluated.
+    """
+    by_index = {}
+    for name, val in results.items():
+        if is_group_input(val):
+            by_index.setdefault(val.input_socket_index, {})[name] = channels[name]
+
+    for input_socket_index, subset in by_index.items():
+        results.update((yield socket_request(group_node.inputs[input_socket_index], subset)))
+
+    return results
+
+
+def _eval_group_output(group_node: tree_plan.NodePlan, socket_index: int, channels: dict):
+    """Evaluates channels from a group node's output, by entering its node tree."""
+    group_plan = get_tree_plan(group_node.node.node_tree)
+    if group_plan.output is None:
+        return defaults(channels)
+
+    results = yield _SOCKET, group_plan.output.inputs[socket_index], channels, group_plan
+    return (yield from _resolve_group_inputs(group_node, results, channels))
+
+
+def _eval_node(node_plan: tree_plan.NodePlan, channels: dict):
+    """Find first value of each channel within node tree.
+    Channels whose config keys resolve to the same socket or handler are evaluated together.
+    """
+    curr_node = node_plan.node
+    results = {}
+    remaining = channels
 
     # enter group nodes
-    if hasattr(curr_node, 'node_tree'):
-        output = next(util.find_outputs(curr_node.node_tree), None)
-        group_val = get_from_node(output, node_key, default_val)
+    if node_plan.is_group:
+        group_plan = get_tree_plan(curr_node.node_tree)
+        group_vals = yield _NODE, group_plan.output, channels, group_plan
+        group_vals = yield from _resolve_group_inputs(node_plan, group_vals, channels)
 
         # if the default value, try the first group inputs
-        if group_val == default_val:
-            socket = curr_node.inputs[0]
-            return get_from_socket(socket, node_key, default_val)
-
-    result = next((p for p in node_key.keys() if p == curr_node.bl_idname), None)
-    if result is not None:
-        if callable(node_key[result]):
-            return node_key[result](curr_node, node_key, default_val)
-        elif isinstance(node_key[result], float):
-            return node_key[result]
+        defaulted = {name: channels[name]
+                     for name, val in group_vals.items()
+                     if val == channels[name][1]}
+        if defaulted:
+            results.update((yield socket_request(node_plan.inputs[0], defaulted)))
+            remaining = {name: channel for name, channel in channels.items() if name not in defaulted}
+
+    by_socket = {}
+    by_handler = {}
+    unmatched = {}
+    for name, (node_key, default_val) in remaining.items():
+        entry = node_key.get(node_plan.bl_idname)
+        if entry is None:
+            unmatched[name] = (node_key, default_val)
+        elif callable(entry):
+            by_handler.setdefault(entry, {})[name] = (node_key, default_val)
+        elif isinstance(entry, float):
+            results[name] = entry
         else:
-            direction, albedo_idx = node_key[result]
-            curr_socket = getattr(curr_node, direction)[albedo_idx]
+            by_socket.setdefault(entry, {})[name] = (node_key, default_val)
 
-            return get_from_socket(curr_socket, node_key, default_val)
+    for handler, subset in by_handler.items():
+        handler_vals = handler(curr_node, subset)
+        if not isinstance(handler_vals, dict):
+            handler_vals = yield from handler_vals
+        results.update(handler_vals)
+
+    for (direction, idx), subset in by_socket.items():
+        curr_socket = getattr(node_plan, direction)[idx]
+        results.update((yield socket_request(curr_socket, subset)))
+
+    if unmatched:
+        if len(node_plan.inputs) == 1:
+            results.update((yield socket_request(node_plan.inputs[0], unmatched)))
+        else:
+            results.update(defaults(unmatched))
 
-    if len(curr_node.inputs) == 1:
-        curr_socket = curr_node.inputs[0]
-        return get_from_socket(curr_socket, node_key, default_val)
+    return results
+
+
+def get_channels_from_socket(curr_socket, channels: dict) -> dict:
+    """Get several values from node socket in one traversal - either evaluating the default value or following the link.
+
+    Channels share the traversal for as long as they resolve to the same sockets.
+
+    :param curr_socket: node socket object.
+    :param channels: channel names mapped to their config key and default value.
+    :return: value of each channel, or a group input reference if it ran into a group input node.
+    """
+    return _run(socket_request(curr_socket, channels), get_tree_plan(curr_socket.id_data))
 
-    return default_val
+
+def get_channels_from_node(curr_node: bpy.types.Node, channels: dict) -> dict:
+    """Find first value of each channel within node tree, in one traversal.
+
+    Channels whose config keys resolve to the same socket or handler are evaluated together.
+
+    :param curr_node: node to start the traversal from.
+    :param channels: channel names mapped to their config key and default value.
+    :return: value of each channel, or a group input reference if it ran into a group input node.
+    """
+    plan = get_tree_plan(curr_node.id_data)
+    return _run((_NODE, plan.node(curr_node), channels), plan)
+
+
+def _single_channel(results: dict):
+    val = results[None]
+    if is_group_input(val):
+        raise util.GroupInputException(input_socket_index=val.input_socket_index)
+    return val
+
+
+def get_from_socket(curr_socket, node_key: dict, default_val):
+    """Get value from node socket - either evaluating the default value or following the link.
+
+    :param curr_socket: node socket object.
+    :param node_key: config key of node ids and which sockets to retrieve the float value.
+    :param default_val: default float value if no nodes match.
+    :return: value from socket
+    """
+    return _single_channel(get_channels_from_socket(curr_socket, {None: (node_key, default_val)}))
+
+
+def get_from_node(curr_node: bpy.types.Node, node_key: dict, default_val) -> float:
+    """Find first float value found within node tree.
+
+    :param curr_node: current node in recursive traversal.
+    :param node_key: config key of node ids and which sockets to retrieve the float value.
+    :param default_val: default float value if no nodes match.
+    """
+    return _single_channel(get_channels_from_node(curr_node, {None: (node_key, default_val)}))
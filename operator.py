@@ -12,26 +12,297 @@
 #     You should have received a copy of the GNU General Public License
 #     along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import sqlite3
+import time
+from contextlib import contextmanager, nullcontext
+
 import bpy
 from mathutils import Vector
 
-from . import config, node_eval as node, util
-
+from . import (config, fingerprint, image_sampling, image_stats, image_store, node_eval as node, pixel_eval, profiling,
+               results, snapshot, util, vector_eval)
+
+
+def active_material(context):
+    """Returns the active object's active material, or None."""
+    obj = context.active_object
+    return None if obj is None else obj.active_material
 
-def set_material(material, metallic: bool, roughness: bool):
-    if material.use_nodes:
-        node_tree = material.node_tree
-        output = next(util.find_outputs(node_tree), None)
 
-        if output is not None:
-            material.diffuse_color = node.assert_color(node.get_from_node(output, config.ALBEDO_MAP,
-                                                                          Vector((0.8, 0.8, 0.8, 1.0))
-                                                                          ))
-            if roughness:
-                material.roughness = node.assert_float(node.get_from_node(output, config.ROUGHNESS_MAP, 0.5))
+def selected_node(node_tree: bpy.types.NodeTree):
+    """Returns the only selected node of a node tree, or None if none or several are selected.
+    Stops at the second selected node, so polls on every redraw do not list every selected node of large trees.
+    """
+    found = None
+    for curr_node in node_tree.nodes:
+        if curr_node.select:
+            if found is not None:
+                return None
+            found = curr_node
+    return found
 
-            if metallic:
-                material.metallic = node.assert_float(node.get_from_node(output, config.METALLIC_MAP, 0.0))
+
+def get_channels(metallic: bool, roughness: bool) -> dict:
+    """Returns the material properties to evaluate, mapped to their config key and default value."""
+    channels = {'diffuse_color': (config.ALBEDO_MAP, Vector((0.8, 0.8, 0.8, 1.0)))}
+    if roughness:
+        channels['roughness'] = (config.ROUGHNESS_MAP, 0.5)
+    if metallic:
+        channels['metallic'] = (config.METALLIC_MAP, 0.0)
+    return channels
+
+
+def evaluate_channels(start_node, channels: dict) -> dict:
+    """Evaluates all channels from a node in one traversal, as values ready to set on the material."""
+    return channel_values(node.get_channels_from_node(start_node, channels), channels)
+
+
+def channel_values(results: dict, channels: dict) -> dict:
+    """Converts evaluated channels to values ready to set on the material,
+    with channels that ran into a group input at their default value.
+    """
+    values = {}
+    for name, val in results.items():
+        if node.is_group_input(val):
+            val = channels[name][1]
+
+        if name == 'diffuse_color':
+            values[name] = node.assert_color(val)
+        else:
+            values[name] = node.assert_float(val)
+
+    return values
+
+
+def evaluate_material(material, metallic: bool, roughness: bool) -> dict:
+    """Returns the viewport display values of a material, or nothing if it has no output node to evaluate."""
+    with profiling.material(material.name_full):
+        if material.use_nodes:
+            output = node.get_tree_plan(material.node_tree).output
+
+            if output is not None:
+                return evaluate_channels(output.node, get_channels(metallic, roughness))
+
+    return {}
+
+
+def set_material(material, metallic: bool, roughness: bool, force: bool = True) -> bool:
+    """Sets a material and stores its fingerprint, see MaterialRun.
+
+    :param force: evaluates the material even if it has not changed since it was last set.
+    :return: whether the material was evaluated.
+    """
+    run = MaterialRun(get_channels(metallic, roughness), vectorized=False, force=force)
+    run.set((material,))
+    run.commit()
+    return run.skipped == 0
+
+
+def verify_snapshots(materials, channels: dict, workers: int = None) -> tuple:
+    """Evaluates materials from snapshots in worker processes, and live, to check that both agree.
+
+    :param channels: channel names mapped to their config key and default value, see get_channels.
+    :param workers: number of worker processes, config.SNAPSHOT_WORKERS by default.
+    :return: number of materials snapshotted, and (material, channel name, live value, snapshot value)
+        for each value that differs, the snapshot value being None if a worker could not evaluate it.
+    """
+    snapshotter = snapshot.Snapshotter(channels)
+    captured = [(material, snapshotter.capture(material)) for material in materials]
+    captured = [(material, snapshot_val) for material, snapshot_val in captured if snapshot_val is not None]
+
+    pool = snapshot.SnapshotPool(workers)
+    try:
+        snapshot_values = pool.evaluate([snapshot_val for _material, snapshot_val in captured])
+    finally:
+        pool.close()
+
+    mismatches = []
+    for (material, _snapshot_val), values in zip(captured, snapshot_values):
+        live_values = evaluate_channels(node.get_tree_plan(material.node_tree).output.node, channels)
+        if values is not None:
+            values = channel_values(values, channels)
+        for name, val in live_values.items():
+            if values is None or results.differs(val, values[name]):
+                mismatches.append((material, name, val, None if values is None else values[name]))
+
+    return len(captured), mismatches
+
+
+class MaterialRun:
+    """Sets many materials, evaluating each distinct node setup once and fanning its values out to the
+    materials sharing its fingerprint. Materials are added in parts, such as the time slices of a batch,
+    each flushed before the next; node trees must not change until the run is over.
+
+    Values are collected in a result table and only set on the materials by commit(), once every part
+    is evaluated. Each material set keeps its fingerprint, so a later run skips it if it has not changed since.
+
+    :param channels: channel names mapped to their config key and default value, see get_channels.
+    :param vectorized: evaluates the distinct materials of each part together, see vector_eval.
+    :param deduplicate: evaluates materials with the same fingerprint once.
+    :param force: evaluates materials even if they have not changed since they were last set.
+    :param workers: evaluates the distinct materials of each part from snapshots in this many worker processes,
+        see snapshot.py, or in this process if 0. Materials snapshots cannot hold are evaluated here.
+    """
+
+    def __init__(self, channels: dict, vectorized: bool = True, deduplicate: bool = True, force: bool = True,
+                 workers: int = 0):
+        self.channels = channels
+        self.vectorized = vectorized
+        self.workers = workers
+        self.deduplicate = deduplicate
+        self.force = force
+        sampler = image_sampling.active()
+        self.fingerprinter = fingerprint.Fingerprinter(
+            channels, pixel_eval.active(), None if sampler is None else (sampler.tolerance, sampler.seed),
+            image_stats.active_statistic())
+        self.materials = 0
+        self.skipped = 0
+        self.evaluated = 0
+        self.batched = 0
+        self.in_workers = 0
+        self.changed = None
+        self.dry_run = False
+        self.table = results.ResultTable(channels)
+        self._fingerprints = {}
+        self._values = {}
+        self._batch = None
+        self._batch_keys = []
+        self._snapshotter = snapshot.Snapshotter(channels) if workers else None
+        self._snapshots = []
+        self._pool = None
+        self._copies = {}  # materials waiting on a fingerprint evaluated in the batch or by the workers
+
+    @property
+    def recomputed(self) -> int:
+        """Materials set, as opposed to skipped as up to date."""
+        return self.materials - self.skipped
+
+    @property
+    def dedup_ratio(self) -> float:
+        """Share of materials set from another material's values instead of being evaluated."""
+        return 1.0 - self.evaluated / self.recomputed if self.recomputed else 0.0
+
+    def material_fingerprint(self, material) -> str:
+        """Returns a material's fingerprint, computed once per run."""
+        pointer = material.as_pointer()
+        if pointer not in self._fingerprints:
+            self._fingerprints[pointer] = self.fingerprinter.material(material)
+        return self._fingerprints[pointer]
+
+    def is_up_to_date(self, material, key: str) -> bool:
+        """Returns whether a material can be skipped: not forced, set from the same fingerprint last time,
+        and still holding the values it was set to, so hand edits to its viewport display are overwritten.
+        """
+        return key is not None and not self.force and fingerprint.is_up_to_date(material, key, self.channels)
+
+    def out_of_date(self, materials) -> list:
+        """Returns the materials the run will set instead of skipping, such as to read only their images ahead."""
+        return [material for material in materials
+                if not self.is_up_to_date(material, self.material_fingerprint(material))]
+
+    def add(self, material):
+        """Sets a material, or adds it to the part's batch or snapshots, set on flush().
+        Skips it if it is up to date.
+        """
+        self.materials += 1
+        key = self.material_fingerprint(material)
+        if self.is_up_to_date(material, key):
+            self.skipped += 1
+            return
+        if self.deduplicate and key in self._values:
+            self.table.add(material, key, self._values[key])
+            return
+        if self.deduplicate and key in self._copies:
+            self._copies[key].append(material)
+            return
+
+        self.evaluated += 1
+        if self._snapshotter is not None:
+            captured = self._snapshotter.capture(material)
+            if captured is not None:
+                self._snapshots.append((material, key, captured))
+                if key is not None:
+                    self._copies[key] = []
+                return
+
+        if self.vectorized:
+            if self._batch is None:
+                self._batch = vector_eval.MaterialBatch(self.channels)
+            if self._batch.add(material):
+                self._batch_keys.append(key)
+                if key is not None:
+                    self._copies[key] = []
+                return
+
+        values = evaluate_material(material, 'metallic' in self.channels, 'roughness' in self.channels)
+        self.table.add(material, key, values)
+        if key is not None:
+            self._values[key] = values
+
+    def flush(self):
+        """Evaluates the part's batch and snapshots, adding their materials and their copies to the table."""
+        if self._batch is None and not self._snapshots:
+            return
+
+        copies, self._copies = self._copies, {}
+        evaluated = []
+        if self._batch is not None:
+            batch, keys = self._batch, self._batch_keys
+            self._batch, self._batch_keys = None, []
+            self.batched += len(batch)
+            evaluated.extend(zip(batch.materials, keys, batch.evaluate()))
+
+        if self._snapshots:
+            snapshots, self._snapshots = self._snapshots, []
+            if self._pool is None:
+                self._pool = snapshot.SnapshotPool(self.workers)
+            snapshot_values = self._pool.evaluate([captured for _material, _key, captured in snapshots])
+            for (material, key, _captured), values in zip(snapshots, snapshot_values):
+                if values is None:  # a worker could not evaluate it
+                    values = evaluate_material(material, 'metallic' in self.channels, 'roughness' in self.channels)
+                else:
+                    self.in_workers += 1
+                    values = channel_values(values, self.channels)
+                evaluated.append((material, key, values))
+
+        for material, key, values in evaluated:
+            self.table.add(material, key, values)
+            if key is not None:
+                self._values[key] = values
+                for copy in copies[key]:
+                    self.table.add(copy, key, values)
+
+    def set(self, materials):
+        """Evaluates materials as one part, set by commit()."""
+        for material in materials:
+            self.add(material)
+        self.flush()
+
+    def commit(self, dry_run: bool = False):
+        """Sets the evaluated values that changed and keeps the fingerprints they were evaluated from.
+        A dry run only counts the materials that would change, and returns them as text.
+        """
+        self.flush()
+        if self._pool is not None:
+            self._pool.close()
+            self._pool = None
+        self.dry_run = dry_run
+        if dry_run:
+            changes = self.table.changes()
+            self.changed = sum(1 for names in changes if names)
+            return self.table.format(changes)
+
+        self.changed = self.table.commit()
+        return None
+
+    def summary(self, memo: node.EvaluationMemo) -> str:
+        summary = ('{} {}, {} up to date, {} recomputed, {} distinct, {:.0%} deduplicated, {} evaluated together, '
+                   '{:.0%} of node evaluations reused').format(
+            self.changed, 'would change' if self.dry_run else 'changed', self.skipped, self.recomputed, self.evaluated,
+            self.dedup_ratio, self.batched, memo.stats()['hit_rate'])
+        if self.workers:
+            summary += ', {} in worker processes'.format(self.in_workers)
+        return summary
 
 
 class CFMOperator(bpy.types.Operator):
@@ -49,22 +320,284 @@ class CFMOperator(bpy.types.Operator):
         default=True,
     )
 
+    profile: bpy.props.BoolProperty(
+        name='Profile',
+        description='Records where evaluation time goes for each material, listed in the panel afterwards',
+        default=False,
+    )
+
+    per_pixel: bpy.props.BoolProperty(
+        name='Per-Pixel Textures',
+        description='Runs color ramp, hue/saturation, invert, gamma and mix nodes fed by textures on every pixel '
+                    'before averaging, instead of on the texture\'s average color. Slower, but more accurate',
+        default=False,
+    )
+
+    statistic: bpy.props.EnumProperty(
+        name='Texture Color',
+        description='What each texture is reduced to',
+        items=image_stats.STATISTICS,
+        default=image_stats.MEAN,
+    )
+
+    estimate: bpy.props.BoolProperty(
+        name='Fast Estimate',
+        description='Estimates each texture\'s average color from a random sample of its pixels, '
+                    'within the tolerance. Much faster on large textures',
+        default=False,
+    )
+
+    tolerance: bpy.props.FloatProperty(
+        name='Tolerance',
+        description='Largest error allowed in each color channel of an estimate, at 95% confidence',
+        default=0.005,
+        min=0.0001,
+        max=0.1,
+        precision=4,
+    )
+
+    seed: bpy.props.IntProperty(
+        name='Seed',
+        description='Seed of the random sample, so the same pixels are sampled each run',
+        default=0,
+        min=0,
+    )
+
+    force: bpy.props.BoolProperty(
+        name='Force',
+        description='Sets every material, including those that have not changed since they were last set. '
+                    'Without it, materials whose viewport display was edited by hand are still set again',
+        default=False,
+    )
+
+    dry_run: bpy.props.BoolProperty(
+        name='Dry Run',
+        description='Evaluates materials without setting them, and prints the values that would change '
+                    'to the system console',
+        default=False,
+    )
+
+    parallel: bpy.props.BoolProperty(
+        name='Worker Processes',
+        description='Evaluates materials in worker processes on several cores, from snapshots of their node trees. '
+                    'Faster on many materials with large node trees',
+        default=False,
+    )
 
-class SelectedObjectsOperator(CFMOperator):
+    def profile_run(self, profiler: profiling.Profiler = None):
+        """Profiling session if profiling was requested, otherwise a block that does nothing."""
+        if self.profile:
+            return profiling.session(profiler)
+        return nullcontext()
+
+    def report_profile(self):
+        if self.profile:
+            self.report({'INFO'}, 'Profile: ' + profiling.latest().summary())
+
+    @contextmanager
+    def texture_mode(self, sampler: image_sampling.Sampler = None):
+        """Evaluates textures per pixel, reduces them to the statistic and estimates them with the sampler,
+        as requested, inside the block. Frees the pixel buffer afterwards, so it does not keep the largest
+        texture read for the rest of the session.
+        """
+        try:
+            with pixel_eval.per_pixel(self.per_pixel), image_stats.statistic(self.statistic):
+                with image_sampling.sampling(sampler):
+                    yield
+        finally:
+            image_stats.release_buffer()
+
+    def new_sampler(self) -> image_sampling.Sampler:
+        """Sampler estimating texture means if requested, otherwise None so they are exact."""
+        if self.estimate:
+            return image_sampling.Sampler(self.tolerance, self.seed)
+        return None
+
+    def prefetch(self, materials, sampler: image_sampling.Sampler):
+        """Computes texture statistics ahead of the run, unless they are means going to be estimated."""
+        for _done, _total in self.prefetch_steps(materials, sampler):
+            pass
+
+    def prefetch_steps(self, materials, sampler: image_sampling.Sampler):
+        """Computes texture statistics like prefetch(), one image per step, see image_stats.prefetch_steps."""
+        if sampler is None or self.statistic != image_stats.MEAN:
+            yield from image_stats.prefetch_steps(util.find_images(materials), kind=self.statistic)
+
+    def report_estimates(self, sampler: image_sampling.Sampler):
+        if sampler is not None:
+            self.report({'INFO'}, 'Estimate: ' + sampler.summary())
+
+    def commit(self, run: MaterialRun, memo: node.EvaluationMemo, start: tuple):
+        """Sets the run's materials, or prints what would change on a dry run, and keeps a summary for the panel.
+
+        :param start: result of run_start() before the run.
+        """
+        changes = run.commit(self.dry_run)
+        if changes:
+            print(changes)
+
+        start_time, image_hits, image_misses = start
+        image_hits = max(image_stats.CACHE.hits - image_hits, 0)
+        image_misses = max(image_stats.CACHE.misses - image_misses, 0)
+        results.record(run.table, {
+            'operator': self.bl_label,
+            'materials': run.materials,
+            'changed': run.changed,
+            'skipped': run.skipped,
+            'seconds': time.perf_counter() - start_time,
+            'node_hit_rate': memo.stats()['hit_rate'],
+            'image_hit_rate': image_hits / (image_hits + image_misses) if image_hits + image_misses else 0.0,
+            'dry_run': self.dry_run,
+        })
+
+    @staticmethod
+    def run_start() -> tuple:
+        """Time and image cache lookups at the start of a run, to measure it by."""
+        return time.perf_counter(), image_stats.CACHE.hits, image_stats.CACHE.misses
+
+    def new_run(self) -> MaterialRun:
+        """Run setting materials, evaluating them node by node when profiling so each one is timed."""
+        return MaterialRun(get_channels(self.analyze_metallic, self.analyze_roughness),
+                           vectorized=config.VECTORIZED_EVALUATION and not self.profile,
+                           deduplicate=config.DEDUPLICATE_MATERIALS, force=self.force,
+                           workers=config.SNAPSHOT_WORKERS if self.parallel and not self.profile else 0)
+
+    def set_materials(self, materials):
+        """Sets every material, sharing evaluated subgraphs between them, and reports how much was shared."""
+        sampler = self.new_sampler()
+        start = self.run_start()
+        with self.profile_run(), self.texture_mode(sampler):
+            with node.evaluation_run() as memo:
+                run = self.new_run()
+                self.prefetch(run.out_of_date(materials), sampler)
+                run.set(materials)
+        self.commit(run, memo, start)
+
+        self.report({'INFO'}, '{} {} materials ({})'.format('Evaluated' if self.dry_run else 'Set', len(materials),
+                                                            run.summary(memo)))
+        self.report_estimates(sampler)
+        self.report_profile()
+
+
+class CFMBatchOperator(CFMOperator):
+    """Sets many materials. Run from the UI, materials are processed in time slices with progress,
+    and the batch can be cancelled with Esc, keeping the materials done so far.
+    The first slices compute the statistics of the textures used, so decoding them can be cancelled too.
+    Materials are only set once the last slice is evaluated, or the batch is cancelled.
+    Sets every material, unless a subclass narrows them down in get_materials().
+    """
+
+    def get_materials(self, _context) -> list:
+        return list(bpy.data.materials)
+
+    def execute(self, context):
+        self.set_materials(self.get_materials(context))
+
+        return {'FINISHED'}
+
+    def invoke(self, context, _event):
+        self._materials = list(self.get_materials(context))
+        self._profiler = profiling.Profiler() if self.profile else None
+        self._sampler = self.new_sampler()
+        self._start = self.run_start()
+        self._done = 0
+        self._memo = node.EvaluationMemo()
+        with self.texture_mode(self._sampler), node.evaluation_run(self._memo):
+            self._run = self.new_run()
+            self._prefetch = self.prefetch_steps(self._run.out_of_date(self._materials), self._sampler)
+        self._start_time = time.perf_counter()
+
+        window_manager = context.window_manager
+        self._timer = window_manager.event_timer_add(config.BATCH_TIMER_INTERVAL, window=context.window)
+        window_manager.progress_begin(0, len(self._materials))
+        window_manager.modal_handler_add(self)
+
+        return {'RUNNING_MODAL'}
+
+    def modal(self, context, event):
+        if event.type == 'ESC':
+            return self.finish(context, cancelled=True)
+
+        # input is blocked while running, so node trees cannot change between slices sharing one memo
+        if event.type != 'TIMER':
+            return {'RUNNING_MODAL'}
+
+        deadline = time.perf_counter() + config.BATCH_SLICE_SECONDS
+        if self._prefetch is not None:
+            with self.profile_run(self._profiler), self.texture_mode(self._sampler):
+                progress = self.prefetch_slice(deadline)
+            if progress is not None:
+                context.workspace.status_text_set('Textures {}/{} (Esc to cancel)'.format(*progress))
+                return {'RUNNING_MODAL'}
+
+        with self.profile_run(self._profiler), self.texture_mode(self._sampler):
+            with node.evaluation_run(self._memo):
+                # each slice's materials are evaluated together, and added to the run's table before the slice ends
+                while self._done < len(self._materials):
+                    self._run.add(self._materials[self._done])
+                    self._done += 1
+                    if time.perf_counter() >= deadline:
+                        break
+                self._run.flush()
+
+        if self._done >= len(self._materials):
+            return self.finish(context)
+
+        elapsed = time.perf_counter() - self._start_time
+        eta = elapsed / self._done * (len(self._materials) - self._done)
+        context.window_manager.progress_update(self._done)
+        context.workspace.status_text_set('Materials {}/{}, about {:.0f}s left (Esc to cancel)'.format(
+            self._done, len(self._materials), eta))
+
+        return {'RUNNING_MODAL'}
+
+    def prefetch_slice(self, deadline: float) -> tuple:
+        """Computes texture statistics until the deadline.
+
+        :return: number of textures done and to do, or None once all are done.
+        """
+        for progress in self._prefetch:
+            if time.perf_counter() >= deadline:
+                return progress
+
+        self._prefetch = None
+        self._start_time = time.perf_counter()  # estimate the time left from materials alone
+        return None
+
+    def finish(self, context, cancelled=False):
+        if self._prefetch is not None:
+            self._prefetch.close()
+            self._prefetch = None
+
+        window_manager = context.window_manager
+        window_manager.event_timer_remove(self._timer)
+        window_manager.progress_end()
+        context.workspace.status_text_set(None)
+        self.commit(self._run, self._memo, self._start)
+
+        if cancelled:
+            message = 'Cancelled after evaluating {} of {} materials'
+        else:
+            message = 'Evaluated {} of {} materials'
+        self.report({'INFO'}, (message + ' ({})').format(self._done, len(self._materials),
+                                                         self._run.summary(self._memo)))
+        self.report_estimates(self._sampler)
+        self.report_profile()
+
+        # materials set before cancelling stay set, so finish either way to keep them in the undo step
+        return {'FINISHED'}
+
+
+class SelectedObjectsOperator(CFMBatchOperator):
     """Sets all selected object's viewport display properties."""
     bl_idname = 'object.selected_objects_nodes_to_viewport'
     bl_label = 'Set Selected Objects\' Nodes To Viewport Display'
 
-    def execute(self, context):
-        materials = {slot.material
+    def get_materials(self, context):
+        return list({slot.material
                      for obj in context.selected_objects
                      for slot in obj.material_slots
-                     if slot.material is not None}
-
-        for material in materials:
-            set_material(material, self.analyze_metallic, self.analyze_roughness)
-
-        return {'FINISHED'}
+                     if slot.material is not None})
 
 
 class ActiveMaterialOperator(CFMOperator):
@@ -74,41 +607,45 @@ class ActiveMaterialOperator(CFMOperator):
 
     @classmethod
     def poll(cls, context):
-        return context.active_object.active_material is not None and context.active_object.active_material.use_nodes
+        material = active_material(context)
+        return material is not None and material.use_nodes
 
     def execute(self, context):
-        set_material(context.active_object.active_material, self.analyze_metallic, self.analyze_roughness)
+        sampler = self.new_sampler()
+        material = active_material(context)
+        start = self.run_start()
+        with self.texture_mode(sampler):
+            with node.evaluation_run() as memo:
+                run = MaterialRun(get_channels(self.analyze_metallic, self.analyze_roughness), vectorized=False,
+                                  force=self.force)
+                run.set((material,))
+        self.commit(run, memo, start)
+
+        if run.skipped:
+            self.report({'INFO'}, '{} is up to date'.format(material.name))
+        elif self.dry_run:
+            self.report({'INFO'}, '{} {}'.format(material.name, run.summary(memo)))
+        self.report_estimates(sampler)
 
         return {'FINISHED'}
 
 
-class ActiveObjectOperator(CFMOperator):
+class ActiveObjectOperator(CFMBatchOperator):
     """Sets current object's material's viewport display properties."""
     bl_idname = 'object.active_object_nodes_to_viewport'
     bl_label = 'Active Objects\' Material Nodes To Viewport Display'
 
-    def execute(self, context):
-        materials = {slot.material
+    def get_materials(self, context):
+        return list({slot.material
                      for slot in context.active_object.material_slots
-                     if slot.material is not None}
+                     if slot.material is not None})
 
-        for material in materials:
-            set_material(material, self.analyze_metallic, self.analyze_roughness)
-
-        return {'FINISHED'}
 
-
-class AllMaterialsOperator(CFMOperator):
+class AllMaterialsOperator(CFMBatchOperator):
     """Sets all materials' viewport display properties."""
     bl_idname = 'object.all_material_nodes_to_viewport'
     bl_label = 'All Material Nodes To Viewport Display'
 
-    def execute(self, _context):
-        for material in bpy.data.materials:
-            set_material(material, self.analyze_metallic, self.analyze_roughness)
-
-        return {'FINISHED'}
-
 
 class ActiveMaterialNodeOperator(CFMOperator):
     """Sets all materials' viewport display properties."""
@@ -119,21 +656,117 @@ class ActiveMaterialNodeOperator(CFMOperator):
 
     @classmethod
     def poll(cls, context):
-        material = context.active_object.active_material
-        return material is not None and material.use_nodes and len([node
-                                                                    for node in material.node_tree.nodes
-                                                                    if node.select]) == 1
+        material = active_material(context)
+        if material is None or not material.use_nodes or material.node_tree is None:
+            return False
+        return selected_node(material.node_tree) is not None
 
     def execute(self, context):
-        material = context.active_object.active_material
-        active_node = [n for n in material.node_tree.nodes if n.select][0]
-        material.diffuse_color = node.assert_color(node.get_from_node(active_node, config.ALBEDO_MAP,
-                                                                      Vector((0.8, 0.8, 0.8, 1.0))
-                                                                      ))
-        if self.analyze_roughness:
-            material.roughness = node.assert_float(node.get_from_node(active_node, config.ROUGHNESS_MAP, 0.5))
+        material = active_material(context)
+        active_node = selected_node(material.node_tree)
+        sampler = self.new_sampler()
+        channels = get_channels(self.analyze_metallic, self.analyze_roughness)
+        with self.texture_mode(sampler):
+            table = results.ResultTable(channels)
+            table.add(material, None, evaluate_channels(active_node, channels))
+
+        if self.dry_run:
+            print(table.format())
+        else:
+            table.commit()
+        results.record(table)
+        self.report_estimates(sampler)
+
+        return {'FINISHED'}
+
+
+class VerifySnapshotsOperator(CFMOperator):
+    """Evaluates all materials both from snapshots in worker processes and node by node,
+    and prints the values that differ to the system console."""
+    bl_idname = 'wm.cfm_verify_snapshots'
+    bl_label = 'Verify Worker Process Evaluation'
+    bl_options = {'REGISTER'}
+
+    def execute(self, _context):
+        materials = list(bpy.data.materials)
+        channels = get_channels(self.analyze_metallic, self.analyze_roughness)
+        with self.texture_mode(self.new_sampler()):
+            with node.evaluation_run():
+                snapshotted, mismatches = verify_snapshots(materials, channels)
+
+        for material, name, live_val, snapshot_val in mismatches:
+            print('{}: {} {} from nodes, {} from snapshot'.format(
+                material.name_full, name, results.to_list(live_val),
+                None if snapshot_val is None else results.to_list(snapshot_val)))
+
+        self.report({'WARNING'} if mismatches else {'INFO'},
+                    'Checked {} of {} materials from snapshots, {} values differ'.format(
+                        snapshotted, len(materials), len(mismatches)))
+        return {'FINISHED'}
+
+
+class ExportProfileOperator(bpy.types.Operator):
+    """Saves the latest material profile as JSON, or as CSV if the file name ends in .csv."""
+    bl_idname = 'wm.cfm_export_profile'
+    bl_label = 'Export Material Profile'
 
-        if self.analyze_metallic:
-            material.metallic = node.assert_float(node.get_from_node(active_node, config.METALLIC_MAP, 0.0))
+    filepath: bpy.props.StringProperty(subtype='FILE_PATH', default='material_profile.json')
 
+    @classmethod
+    def poll(cls, _context):
+        return profiling.latest() is not None
+
+    def invoke(self, context, _event):
+        context.window_manager.fileselect_add(self)
+        return {'RUNNING_MODAL'}
+
+    def execute(self, _context):
+        profiler = profiling.latest()
+        filepath = bpy.path.abspath(self.filepath)
+        try:
+            if filepath.lower().endswith('.csv'):
+                profiler.write_csv(filepath)
+            else:
+                profiler.write_json(filepath)
+        except OSError as e:
+            self.report({'ERROR'}, 'Could not save profile: {}'.format(e))
+            return {'CANCELLED'}
+
+        self.report({'INFO'}, 'Saved profile of {} materials to {}'.format(len(profiler.profiles), filepath))
+        return {'FINISHED'}
+
+
+class VerifyImageStoreOperator(bpy.types.Operator):
+    """Removes stored image statistics of files that were deleted or changed since."""
+    bl_idname = 'wm.cfm_verify_image_store'
+    bl_label = 'Verify Stored Image Statistics'
+
+    def execute(self, _context):
+        try:
+            checked, removed = image_store.STORE.verify()
+        except sqlite3.Error as e:
+            self.report({'ERROR'}, 'Could not verify {}: {}'.format(image_store.STORE.path, e))
+            return {'CANCELLED'}
+
+        self.report({'INFO'}, 'Checked {} stored images, removed {}'.format(checked, removed))
+        return {'FINISHED'}
+
+
+class PurgeImageStoreOperator(bpy.types.Operator):
+    """Removes all stored image statistics, so every image is read again."""
+    bl_idname = 'wm.cfm_purge_image_store'
+    bl_label = 'Purge Stored Image Statistics'
+
+    def invoke(self, context, event):
+        return context.window_manager.invoke_confirm(self, event)
+
+    def execute(self, _context):
+        try:
+            removed = image_store.STORE.purge()
+        except sqlite3.Error as e:
+            self.report({'ERROR'}, 'Could not purge {}: {}'.format(image_store.STORE.path, e))
+            return {'CANCELLED'}
+
+        image_stats.CACHE.invalidate()
+        self.report({'INFO'}, 'Removed {} stored images'.format(removed))
         return {'FINISHED'}
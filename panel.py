@@ -14,7 +14,7 @@
 
 import bpy
 
-from . import operator
+from . import operator, profiling, results
 
 
 class CM_PT_ObjectColorFromMaterial(bpy.types.Panel):
@@ -35,10 +35,35 @@ class CM_PT_ObjectColorFromMaterial(bpy.types.Panel):
         col.prop(window_manager, 'cfm_analyze_metallic', text='Metallic')
         col.prop(window_manager, 'cfm_analyze_roughness', text='Roughness')
 
+        layout.prop(window_manager, 'cfm_statistic')
+        layout.prop(window_manager, 'cfm_per_pixel')
+        layout.prop(window_manager, 'cfm_estimate')
+        col = layout.column(align=True)
+        col.active = window_manager.cfm_estimate
+        col.prop(window_manager, 'cfm_estimate_tolerance')
+        col.prop(window_manager, 'cfm_estimate_seed')
+        layout.prop(window_manager, 'cfm_force')
+        layout.prop(window_manager, 'cfm_dry_run')
+        layout.prop(window_manager, 'cfm_live_sync')
+        layout.prop(window_manager, 'cfm_profile')
+
         def draw_op(layout, bl_idname, **kwargs):
             op = layout.operator(bl_idname, **kwargs)
             op.analyze_metallic = window_manager.cfm_analyze_metallic
             op.analyze_roughness = window_manager.cfm_analyze_roughness
+            op.profile = window_manager.cfm_profile
+            op.per_pixel = window_manager.cfm_per_pixel
+            op.statistic = window_manager.cfm_statistic
+            op.estimate = window_manager.cfm_estimate
+            op.tolerance = window_manager.cfm_estimate_tolerance
+            op.seed = window_manager.cfm_estimate_seed
+            op.force = window_manager.cfm_force
+            op.dry_run = window_manager.cfm_dry_run
+            op.parallel = window_manager.cfm_parallel
+
+        row = layout.row()
+        row.prop(window_manager, 'cfm_parallel')
+        draw_op(row, operator.VerifySnapshotsOperator.bl_idname, text='', icon='CHECKMARK')
 
         row = layout.row()
         draw_op(row, operator.ActiveMaterialOperator.bl_idname,
@@ -52,3 +77,100 @@ class CM_PT_ObjectColorFromMaterial(bpy.types.Panel):
                 text='Selected Objects', icon='SCENE_DATA')
         draw_op(layout, operator.AllMaterialsOperator.bl_idname,
                 text='All Materials', icon='FILE_BLEND')
+
+
+def _format_value(val) -> str:
+    if isinstance(val, list):
+        return ', '.join('{:.3f}'.format(v) for v in val)
+    return '{:.3f}'.format(val)
+
+
+class CM_PT_LastRun(bpy.types.Panel):
+    """Shows the last run and the active material's last values, as kept by the operators,
+    so drawing it never evaluates a node tree.
+    """
+    bl_label = 'Last Run'
+    bl_idname = 'CM_PT_LastRun'
+    bl_parent_id = CM_PT_ObjectColorFromMaterial.bl_idname
+    bl_space_type = 'PROPERTIES'
+    bl_region_type = 'WINDOW'
+    bl_context = 'material'
+    bl_options = {'DEFAULT_CLOSED'}
+
+    @classmethod
+    def poll(cls, context):
+        material = operator.active_material(context)
+        return results.last_run() is not None or (material is not None and results.last_values(material) is not None)
+
+    def draw(self, context):
+        layout = self.layout
+        summary = results.last_run()
+
+        if summary is not None:
+            col = layout.column(align=True)
+            col.label(text=summary['operator'] + (' (dry run)' if summary['dry_run'] else ''))
+            col.label(text='{} materials in {:.2f}s'.format(summary['materials'], summary['seconds']))
+            col.label(text='{} {}, {} up to date'.format(
+                summary['changed'], 'would change' if summary['dry_run'] else 'changed', summary['skipped']))
+            col.label(text='{:.0%} of node evaluations reused, {:.0%} image cache hits'.format(
+                summary['node_hit_rate'], summary['image_hit_rate']))
+
+        material = operator.active_material(context)
+        values = None if material is None else results.last_values(material)
+        if values:
+            col = layout.column(align=True)
+            col.label(text=material.name, icon='MATERIAL')
+            for name, val in values.items():
+                row = col.row()
+                row.label(text=name.replace('_', ' ').title())
+                row.label(text=_format_value(val))
+
+
+class CM_PT_MaterialProfile(bpy.types.Panel):
+    bl_label = 'Slowest Materials'
+    bl_idname = 'CM_PT_MaterialProfile'
+    bl_parent_id = CM_PT_ObjectColorFromMaterial.bl_idname
+    bl_space_type = 'PROPERTIES'
+    bl_region_type = 'WINDOW'
+    bl_context = 'material'
+    bl_options = {'DEFAULT_CLOSED'}
+
+    @classmethod
+    def poll(cls, _context):
+        return profiling.latest() is not None
+
+    def draw(self, context):
+        layout = self.layout
+        window_manager = context.window_manager
+        profiler = profiling.latest()
+        sort_key = window_manager.cfm_profile_sort
+
+        row = layout.row()
+        row.prop(window_manager, 'cfm_profile_sort', expand=True)
+        row.operator(operator.ExportProfileOperator.bl_idname, text='', icon='EXPORT')
+
+        col = layout.column(align=True)
+        for entry in profiler.top(sort_key, window_manager.cfm_profile_rows):
+            row = col.row()
+            row.label(text=entry['material'], icon='MATERIAL')
+            if sort_key == 'seconds':
+                row.label(text='{:.1f} ms'.format(entry['seconds'] * 1000))
+            elif sort_key == 'image_bytes':
+                row.label(text='{:.1f} MB'.format(entry['image_bytes'] / (1 << 20)))
+            else:
+                row.label(text=str(entry[sort_key]))
+
+
+class CM_PT_ImageStore(bpy.types.Panel):
+    bl_label = 'Stored Image Statistics'
+    bl_idname = 'CM_PT_ImageStore'
+    bl_parent_id = CM_PT_ObjectColorFromMaterial.bl_idname
+    bl_space_type = 'PROPERTIES'
+    bl_region_type = 'WINDOW'
+    bl_context = 'material'
+    bl_options = {'DEFAULT_CLOSED'}
+
+    def draw(self, _context):
+        row = self.layout.row()
+        row.operator(operator.VerifyImageStoreOperator.bl_idname, text='Verify', icon='CHECKMARK')
+        row.operator(operator.PurgeImageStoreOperator.bl_idname, text='Purge', icon='TRASH')
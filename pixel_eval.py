@@ -0,0 +1,533 @@
+# Copyright (C) 2024 Spencer Magnusson
+# semagnum@gmail.com
+# Created by Spencer Magnusson
+#     This program is free software: you can redistribute it and/or modify
+#     it under the terms of the GNU General Public License as published by
+#     the Free Software Foundation, either version 3 of the License, or
+#     (at your option) any later version.
+#     This program is distributed in the hope that it will be useful,
+#     but WITHOUT ANY WARRANTY; without even the implied warranty of
+#     MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#     GNU General Public License for more details.
+#     You should have received a copy of the GNU General Public License
+#     along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Per-pixel evaluation of node chains rooted in image textures.
+
+Averaging a texture and then transforming the mean is only right for linear nodes.
+In per-pixel mode, a chain of color ramp, hue/saturation, invert, gamma and mix nodes fed by textures
+is instead run on every pixel, in fixed-size chunks through preallocated buffers, and averaged at the end.
+"""
+
+from collections import OrderedDict
+from contextlib import contextmanager
+
+import bpy
+import numpy as np
+from mathutils import Vector
+
+from . import config, image_stats, tree_plan
+
+# nodes a chain is made of, and the nodes that may feed it
+CHAIN_NODES = {'ShaderNodeValToRGB', 'ShaderNodeInvert', 'ShaderNodeGamma', 'ShaderNodeHueSaturation',
+               'ShaderNodeMix'}
+_IMAGE_NODES = {'ShaderNodeTexImage', 'ShaderNodeTexEnvironment'}
+_CONSTANT_NODES = {'ShaderNodeRGB', 'ShaderNodeValue'}
+
+# longest chain compiled, as chains are compiled recursively
+_MAX_DEPTH = 64
+
+# register widths
+_FLOAT = 1
+_COLOR = 4
+
+# step codes
+_CONSTANT = 0
+_IMAGE = 1
+_TO_FLOAT = 2
+_TO_COLOR = 3
+_RAMP = 4
+_INVERT = 5
+_GAMMA = 6
+_HUE_SAT = 7
+_MIX = 8
+
+_enabled = False
+
+
+def active() -> bool:
+    """Returns whether texture chains are evaluated per pixel in the current block."""
+    return _enabled
+
+
+@contextmanager
+def per_pixel(enabled: bool = True):
+    """Evaluates texture chains per pixel inside the block, or as the transform of their texture's mean."""
+    global _enabled
+    outer = _enabled
+    _enabled = enabled
+    try:
+        yield
+    finally:
+        _enabled = outer
+
+
+class Unsupported(Exception):
+    """A node or setting the per-pixel chain cannot reproduce, so the chain is evaluated on its mean instead."""
+
+
+class Chain:
+    """Steps evaluating a chain per pixel, each writing the register of the same index.
+
+    :param steps: (code, width, argument) per step. Arguments are a constant, an image and channel,
+        or a tuple of registers and settings.
+    :param images: images read, in the order image steps refer to them.
+    :param key: description of everything the chain's mean depends on.
+    """
+
+    def __init__(self):
+        self.steps = []
+        self.images = []
+        self.key = []
+
+    def add(self, code: int, width: int, argument, key) -> int:
+        self.steps.append((code, width, argument))
+        self.key.append((code, width, key))
+        return len(self.steps) - 1
+
+    def width(self, register: int) -> int:
+        return self.steps[register][1]
+
+
+def _constant_value(val, width: int):
+    """Converts a socket value to a float or color like node_eval.assert_float() and assert_color()."""
+    try:
+        components = tuple(val)
+    except TypeError:
+        return float(val) if width == _FLOAT else (float(val), float(val), float(val), 1.0)
+
+    if width == _FLOAT:
+        return float(max(components[:-1]))
+    if len(components) != 4:
+        raise Unsupported('vector of length {}'.format(len(components)))
+    return tuple(float(v) for v in components)
+
+
+def _ramp_tables(ramp) -> tuple:
+    if ramp.color_mode != 'RGB' or ramp.interpolation not in {'LINEAR', 'CONSTANT', 'EASE'}:
+        raise Unsupported('{} {} color ramp'.format(ramp.interpolation, ramp.color_mode))
+
+    positions = np.array([element.position for element in ramp.elements], dtype=np.float32)
+    colors = np.array([tuple(element.color) for element in ramp.elements], dtype=np.float32)
+    return ramp.interpolation, positions, colors
+
+
+class _Compiler:
+    def __init__(self, plan: tree_plan.TreePlan):
+        self.plan = plan
+        self.chain = Chain()
+        self._registers = {}
+        self._visiting = set()
+        self._image_indices = {}
+
+    def constant(self, val, width: int) -> int:
+        val = _constant_value(val, width)
+        return self.chain.add(_CONSTANT, width, np.array(val, dtype=np.float32), val)
+
+    def convert(self, register: int, width: int) -> int:
+        """Converts a register to a float or color register, folding constants."""
+        code, register_width, argument = self.chain.steps[register]
+        if register_width == width:
+            return register
+        if code == _CONSTANT:
+            return self.constant(argument.tolist(), width)
+        return self.chain.add(_TO_FLOAT if width == _FLOAT else _TO_COLOR, width, (register,), register)
+
+    def image(self, node, output_index: int) -> int:
+        image = getattr(node, 'image', None)
+        if image is None:  # typical "cannot find the texture" color, like custom_node_eval.image_node
+            return self.constant((1.0, 0.0, 1.0, 1.0), _FLOAT if output_index == 1 else _COLOR)
+        if image.source == 'TILED':  # pixels only hold the first tile
+            raise Unsupported('tiled image')
+
+        index = self._image_indices.get(image.name_full)
+        if index is None:
+            index = self._image_indices[image.name_full] = len(self.chain.images)
+            self.chain.images.append(image)
+
+        if output_index == 1:  # alpha
+            return self.chain.add(_IMAGE, _FLOAT, (index, 3),
+                                  (image.name_full, image_stats.CACHE.stamp(image), 3))
+        return self.chain.add(_IMAGE, _COLOR, (index, None), (image.name_full, image_stats.CACHE.stamp(image)))
+
+    def socket(self, socket, width: int, depth: int) -> int:
+        """Compiles the value of an input socket as a register of the given width."""
+        if depth > _MAX_DEPTH:
+            raise Unsupported('chain too long')
+
+        link = self.plan.links.get(socket.as_pointer())
+        if link is None:
+            if not hasattr(socket, 'default_value'):
+                raise Unsupported('socket without a value')
+            return self.constant(socket.default_value, width)
+
+        node_plan = link.from_node
+        if node_plan.bl_idname == 'NodeReroute':
+            return self.socket(node_plan.inputs[0], width, depth + 1)
+        if node_plan.bl_idname in _IMAGE_NODES:
+            return self.convert(self.image(node_plan.node, link.from_socket_index), width)
+        if node_plan.bl_idname in _CONSTANT_NODES:
+            return self.constant(node_plan.outputs[0].default_value, width)
+        if node_plan.bl_idname in CHAIN_NODES:
+            return self.convert(self.node(node_plan, link.from_socket_index, depth + 1), width)
+        raise Unsupported(node_plan.bl_idname)
+
+    def node(self, node_plan: tree_plan.NodePlan, output_index: int, depth: int) -> int:
+        """Compiles a chain node's output, sharing the registers of nodes feeding several others."""
+        key = (node_plan, output_index)
+        if key in self._registers:
+            return self._registers[key]
+        if depth > _MAX_DEPTH or node_plan in self._visiting:
+            raise Unsupported('chain too long, or a cycle')
+
+        self._visiting.add(node_plan)
+        try:
+            register = self._registers[key] = self._node(node_plan, output_index, depth)
+        finally:
+            self._visiting.discard(node_plan)
+        return register
+
+    def _node(self, node_plan: tree_plan.NodePlan, output_index: int, depth: int) -> int:
+        node = node_plan.node
+        inputs = node_plan.inputs
+        bl_idname = node_plan.bl_idname
+
+        if bl_idname == 'ShaderNodeValToRGB':
+            factor = self.socket(inputs[0], _FLOAT, depth)
+            interpolation, positions, colors = _ramp_tables(node.color_ramp)
+            width = _FLOAT if output_index == 1 else _COLOR
+            return self.chain.add(_RAMP, width, (factor, interpolation, positions, colors),
+                                  (factor, interpolation, tuple(positions.tolist()),
+                                   tuple(map(tuple, colors.tolist()))))
+
+        if bl_idname == 'ShaderNodeInvert':
+            args = self.socket(inputs[0], _FLOAT, depth), self.socket(inputs[1], _COLOR, depth)
+            return self.chain.add(_INVERT, _COLOR, args, args)
+
+        if bl_idname == 'ShaderNodeGamma':
+            args = self.socket(inputs[0], _COLOR, depth), self.socket(inputs[1], _FLOAT, depth)
+            return self.chain.add(_GAMMA, _COLOR, args, args)
+
+        if bl_idname == 'ShaderNodeHueSaturation':
+            args = tuple(self.socket(inputs[i], _FLOAT, depth) for i in range(4))
+            args += (self.socket(inputs[4], _COLOR, depth),)
+            return self.chain.add(_HUE_SAT, _COLOR, args, args)
+
+        # mix node, mixing linearly whatever its blend type like custom_node_eval.mix_node
+        data_type = node.data_type
+        if data_type == 'RGBA':
+            width, a_index, b_index = _COLOR, 6, 7
+        elif data_type == 'FLOAT':
+            width, a_index, b_index = _FLOAT, 2, 3
+        else:
+            raise Unsupported('{} mix'.format(data_type))
+        args = (self.socket(inputs[0], _FLOAT, depth), self.socket(inputs[a_index], width, depth),
+                self.socket(inputs[b_index], width, depth))
+        return self.chain.add(_MIX, width, args, args)
+
+
+def compile_chain(plan: tree_plan.TreePlan, node_plan: tree_plan.NodePlan, output_index: int) -> Chain:
+    """Compiles the chain ending at a node's output, or returns None if it is not a chain fed by textures."""
+    if node_plan.bl_idname not in CHAIN_NODES:
+        return None
+
+    compiler = _Compiler(plan)
+    try:
+        compiler.node(node_plan, output_index, 0)
+    except Unsupported:
+        return None
+
+    chain = compiler.chain
+    if not chain.images:
+        return None
+    chain.key = tuple(chain.key)
+    return chain
+
+
+def _column(register: np.ndarray) -> np.ndarray:
+    """Float register as a column, so it scales each color component."""
+    return register[:, None] if register.ndim == 1 else register
+
+
+def _scale(out: np.ndarray, factor: np.ndarray):
+    """Multiplies a float or color register by a float register in place."""
+    out *= _column(factor) if out.ndim == 2 else factor
+
+
+def _ramp(out: np.ndarray, factors: np.ndarray, interpolation: str, positions: np.ndarray, colors: np.ndarray):
+    """Evaluates a color ramp at every factor, like Blender's color band."""
+    if len(positions) == 1:
+        out[:] = colors[0] if out.ndim == 2 else colors[0, 3]
+        return
+
+    factors = np.broadcast_to(factors, out.shape[:1])
+    if interpolation == 'LINEAR':
+        if out.ndim == 2:
+            for channel in range(4):
+                out[:, channel] = np.interp(factors, positions, colors[:, channel])
+        else:
+            out[:] = np.interp(factors, positions, colors[:, 3])
+        return
+
+    # index of the stop at or before each factor, so the factor lies between stops lower and lower + 1
+    lower = np.clip(np.searchsorted(positions, factors, side='right') - 1, 0, len(positions) - 2)
+    if interpolation == 'CONSTANT':
+        t = (factors >= positions[lower + 1]).astype(np.float32)
+    else:
+        span = positions[lower + 1] - positions[lower]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            t = np.clip(np.where(span > 0, (factors - positions[lower]) / span, 0.0), 0.0, 1.0)
+        t = t * t * (3.0 - 2.0 * t)
+
+    selected = colors if out.ndim == 2 else colors[:, 3]
+    start = selected[lower]
+    np.subtract(selected[lower + 1], start, out=out)
+    _scale(out, t)
+    out += start
+
+
+def _invert(out: np.ndarray, factor: np.ndarray, color: np.ndarray):
+    # whole rows are faster than the first three columns, so alpha is written over afterwards
+    np.multiply(color, -2.0, out=out)
+    out += 1.0
+    _scale(out, factor)
+    out += color
+    out[:, 3] = color[..., 3]
+
+
+def _gamma(out: np.ndarray, color: np.ndarray, gamma: np.ndarray):
+    """Raises positive components to the gamma, leaving others as they are."""
+    source = np.broadcast_to(color, out.shape)
+    np.maximum(source, 0.0, out=out)
+    np.power(out, _column(gamma), out=out)
+    np.copyto(out, source, where=source <= 0.0)
+    out[:, 3] = source[:, 3]
+
+
+def _hue_sat(out: np.ndarray, hue, saturation, value, factor, color: np.ndarray):
+    """Shifts hue, scales saturation and value, and mixes with the input by the factor, like Blender's node."""
+    rgb = np.broadcast_to(color[..., :3], out[:, :3].shape)
+    r, g, b = rgb[:, 0], rgb[:, 1], rgb[:, 2]
+
+    # RGB to HSV, with pairwise maximum and minimum, as reducing an axis of three is slow
+    c_max = np.maximum(np.maximum(r, g), b)
+    delta = c_max - np.minimum(np.minimum(r, g), b)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        s = np.where(c_max != 0.0, delta / c_max, 0.0)
+        safe_delta = np.where(delta != 0.0, delta, 1.0)
+        h = np.where(r == c_max, (g - b) / safe_delta,
+                     np.where(g == c_max, 2.0 + (b - r) / safe_delta, 4.0 + (r - g) / safe_delta)) / 6.0
+    h = np.where(s == 0.0, 0.0, h - np.floor(h))
+
+    # wrapping with floor() is much faster than %, and hsv_to_rgb() gives the same color at 0 and 1
+    h += hue + 0.5
+    h -= np.floor(h)
+    s = np.clip(s * saturation, 0.0, 1.0)
+    v = c_max * value
+
+    # HSV to RGB, as in Blender's hsv_to_rgb()
+    h6 = h * 6.0
+    for channel, (offset, sign, shift) in enumerate(((3.0, 1.0, -1.0), (2.0, -1.0, 2.0), (4.0, -1.0, 2.0))):
+        component = out[:, channel]
+        np.subtract(h6, offset, out=component)
+        np.abs(component, out=component)
+        component *= sign
+        component += shift
+        np.clip(component, 0.0, 1.0, out=component)
+        component -= 1.0
+        component *= s
+        component += 1.0
+        component *= v
+
+    # mix with the input color by the factor
+    rgb_out = out[:, :3]
+    rgb_out -= rgb
+    _scale(rgb_out, factor)
+    rgb_out += rgb
+    out[:, 3] = color[..., 3]
+
+
+def _mix(out: np.ndarray, factor, a, b):
+    np.subtract(b, a, out=out)
+    _scale(out, factor)
+    out += a
+
+
+def _read_images(images) -> list:
+    """Reads each image's pixels into the shared buffer of its slot, reused by the next chain."""
+    return [image_stats.read_pixels(image, slot) for slot, image in enumerate(images)]
+
+
+def run_chain(chain: Chain, chunk_size: int = None, kind: str = None):
+    """Evaluates a chain on every pixel, reducing the pixels whose alpha passes the threshold in every image
+    to their mean, or their dominant value, as for images.
+
+    Registers are allocated once for a chunk and reused for the next, so they do not grow with image size.
+    The images themselves are held whole, each in its own reusable buffer, see image_stats.read_pixels,
+    so memory grows with the size of every image in the chain.
+
+    :param kind: statistic, see image_stats.STATISTICS, or None for the active one.
+    :return: color as a Vector, or float, or None if the images differ in size or no pixel passes.
+    """
+    if chunk_size is None:
+        chunk_size = config.PIXEL_CHUNK_SIZE
+    if kind is None:
+        kind = image_stats.active_statistic()
+
+    pixels = _read_images(chain.images)
+    count = len(pixels[0])
+    if any(len(image_pixels) != count for image_pixels in pixels):
+        return None
+
+    length = min(chunk_size, count)
+    registers = []
+    for code, step_width, argument in chain.steps:
+        if code == _CONSTANT:
+            registers.append(argument)
+        elif code == _IMAGE:
+            registers.append(None)  # a view of the image's chunk
+        else:
+            registers.append(np.empty((length, step_width) if step_width == _COLOR else length, dtype=np.float32))
+
+    mask = np.empty(length, dtype=bool)
+    weights = np.empty(length, dtype=np.float32)
+    total = np.zeros(_COLOR, dtype=np.float64)
+    counted = 0
+    histogram = image_stats.ColorHistogram() if kind == image_stats.DOMINANT else None
+    width = chain.width(len(chain.steps) - 1)
+
+    for start in range(0, count, chunk_size):
+        chunks = [image_pixels[start:start + chunk_size] for image_pixels in pixels]
+        n = len(chunks[0])
+
+        views = []
+        for (code, _step_width, argument), register in zip(chain.steps, registers):
+            if code == _CONSTANT:
+                views.append(register)
+                continue
+            if code == _IMAGE:
+                index, channel = argument
+                views.append(chunks[index] if channel is None else chunks[index][:, channel])
+                continue
+
+            out = register[:n]
+            if code == _TO_FLOAT:
+                color = np.atleast_2d(views[argument[0]])
+                np.maximum(color[:, 0], color[:, 1], out=out)
+                np.maximum(out, color[:, 2], out=out)
+            elif code == _TO_COLOR:
+                out[:, :3] = _column(views[argument[0]])
+                out[:, 3] = 1.0
+            elif code == _RAMP:
+                factor, interpolation, positions, colors = argument
+                _ramp(out, views[factor], interpolation, positions, colors)
+            elif code == _INVERT:
+                _invert(out, *(views[arg] for arg in argument))
+            elif code == _GAMMA:
+                _gamma(out, *(views[arg] for arg in argument))
+            elif code == _HUE_SAT:
+                _hue_sat(out, *(views[arg] for arg in argument))
+            else:
+                _mix(out, *(views[arg] for arg in argument))
+            views.append(out)
+
+        chunk_mask = mask[:n]
+        np.greater_equal(chunks[0][:, 3], config.ALPHA_THRESHOLD, out=chunk_mask)
+        for chunk in chunks[1:]:
+            chunk_mask &= chunk[:, 3] >= config.ALPHA_THRESHOLD
+        result = np.broadcast_to(views[-1], (n, _COLOR) if width == _COLOR else (n,))
+        if histogram is not None:
+            # a float is counted as a gray color
+            histogram.add(result[:, :3] if width == _COLOR else np.broadcast_to(result[:, None], (n, 3)),
+                          chunk_mask)
+            continue
+
+        chunk_weights = weights[:n]
+        chunk_weights[:] = chunk_mask
+
+        # masked sum as a dot product, as in image_stats.reduce_pixels
+        chunk_total = chunk_weights @ result
+        if not np.all(np.isfinite(chunk_total)):
+            chunk_total = result[chunk_mask].sum(axis=0, dtype=np.float64)
+        total[:width] += chunk_total
+        counted += int(np.count_nonzero(chunk_mask))
+
+    if histogram is not None:
+        color = histogram.dominant()[0]
+        if color is None:
+            return None
+        value = np.array(color)
+    else:
+        if counted == 0:
+            return None
+        value = total / counted
+        if not np.all(np.isfinite(value)):
+            return None
+
+    if width == _FLOAT:
+        return float(value[0])
+    return Vector((float(value[0]), float(value[1]), float(value[2]), 1.0))
+
+
+class ChainCache:
+    """Least-recently-used cache of chain values, keyed by the chain's description,
+    which includes its constants and the validity stamp of each image, and the statistic.
+    Bounded by entries and bytes like image_stats.ImageStatsCache, as keys hold color ramp tables.
+    """
+
+    def __init__(self):
+        self.bytes = 0
+        self._entries = OrderedDict()
+        self._sizes = {}
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, chain: Chain):
+        kind = image_stats.active_statistic()
+        key = chain.key, kind
+        if key in self._entries:
+            self._entries.move_to_end(key)
+            return self._entries[key]
+
+        value = run_chain(chain, kind=kind)
+        self._entries[key] = value
+        self._sizes[key] = image_stats.cached_bytes(key) + image_stats.cached_bytes(value)
+        self.bytes += self._sizes[key]
+        while len(self._entries) > 1 and (len(self._entries) > config.IMAGE_CACHE_MAX_ENTRIES
+                                          or self.bytes > config.IMAGE_CACHE_MAX_BYTES):
+            self.bytes -= self._sizes.pop(self._entries.popitem(last=False)[0])
+        return value
+
+    def clear(self):
+        self._entries.clear()
+        self._sizes.clear()
+        self.bytes = 0
+
+
+CACHE = ChainCache()
+
+
+def chain_value(plan: tree_plan.TreePlan, node_plan: tree_plan.NodePlan, output_index: int):
+    """Returns the per-pixel mean or dominant value of the chain ending at a node's output,
+    or None to evaluate it as usual.
+    """
+    chain = compile_chain(plan, node_plan, output_index)
+    if chain is None:
+        return None
+    return CACHE.get(chain)
+
+
+@bpy.app.handlers.persistent
+def clear_on_load(_dummy):
+    CACHE.clear()
@@ -0,0 +1,206 @@
+# Copyright (C) 2024 Spencer Magnusson
+# semagnum@gmail.com
+# Created by Spencer Magnusson
+#     This program is free software: you can redistribute it and/or modify
+#     it under the terms of the GNU General Public License as published by
+#     the Free Software Foundation, either version 3 of the License, or
+#     (at your option) any later version.
+#     This program is distributed in the hope that it will be useful,
+#     but WITHOUT ANY WARRANTY; without even the implied warranty of
+#     MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#     GNU General Public License for more details.
+#     You should have received a copy of the GNU General Public License
+#     along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import csv
+import heapq
+import json
+import time
+from collections import Counter
+from contextlib import contextmanager
+
+import bpy
+
+
+class MaterialProfile:
+    """Where the time went while evaluating one material."""
+
+    def __init__(self, name: str):
+        self.name = name
+        self.seconds = 0.0
+        self.node_visits = Counter()
+        self.group_descents = 0
+        self.image_bytes = 0
+        self.image_cache_hits = 0
+        self.image_cache_misses = 0
+
+    def visit(self, node_plan):
+        """Counts a node evaluated by the traversal, as opposed to answered from the memo."""
+        self.node_visits[node_plan.bl_idname] += 1
+        if node_plan.is_group:
+            self.group_descents += 1
+
+    def to_dict(self) -> dict:
+        return {
+            'material': self.name,
+            'seconds': self.seconds,
+            'nodes': sum(self.node_visits.values()),
+            'group_descents': self.group_descents,
+            'image_bytes': self.image_bytes,
+            'image_cache_hits': self.image_cache_hits,
+            'image_cache_misses': self.image_cache_misses,
+            'node_visits': dict(self.node_visits.most_common()),
+        }
+
+
+# ways to sort the slowest materials list, as (identifier, name, description) for an EnumProperty
+SORT_KEYS = [
+    ('seconds', 'Time', 'Wall time spent evaluating the material'),
+    ('nodes', 'Nodes', 'Nodes evaluated'),
+    ('group_descents', 'Groups', 'Node groups entered'),
+    ('image_bytes', 'Image Data', 'Bytes of image pixels read'),
+]
+
+
+class Profiler:
+    """Material profiles of one run, such as one batch operator."""
+
+    def __init__(self):
+        self.profiles = []
+        self.image_bytes = 0
+        self._sorted = {}
+
+    def add(self, profile: MaterialProfile):
+        self.profiles.append(profile)
+        self._sorted.clear()
+
+    def top(self, sort_key: str = 'seconds', limit: int = 10) -> list:
+        """Returns the material profiles that rank highest by a sort key, as dictionaries."""
+        key = (sort_key, limit)
+        if key not in self._sorted:
+            rows = (profile.to_dict() for profile in self.profiles)
+            self._sorted[key] = heapq.nlargest(limit, rows, key=lambda row: row[sort_key])
+        return self._sorted[key]
+
+    def totals(self) -> dict:
+        node_visits = Counter()
+        for profile in self.profiles:
+            node_visits.update(profile.node_visits)
+
+        return {
+            'materials': len(self.profiles),
+            'seconds': sum(profile.seconds for profile in self.profiles),
+            'nodes': sum(node_visits.values()),
+            'group_descents': sum(profile.group_descents for profile in self.profiles),
+            # includes images read ahead of the traversal, which no single material is charged for
+            'image_bytes': self.image_bytes + sum(profile.image_bytes for profile in self.profiles),
+            'image_cache_hits': sum(profile.image_cache_hits for profile in self.profiles),
+            'image_cache_misses': sum(profile.image_cache_misses for profile in self.profiles),
+            'node_visits': dict(node_visits.most_common()),
+        }
+
+    def summary(self) -> str:
+        """One line summary for an operator report."""
+        totals = self.totals()
+        if not self.profiles:
+            return 'No materials profiled'
+
+        slowest = self.top('seconds', 1)[0]
+        lookups = totals['image_cache_hits'] + totals['image_cache_misses']
+        return ('{} materials in {:.3f}s, slowest "{}" ({:.3f}s); {} nodes, {} group descents, '
+                '{:.1f} MB of images read, {:.0%} image cache hits').format(
+            totals['materials'], totals['seconds'], slowest['material'], slowest['seconds'], totals['nodes'],
+            totals['group_descents'], totals['image_bytes'] / (1 << 20),
+            totals['image_cache_hits'] / lookups if lookups else 0.0)
+
+    def write_json(self, filepath: str):
+        with open(filepath, 'w') as f:
+            json.dump({'totals': self.totals(), 'materials': [profile.to_dict() for profile in self.profiles]},
+                      f, indent=2)
+
+    def write_csv(self, filepath: str):
+        with open(filepath, 'w', newline='') as f:
+            writer = csv.writer(f)
+            columns = ['material', 'seconds', 'nodes', 'group_descents', 'image_bytes',
+                       'image_cache_hits', 'image_cache_misses']
+            writer.writerow(columns + ['node_visits'])
+            for profile in self.profiles:
+                row = profile.to_dict()
+                writer.writerow([row[column] for column in columns] +
+                                [' '.join('{}={}'.format(*item) for item in row['node_visits'].items())])
+
+
+_profiler = None
+_profile = None
+_latest = None
+
+
+def current() -> MaterialProfile:
+    """Returns the profile of the material being evaluated, or None when not profiling."""
+    return _profile
+
+
+def latest() -> Profiler:
+    """Returns the most recent run's profiler, if any run was profiled."""
+    return _latest
+
+
+@contextmanager
+def session(profiler: Profiler = None):
+    """Profiles every material evaluated inside the block.
+
+    :param profiler: profiler to continue with, such as across the time slices of one batch. A new one by default.
+    """
+    global _profiler, _latest
+    outer_profiler = _profiler
+    _profiler = _latest = Profiler() if profiler is None else profiler
+    try:
+        yield _profiler
+    finally:
+        _profiler = outer_profiler
+
+
+@contextmanager
+def material(name: str):
+    """Records one material's profile, if inside a profiling session."""
+    global _profile
+    if _profiler is None:
+        yield None
+        return
+
+    outer_profile = _profile
+    profile = _profile = MaterialProfile(name)
+    start = time.perf_counter()
+    try:
+        yield profile
+    finally:
+        profile.seconds = time.perf_counter() - start
+        _profile = outer_profile
+        _profiler.add(profile)
+
+
+def record_image_read(nbytes: int):
+    """Counts image pixels read, against the current material or else the run."""
+    if _profile is not None:
+        _profile.image_bytes += nbytes
+    elif _profiler is not None:
+        _profiler.image_bytes += nbytes
+
+
+def record_image_lookup(hit: bool):
+    if _profile is not None:
+        if hit:
+            _profile.image_cache_hits += 1
+        else:
+            _profile.image_cache_misses += 1
+
+
+def clear():
+    global _latest
+    _latest = None
+
+
+@bpy.app.handlers.persistent
+def clear_on_load(_dummy):
+    """Profiles name materials of the previous file, so drop them when a new file is loaded."""
+    clear()
@@ -0,0 +1,200 @@
+# Copyright (C) 2024 Spencer Magnusson
+# semagnum@gmail.com
+# Created by Spencer Magnusson
+#     This program is free software: you can redistribute it and/or modify
+#     it under the terms of the GNU General Public License as published by
+#     the Free Software Foundation, either version 3 of the License, or
+#     (at your option) any later version.
+#     This program is distributed in the hope that it will be useful,
+#     but WITHOUT ANY WARRANTY; without even the implied warranty of
+#     MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#     GNU General Public License for more details.
+#     You should have received a copy of the GNU General Public License
+#     along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Values evaluated for materials, set on them once every material is evaluated.
+
+Each property set on a material runs its update callbacks and tags the depsgraph, so setting values
+as they are evaluated interleaves those updates with the traversal, and a failure halfway leaves some
+materials set and others not. A result table collects the values first, and its commit only sets
+the ones that changed, optionally in bulk when many materials change the same property.
+"""
+
+import bpy
+import numpy as np
+
+from . import config, fingerprint
+
+# smallest difference between a material's value and an evaluated one that is written
+TOLERANCE = 1e-6
+
+
+def differs(current, new) -> bool:
+    """Returns whether an evaluated value differs from a material's current one, a color or a float."""
+    try:
+        return any(abs(a - b) > TOLERANCE for a, b in zip(current, new))
+    except TypeError:
+        return abs(current - new) > TOLERANCE
+
+
+def to_list(val):
+    """Converts a value to a float, or a list of floats for colors, such as to write it as JSON."""
+    try:
+        return [float(v) for v in val]
+    except TypeError:
+        return float(val)
+
+
+def _bulk_indices() -> dict:
+    """Returns the index of each material in bpy.data.materials by pointer, or an empty dictionary if any is
+    linked from a library, as a bulk write goes over the whole collection and must not write linked materials.
+    """
+    indices = {}
+    for index, material in enumerate(bpy.data.materials):
+        if material.library is not None:
+            return {}
+        indices[material.as_pointer()] = index
+    return indices
+
+
+def _bulk_set(name: str, changes: list):
+    """Sets one property of many materials with a single foreach_set on bpy.data.materials,
+    which skips the update callbacks run by setting it on each material.
+
+    :param changes: (index in bpy.data.materials, value) pairs.
+    """
+    collection = bpy.data.materials
+    width = len(changes[0][1]) if hasattr(changes[0][1], '__len__') else 1
+    buffer = np.empty(len(collection) * width, dtype=np.float32)
+    collection.foreach_get(name, buffer)
+
+    columns = buffer.reshape(len(collection), width)
+    for index, val in changes:
+        columns[index] = val
+    collection.foreach_set(name, buffer)
+
+
+class ResultTable:
+    """Values to set on materials, one row per material, which commit() sets together.
+
+    :param names: names of the material properties evaluated.
+    """
+
+    def __init__(self, names):
+        self.names = tuple(names)
+        self.rows = []
+
+    def __len__(self):
+        return len(self.rows)
+
+    def add(self, material: bpy.types.Material, key: str, values: dict):
+        """Adds a material's values, and the fingerprint they were evaluated from, or None to not store one."""
+        self.rows.append((material, key, values))
+
+    def changes(self) -> list:
+        """Returns, for each row, the names of the properties whose values differ from the material's."""
+        return [[name for name, val in values.items() if differs(getattr(material, name), val)]
+                for material, _key, values in self.rows]
+
+    def commit(self) -> int:
+        """Sets the values that differ from the materials' current ones, then stores each material's fingerprint.
+
+        With config.BULK_WRITE_ENABLED, a property changed on at least config.BULK_WRITE_MIN_MATERIALS materials
+        is set on all of them at once, and each of those materials is tagged for update once afterwards.
+        Files with materials linked from libraries are always set one material at a time.
+
+        :return: number of materials changed.
+        """
+        changes = self.changes()
+        indices = None
+        bulk_set = {}
+
+        for name in self.names:
+            changed = [(material, values[name]) for (material, _key, values), names in zip(self.rows, changes)
+                       if name in names]
+            local = [(material, val) for material, val in changed if material.library is None]
+
+            if config.BULK_WRITE_ENABLED and len(local) >= config.BULK_WRITE_MIN_MATERIALS:
+                if indices is None:
+                    indices = _bulk_indices()
+                local = [(material, val) for material, val in local if material.as_pointer() in indices]
+
+            if indices and len(local) >= config.BULK_WRITE_MIN_MATERIALS:
+                _bulk_set(name, [(indices[material.as_pointer()], val) for material, val in local])
+                written = {material.as_pointer(): material for material, _val in local}
+                bulk_set.update(written)
+                changed = [(material, val) for material, val in changed if material.as_pointer() not in written]
+
+            for material, val in changed:
+                setattr(material, name, val)
+
+        for material in bulk_set.values():
+            material.update_tag()
+
+        for material, key, _values in self.rows:
+            if key is not None:
+                fingerprint.store(material, key, self.names)
+
+        return sum(1 for names in changes if names)
+
+    def to_dicts(self, changes: list = None) -> list:
+        """Returns the rows as JSON-ready dictionaries, with the properties each would change.
+
+        :param changes: result of changes(), if already computed.
+        """
+        if changes is None:
+            changes = self.changes()
+        return [{'material': material.name_full,
+                 'values': {name: to_list(val) for name, val in values.items()},
+                 'changed': names}
+                for (material, _key, values), names in zip(self.rows, changes)]
+
+    def format(self, changes: list = None) -> str:
+        """Returns the values that would change as text, one line per material and property."""
+        if changes is None:
+            changes = self.changes()
+        lines = []
+        for (material, _key, values), names in zip(self.rows, changes):
+            for name in names:
+                lines.append('{}: {} {} -> {}'.format(material.name_full, name, to_list(getattr(material, name)),
+                                                      to_list(values[name])))
+        return '\n'.join(lines)
+
+
+# values each material was last evaluated to, and a summary of the last operator run,
+# kept so the panel can show them without evaluating anything while it draws
+_last_values = {}
+_last_run = None
+
+
+def record(table: ResultTable, summary: dict = None):
+    """Keeps the values of a table's materials, and the summary of its run if it has one, for the panel.
+
+    :param summary: measurements of the run, see CFMOperator.commit in operator.py.
+    """
+    global _last_run
+    for material, _key, values in table.rows:
+        _last_values[material.name_full] = {name: to_list(val) for name, val in values.items()}
+    if summary is not None:
+        _last_run = summary
+
+
+def last_values(material: bpy.types.Material) -> dict:
+    """Returns the values a material was last evaluated to, as lists and floats, or None."""
+    return _last_values.get(material.name_full)
+
+
+def last_run() -> dict:
+    """Returns the summary of the last operator run, or None."""
+    return _last_run
+
+
+def clear():
+    global _last_run
+    _last_values.clear()
+    _last_run = None
+
+
+@bpy.app.handlers.persistent
+def clear_on_load(_dummy):
+    clear()
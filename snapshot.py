@@ -0,0 +1,328 @@
+# Copyright (C) 2024 Spencer Magnusson
+# semagnum@gmail.com
+# Created by Spencer Magnusson
+#     This program is free software: you can redistribute it and/or modify
+#     it under the terms of the GNU General Public License as published by
+#     the Free Software Foundation, either version 3 of the License, or
+#     (at your option) any later version.
+#     This program is distributed in the hope that it will be useful,
+#     but WITHOUT ANY WARRANTY; without even the implied warranty of
+#     MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#     GNU General Public License for more details.
+#     You should have received a copy of the GNU General Public License
+#     along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Snapshots of what evaluating a material reads, evaluated by worker processes on other cores.
+
+Node trees can only be read on Blender's main thread, so a snapshot copies the nodes reachable from a material's
+output into plain lists and dictionaries, which snapshot_eval evaluates without bpy:
+
+    {'channels': {name: [config map index, default value]},
+     'rules': [{node type: ['inputs' or 'outputs', index], a float, or a handler name}, one per config map],
+     'trees': {'': material tree, group name: group tree},
+     'images': {image name: statistic RGB, or None}}
+
+A tree is {'output': index of its output node or None, 'nodes': [node]}, and a node is
+{'type': bl_idname, 'inputs': [source], 'outputs': [source]}, plus the settings its handlers read: 'data_type',
+'clamp_type', 'ramp' as [interpolation, positions, colors], 'image' as a name, and 'group' as a tree key.
+A source is ['value', default value], ['default'] for a socket without one, ['link', node index, output index],
+or ['group_input', index], and None for sockets evaluation never reads.
+Image statistics and per-pixel chains are computed here, as they read pixels.
+Snapshots only hold what JSON can, and are sent to workers pickled, so node groups shared by the snapshots
+of one job are sent once.
+"""
+
+import os
+import pickle
+import subprocess
+import sys
+from concurrent.futures import ThreadPoolExecutor
+
+import bpy
+
+from . import (config, custom_node_eval as custom, fingerprint, image_sampling, node_eval, pixel_eval, snapshot_eval,
+               tree_plan)
+
+# names snapshots give custom_node_eval handlers
+_HANDLERS = {
+    custom.clamp_node: 'CLAMP',
+    custom.color_ramp: 'RAMP',
+    custom.image_node: 'IMAGE',
+    custom.mix_node: 'MIX',
+}
+
+
+class Unsupported(Exception):
+    """A node or setting snapshots cannot hold, so the material is evaluated live instead."""
+
+
+def _value(val):
+    """Converts a socket value to a float, or a list of floats for colors and vectors. Leaves others as they are."""
+    if val is None or isinstance(val, (float, int, str)):
+        return val
+    try:
+        return [float(v) for v in val]
+    except TypeError:
+        return float(val)
+
+
+def _source(socket) -> list:
+    if hasattr(socket, 'default_value'):
+        return ['value', _value(socket.default_value)]
+    return ['default']
+
+
+def _ramp(ramp) -> list:
+    if ramp.color_mode != 'RGB' or ramp.interpolation not in {'LINEAR', 'CONSTANT', 'EASE'}:
+        raise Unsupported('{} {} color ramp'.format(ramp.interpolation, ramp.color_mode))
+    return [ramp.interpolation, [float(element.position) for element in ramp.elements],
+            [_value(element.color) for element in ramp.elements]]
+
+
+class _TreeSnapshot:
+    """Snapshot of one node tree, with what it refers to outside of it.
+
+    :param tree: the tree's snapshot.
+    :param groups: names of the node groups its group nodes use.
+    :param images: names of the images its image nodes use.
+    :param types: node types it contains.
+    """
+
+    __slots__ = ('tree', 'groups', 'images', 'types')
+
+    def __init__(self, tree: dict, groups: set, images: set, types: set):
+        self.tree = tree
+        self.groups = groups
+        self.images = images
+        self.types = types
+
+
+class Snapshotter:
+    """Captures snapshots of materials for one set of channels.
+
+    Node group snapshots and image statistics are shared between materials,
+    so a snapshotter must not outlive changes to them, like an evaluation run.
+
+    :param channels: channel names mapped to their config key and default value.
+    """
+
+    def __init__(self, channels: dict):
+        self.fingerprinter = fingerprint.Fingerprinter(channels, pixel_eval.active())
+        self.node_keys = []
+        self.channels = {}
+        for name, (node_key, default_val) in channels.items():
+            map_index = next((i for i, key in enumerate(self.node_keys) if key is node_key), None)
+            if map_index is None:
+                map_index = len(self.node_keys)
+                self.node_keys.append(node_key)
+            self.channels[name] = [map_index, _value(default_val)]
+        self._rules = [{} for _node_key in self.node_keys]
+        self._handlers = {}
+        self._groups = {}
+        self._images = {}
+
+    def capture(self, material: bpy.types.Material) -> dict:
+        """Returns a material's snapshot, or None if it has no nodes to evaluate or nodes snapshots cannot hold."""
+        if not material.use_nodes or material.node_tree is None:
+            return None
+
+        plan = node_eval.get_tree_plan(material.node_tree)
+        if plan.output is None:
+            return None
+
+        try:
+            tree = self._tree(plan, False)
+        except Unsupported:
+            return None
+
+        trees = {snapshot_eval.MATERIAL_TREE: tree.tree}
+        images = set(tree.images)
+        types = set(tree.types)
+        stack = list(tree.groups)
+        while stack:
+            name = stack.pop()
+            if name in trees:
+                continue
+            group = self._groups[name]
+            trees[name] = group.tree
+            images.update(group.images)
+            types.update(group.types)
+            stack.extend(group.groups)
+
+        return {
+            'channels': self.channels,
+            'rules': [{bl_idname: rules[bl_idname] for bl_idname in types if bl_idname in rules}
+                      for rules in self._rules],
+            'trees': trees,
+            'images': {name: self._images[name] for name in images},
+        }
+
+    def _node_handlers(self, bl_idname: str) -> set:
+        """Returns the names of the handlers a node type is evaluated by, keeping its rule in each config map."""
+        if bl_idname not in self._handlers:
+            handlers = set()
+            for node_key, rules in zip(self.node_keys, self._rules):
+                entry = node_key.get(bl_idname)
+                if entry is None:
+                    continue
+                if callable(entry):
+                    if entry not in _HANDLERS:
+                        raise Unsupported(entry.__name__)
+                    entry = _HANDLERS[entry]
+                    handlers.add(entry)
+                elif not isinstance(entry, float):
+                    entry = list(entry)
+                rules[bl_idname] = entry
+            self._handlers[bl_idname] = handlers
+        return self._handlers[bl_idname]
+
+    def _image(self, image: bpy.types.Image) -> str:
+        key = image.name_full
+        if key not in self._images:
+            stat = image_sampling.get_stat(image)
+            self._images[key] = None if stat is None else _value(stat)
+        return key
+
+    def _group(self, node_tree: bpy.types.NodeTree) -> str:
+        key = node_tree.name_full
+        if key not in self._groups:
+            self._groups[key] = None  # a group nested in itself, or one snapshots cannot hold
+            plan = node_eval.get_tree_plan(node_tree)
+            if plan.output is None:
+                self._groups[key] = _TreeSnapshot({'output': None, 'nodes': []}, set(), set(), set())
+            else:
+                self._groups[key] = self._tree(plan, True)
+        if self._groups[key] is None:
+            raise Unsupported(key)
+        return key
+
+    def _tree(self, plan: tree_plan.TreePlan, group: bool) -> _TreeSnapshot:
+        """Captures the nodes reachable from a tree's output, numbered in the order they are reached,
+        like fingerprint.Fingerprinter._walk.
+        """
+        index = {plan.output: 0}
+        stack = [plan.output]
+        nodes = [None]
+        snapshot = _TreeSnapshot({'output': 0, 'nodes': nodes}, set(), set(), set())
+        while stack:
+            node_plan = stack.pop()
+            input_indices, output_indices = self.fingerprinter.relevant(node_plan)
+            if group and node_plan is plan.output:
+                input_indices = range(len(node_plan.inputs))
+
+            inputs = [None] * len(node_plan.inputs)
+            for idx in input_indices:
+                socket = node_plan.inputs[idx]
+                link = plan.links.get(socket.as_pointer())
+                if link is None:
+                    inputs[idx] = _source(socket)
+                    continue
+
+                from_node = link.from_node
+                if from_node.bl_idname == 'NodeGroupInput':
+                    inputs[idx] = ['group_input', link.from_socket_index]
+                    continue
+                if pixel_eval.active() and from_node.bl_idname in pixel_eval.CHAIN_NODES:
+                    value = pixel_eval.chain_value(plan, from_node, link.from_socket_index)
+                    if value is not None:
+                        inputs[idx] = ['value', _value(value)]
+                        continue
+
+                if from_node not in index:
+                    index[from_node] = len(nodes)
+                    nodes.append(None)
+                    stack.append(from_node)
+                inputs[idx] = ['link', index[from_node], link.from_socket_index]
+
+            outputs = [None] * len(node_plan.outputs)
+            for idx in output_indices:
+                outputs[idx] = _source(node_plan.outputs[idx])
+
+            node = {'type': node_plan.bl_idname, 'inputs': inputs, 'outputs': outputs}
+            self._settings(node_plan, node, snapshot)
+            nodes[index[node_plan]] = node
+            snapshot.types.add(node_plan.bl_idname)
+
+        return snapshot
+
+    def _settings(self, node_plan: tree_plan.NodePlan, node: dict, snapshot: _TreeSnapshot):
+        """Adds the settings a node's handlers read, and the group it enters, to its snapshot."""
+        curr_node = node_plan.node
+        handlers = self._node_handlers(node_plan.bl_idname)
+        if 'MIX' in handlers:
+            node['data_type'] = curr_node.data_type
+        if 'CLAMP' in handlers:
+            node['clamp_type'] = curr_node.clamp_type
+        if 'RAMP' in handlers:
+            node['ramp'] = _ramp(curr_node.color_ramp)
+        if 'IMAGE' in handlers:
+            image = getattr(curr_node, 'image', None)
+            node['image'] = None if image is None else self._image(image)
+            if image is not None:
+                snapshot.images.add(node['image'])
+
+        if node_plan.is_group:
+            if curr_node.node_tree is None:
+                raise Unsupported('group node without a node tree')
+            node['group'] = self._group(curr_node.node_tree)
+            snapshot.groups.add(node['group'])
+
+
+class SnapshotPool:
+    """Worker processes evaluating snapshots, started on first use and kept until closed.
+
+    Each worker runs snapshot_eval.py with this Python interpreter in isolated mode, so it needs neither bpy nor
+    this add-on's package, and reads one job of snapshots at a time. A worker that fails has its job evaluated
+    in this process instead.
+
+    :param workers: number of worker processes, config.SNAPSHOT_WORKERS by default.
+    """
+
+    def __init__(self, workers: int = None):
+        self.workers = max(config.SNAPSHOT_WORKERS if workers is None else workers, 1)
+        self._processes = []
+
+    def _start(self):
+        script = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'snapshot_eval.py')
+        self._processes = [subprocess.Popen([sys.executable, '-I', script], stdin=subprocess.PIPE,
+                                            stdout=subprocess.PIPE,
+                                            creationflags=getattr(subprocess, 'CREATE_NO_WINDOW', 0))
+                           for _ in range(self.workers)]
+
+    def _evaluate_job(self, process: subprocess.Popen, snapshots: list) -> list:
+        try:
+            pickle.dump({'max_depth': config.MAX_EVAL_DEPTH, 'snapshots': snapshots}, process.stdin,
+                        protocol=pickle.HIGHEST_PROTOCOL)
+            process.stdin.flush()
+            return pickle.load(process.stdout)
+        except (OSError, EOFError, pickle.UnpicklingError):
+            return snapshot_eval.evaluate_all(snapshots, config.MAX_EVAL_DEPTH)
+
+    def evaluate(self, snapshots: list) -> list:
+        """Evaluates snapshots split evenly between the workers.
+
+        :return: values of each snapshot, see snapshot_eval.evaluate, or None for a snapshot that could not
+            be evaluated.
+        """
+        if not snapshots:
+            return []
+        if not self._processes:
+            self._start()
+
+        size = -(-len(snapshots) // len(self._processes))
+        jobs = [snapshots[start:start + size] for start in range(0, len(snapshots), size)]
+        with ThreadPoolExecutor(max_workers=len(jobs)) as threads:
+            parts = list(threads.map(self._evaluate_job, self._processes, jobs))
+        return [values for part in parts for values in part]
+
+    def close(self):
+        """Stops the workers, which exit once their input is closed."""
+        for process in self._processes:
+            try:
+                process.stdin.close()
+                process.wait(timeout=5)
+            except (OSError, subprocess.TimeoutExpired):
+                process.kill()
+                process.wait()
+            process.stdout.close()
+        self._processes = []
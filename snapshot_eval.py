@@ -0,0 +1,373 @@
+# Copyright (C) 2024 Spencer Magnusson
+# semagnum@gmail.com
+# Created by Spencer Magnusson
+#     This program is free software: you can redistribute it and/or modify
+#     it under the terms of the GNU General Public License as published by
+#     the Free Software Foundation, either version 3 of the License, or
+#     (at your option) any later version.
+#     This program is distributed in the hope that it will be useful,
+#     but WITHOUT ANY WARRANTY; without even the implied warranty of
+#     MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#     GNU General Public License for more details.
+#     You should have received a copy of the GNU General Public License
+#     along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Evaluates material snapshots, see snapshot.py, with only the standard library, so it runs outside Blender.
+
+It follows node_eval and custom_node_eval step by step, with snapshot data in place of nodes.
+Run as a script, it is a worker process of snapshot.SnapshotPool: it reads pickled jobs from stdin,
+{'max_depth': ..., 'snapshots': [...]}, and writes the pickled values of each job's snapshots to stdout,
+None for a snapshot it could not evaluate, until stdin is closed.
+
+    python -I snapshot_eval.py
+"""
+
+import bisect
+import pickle
+import sys
+
+# evaluation request kinds, like node_eval's
+_SOCKET = 0
+_NODE = 1
+
+# key of the material's own tree among a snapshot's trees, the others being node groups by name
+MATERIAL_TREE = ''
+
+
+class GroupInput:
+    """Result of a channel whose traversal ran into a group input node, like util.GroupInputRef."""
+    __slots__ = ('index',)
+
+    def __init__(self, index: int):
+        self.index = index
+
+
+def assert_float(val) -> float:
+    if isinstance(val, (list, tuple)):  # is a color, exclude alpha channel
+        return max(val[:-1])
+    return val
+
+
+def assert_color(val) -> list:
+    if isinstance(val, (list, tuple)):
+        return val
+    return [val, val, val, 1.0]
+
+
+def _first_group_input(*vals):
+    return next((val for val in vals if isinstance(val, GroupInput)), None)
+
+
+def _defaults(channels: dict) -> dict:
+    return {name: default_val for name, (_map_index, default_val) in channels.items()}
+
+
+def _with_default(channels: dict, default_val) -> dict:
+    return {name: (map_index, default_val) for name, (map_index, _default_val) in channels.items()}
+
+
+def evaluate_ramp(ramp: list, factor: float) -> list:
+    """Evaluates a color ramp snapshot, [interpolation, positions, colors], like pixel_eval's color ramps."""
+    interpolation, positions, colors = ramp
+    if len(positions) == 1:
+        return list(colors[0])
+    if interpolation == 'LINEAR':
+        if factor <= positions[0]:
+            return list(colors[0])
+        if factor >= positions[-1]:
+            return list(colors[-1])
+
+    # the factor lies between stops lower and lower + 1
+    lower = min(max(bisect.bisect_right(positions, factor) - 1, 0), len(positions) - 2)
+    span = positions[lower + 1] - positions[lower]
+    if interpolation == 'CONSTANT':
+        t = 1.0 if factor >= positions[lower + 1] else 0.0
+    else:
+        t = min(max((factor - positions[lower]) / span, 0.0), 1.0) if span > 0 else 0.0
+        if interpolation == 'EASE':
+            t = t * t * (3.0 - 2.0 * t)
+
+    start = colors[lower]
+    return [a + (b - a) * t for a, b in zip(start, colors[lower + 1])]
+
+
+class Evaluator:
+    """Evaluates channels on one snapshot, with an explicit stack like node_eval._run.
+
+    Nodes are identified by their tree's key and their index in it, and sockets by their node,
+    'inputs' or 'outputs', and their index. Values evaluated from a node output are memoized
+    for the snapshot's other channels and paths reaching it.
+
+    :param snapshot: snapshot of a material, see snapshot.Snapshotter.capture.
+    :param max_depth: maximum number of nested evaluation steps, see config.MAX_EVAL_DEPTH.
+    """
+
+    def __init__(self, snapshot: dict, max_depth: int):
+        self.trees = snapshot['trees']
+        self.rules = snapshot['rules']
+        self.images = snapshot['images']
+        self.max_depth = max_depth
+        self.channels = {name: (map_index, tuple(default_val) if isinstance(default_val, list) else default_val)
+                         for name, (map_index, default_val) in snapshot['channels'].items()}
+        self._memo = {}
+        self._handlers = {'CLAMP': self._clamp, 'RAMP': self._ramp, 'IMAGE': self._image, 'MIX': self._mix}
+
+    def evaluate(self) -> dict:
+        """Returns the value of each channel from the material's output node,
+        with channels that ran into a group input at their default value.
+        """
+        tree = self.trees[MATERIAL_TREE]
+        results = self._run((_NODE, MATERIAL_TREE, tree['output'], self.channels))
+        return {name: self.channels[name][1] if isinstance(val, GroupInput) else val
+                for name, val in results.items()}
+
+    def _lookup(self, memo_key: tuple, channels: dict) -> tuple:
+        cached = {}
+        missing = {}
+        for name, channel in channels.items():
+            key = memo_key + channel
+            if key in self._memo:
+                cached[name] = self._memo[key]
+            else:
+                missing[name] = channel
+        return cached, missing
+
+    def _finish(self, memo_key: tuple, cached: dict, channels: dict, value: dict) -> dict:
+        if memo_key is None:
+            return value
+
+        for name, channel in channels.items():
+            self._memo[memo_key + channel] = value[name]
+        cached.update(value)
+        return cached
+
+    def _open(self, request: tuple) -> tuple:
+        """Answers a request directly if possible, otherwise creates the stack frame that will evaluate it,
+        like node_eval._open.
+        """
+        kind, tree_key, arg, channels = request
+        nodes = self.trees[tree_key]['nodes']
+
+        if kind == _NODE:
+            if arg is None:
+                return _defaults(channels), None
+            return None, (self._eval_node(tree_key, arg, channels), (tree_key, arg), None, None, channels)
+
+        node_index, direction, socket_index = arg
+        source = nodes[node_index][direction][socket_index]
+        tag = source[0]
+        if tag == 'value':
+            return {name: source[1] for name in channels}, None
+        if tag == 'default':
+            return _defaults(channels), None
+        if tag == 'group_input':
+            group_input = GroupInput(source[1])
+            return {name: group_input for name in channels}, None
+
+        _tag, from_index, from_socket_index = source
+        memo_key = (tree_key, from_index, from_socket_index)
+        cached, channels = self._lookup(memo_key, channels)
+        if not channels:
+            return cached, None
+
+        if 'group' in nodes[from_index]:
+            generator = self._eval_group_output(tree_key, from_index, from_socket_index, channels)
+        else:
+            generator = self._eval_node(tree_key, from_index, channels)
+        return None, (generator, (tree_key, from_index), memo_key, cached, channels)
+
+    def _run(self, request: tuple) -> dict:
+        """Runs an evaluation request like node_eval._run: a node already on the stack, or a stack at the
+        maximum depth, gets the channel default values instead.
+        """
+        stack = []
+        visiting = set()
+
+        value, frame = self._open(request)
+        while True:
+            if frame is not None:
+                _generator, node_id, _memo_key, cached, channels = frame
+                if len(stack) >= self.max_depth or node_id in visiting:
+                    value = dict(cached or {})
+                    value.update(_defaults(channels))
+                else:
+                    stack.append(frame)
+                    visiting.add(node_id)
+                    value = None
+
+            if not stack:
+                return value
+
+            top = stack[-1]
+            try:
+                request = top[0].send(value)
+            except StopIteration as done:
+                stack.pop()
+                _generator, node_id, memo_key, cached, channels = top
+                visiting.discard(node_id)
+                value = self._finish(memo_key, cached, channels, done.value)
+                frame = None
+                continue
+
+            value, frame = self._open(request)
+
+    @staticmethod
+    def _socket(tree_key: str, node_index: int, socket_index: int, channels: dict) -> tuple:
+        return _SOCKET, tree_key, (node_index, 'inputs', socket_index), channels
+
+    def _resolve_group_inputs(self, tree_key: str, node_index: int, results: dict, channels: dict):
+        by_index = {}
+        for name, val in results.items():
+            if isinstance(val, GroupInput):
+                by_index.setdefault(val.index, {})[name] = channels[name]
+
+        for socket_index, subset in by_index.items():
+            results.update((yield self._socket(tree_key, node_index, socket_index, subset)))
+
+        return results
+
+    def _eval_group_output(self, tree_key: str, node_index: int, socket_index: int, channels: dict):
+        group_key = self.trees[tree_key]['nodes'][node_index]['group']
+        output = self.trees[group_key]['output']
+        if output is None:
+            return _defaults(channels)
+
+        results = yield _SOCKET, group_key, (output, 'inputs', socket_index), channels
+        return (yield from self._resolve_group_inputs(tree_key, node_index, results, channels))
+
+    def _eval_node(self, tree_key: str, node_index: int, channels: dict):
+        node = self.trees[tree_key]['nodes'][node_index]
+        results = {}
+
+        by_socket = {}
+        by_handler = {}
+        unmatched = {}
+        for name, (map_index, default_val) in channels.items():
+            rule = self.rules[map_index].get(node['type'])
+            if rule is None:
+                unmatched[name] = (map_index, default_val)
+            elif isinstance(rule, str):
+                by_handler.setdefault(rule, {})[name] = (map_index, default_val)
+            elif isinstance(rule, float):
+                results[name] = rule
+            else:
+                by_socket.setdefault(tuple(rule), {})[name] = (map_index, default_val)
+
+        for handler, subset in by_handler.items():
+            handler_vals = self._handlers[handler](tree_key, node_index, node, subset)
+            if not isinstance(handler_vals, dict):
+                handler_vals = yield from handler_vals
+            results.update(handler_vals)
+
+        for (direction, socket_index), subset in by_socket.items():
+            results.update((yield _SOCKET, tree_key, (node_index, direction, socket_index), subset))
+
+        if unmatched:
+            if len(node['inputs']) == 1:
+                results.update((yield self._socket(tree_key, node_index, 0, unmatched)))
+            else:
+                results.update(_defaults(unmatched))
+
+        return results
+
+    def _ramp(self, tree_key: str, node_index: int, node: dict, channels: dict):
+        factors = yield self._socket(tree_key, node_index, 0, _with_default(channels, 0.5))
+
+        results = {}
+        for name, factor_val in factors.items():
+            if isinstance(factor_val, GroupInput):
+                results[name] = factor_val
+            else:
+                results[name] = evaluate_ramp(node['ramp'], assert_float(factor_val))
+        return results
+
+    def _image(self, _tree_key: str, _node_index: int, node: dict, channels: dict) -> dict:
+        if node['image'] is None:
+            return {name: [1.0, 0.0, 1.0, 1.0] for name in channels}
+
+        color = self.images[node['image']]
+        if color is None:
+            return _defaults(channels)
+        return {name: list(color) + [1.0] for name in channels}
+
+    def _clamp(self, tree_key: str, node_index: int, node: dict, channels: dict):
+        value_vals = yield self._socket(tree_key, node_index, 0, channels)
+        min_vals = yield self._socket(tree_key, node_index, 1, _with_default(channels, 0.0))
+        max_vals = yield self._socket(tree_key, node_index, 2, _with_default(channels, 1.0))
+
+        results = {}
+        for name in channels:
+            group_input = _first_group_input(value_vals[name], min_vals[name], max_vals[name])
+            if group_input is not None:
+                results[name] = group_input
+                continue
+
+            value_val = assert_float(value_vals[name])
+            min_val = assert_float(min_vals[name])
+            max_val = assert_float(max_vals[name])
+            if node['clamp_type'] == 'RANGE':
+                min_val, max_val = min(min_val, max_val), max(min_val, max_val)
+
+            results[name] = min(max(value_val, min_val), max_val)
+        return results
+
+    def _mix(self, tree_key: str, node_index: int, node: dict, channels: dict):
+        data_type = node['data_type']
+        factor_vals = yield self._socket(tree_key, node_index, 0, _with_default(channels, 0.0))
+
+        if data_type == 'RGBA':
+            a_index, b_index = 6, 7
+        elif data_type == 'VECTOR':
+            a_index, b_index = 4, 5
+        else:
+            a_index, b_index = 2, 3
+
+        a_vals = yield self._socket(tree_key, node_index, a_index, channels)
+        b_vals = yield self._socket(tree_key, node_index, b_index, channels)
+
+        results = {}
+        for name in channels:
+            group_input = _first_group_input(factor_vals[name], a_vals[name], b_vals[name])
+            if group_input is not None:
+                results[name] = group_input
+                continue
+
+            factor_val = assert_float(factor_vals[name])
+            a_factor = 1 - factor_val
+            if data_type == 'FLOAT':
+                results[name] = assert_float(b_vals[name]) * factor_val + assert_float(a_vals[name]) * a_factor
+            else:
+                results[name] = [a * a_factor + b * factor_val
+                                 for a, b in zip(assert_color(a_vals[name]), assert_color(b_vals[name]))]
+        return results
+
+
+def evaluate(snapshot: dict, max_depth: int) -> dict:
+    """Returns the value of each channel of a material snapshot, see Evaluator."""
+    return Evaluator(snapshot, max_depth).evaluate()
+
+
+def evaluate_all(snapshots: list, max_depth: int) -> list:
+    """Returns the values of each snapshot, or None for a snapshot that could not be evaluated."""
+    values = []
+    for snapshot in snapshots:
+        try:
+            values.append(evaluate(snapshot, max_depth))
+        except (KeyError, IndexError, TypeError, ValueError):
+            values.append(None)
+    return values
+
+
+def run_worker(stdin, stdout):
+    """Evaluates the jobs read from a binary stream, writing the values of each to another, until the first ends."""
+    while True:
+        try:
+            job = pickle.load(stdin)
+        except EOFError:
+            return
+        pickle.dump(evaluate_all(job['snapshots'], job['max_depth']), stdout, protocol=pickle.HIGHEST_PROTOCOL)
+        stdout.flush()
+
+
+if __name__ == '__main__':
+    run_worker(sys.stdin.buffer, sys.stdout.buffer)
@@ -0,0 +1,136 @@
+# Copyright (C) 2024 Spencer Magnusson
+# semagnum@gmail.com
+# Created by Spencer Magnusson
+#     This program is free software: you can redistribute it and/or modify
+#     it under the terms of the GNU General Public License as published by
+#     the Free Software Foundation, either version 3 of the License, or
+#     (at your option) any later version.
+#     This program is distributed in the hope that it will be useful,
+#     but WITHOUT ANY WARRANTY; without even the implied warranty of
+#     MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#     GNU General Public License for more details.
+#     You should have received a copy of the GNU General Public License
+#     along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import bpy
+
+
+class NodePlan:
+    """Node attributes read during evaluation, resolved once when the tree is compiled."""
+    __slots__ = ('node', 'bl_idname', 'inputs', 'outputs', 'is_group')
+
+    def __init__(self, node: bpy.types.Node):
+        self.node = node
+        self.bl_idname = node.bl_idname
+        self.inputs = tuple(node.inputs)
+        self.outputs = tuple(node.outputs)
+        self.is_group = hasattr(node, 'node_tree')
+
+
+class LinkPlan:
+    """Where an input socket's first link comes from."""
+    __slots__ = ('from_node', 'from_socket_key', 'from_socket_index')
+
+    def __init__(self, from_node: NodePlan, from_socket_key: int, from_socket_index: int):
+        self.from_node = from_node
+        self.from_socket_key = from_socket_key
+        self.from_socket_index = from_socket_index
+
+
+def tree_stamp(node_tree: bpy.types.NodeTree) -> tuple:
+    """Returns a value that changes whenever nodes are added or removed, their sockets change, or links change.
+
+    Nodes are compared by pointer, as deleting a node and adding another keeps their number the same,
+    and by their number of sockets, which group interface edits change on group nodes.
+    """
+    return (tuple((node.as_pointer(), len(node.inputs), len(node.outputs)) for node in node_tree.nodes),
+            tuple((link.from_socket.as_pointer(), link.to_socket.as_pointer()) for link in node_tree.links))
+
+
+class TreePlan:
+    """Flat evaluation plan of a node tree.
+
+    Holds the tree's output node, each node's resolved attributes,
+    and the link feeding each linked input socket, keyed by socket pointer.
+    Evaluating from a plan needs no string parsing or scans over the tree's nodes and links.
+    Other modules may keep what they derive from the tree's structure in `derived`, dropped along with the plan.
+    """
+    __slots__ = ('stamp', 'output', 'nodes', 'links', 'checked_run', 'derived')
+
+    def __init__(self, node_tree: bpy.types.NodeTree, stamp: tuple):
+        self.checked_run = None
+        self._compile(node_tree, stamp)
+
+    def _compile(self, node_tree: bpy.types.NodeTree, stamp: tuple):
+        self.stamp = stamp
+        self.derived = {}
+        self.nodes = {}
+
+        socket_indices = {}
+        for node in node_tree.nodes:
+            node_plan = NodePlan(node)
+            self.nodes[node.as_pointer()] = node_plan
+            for socket_index, socket in enumerate(node_plan.outputs):
+                socket_indices[socket.as_pointer()] = socket_index
+
+        # same node as util.find_outputs would return first
+        self.output = next((node_plan for node_plan in self.nodes.values() if 'Output' in node_plan.bl_idname), None)
+
+        self.links = {}
+        for link in node_tree.links:
+            to_socket_key = link.to_socket.as_pointer()
+            if to_socket_key in self.links:
+                continue
+
+            from_socket_key = link.from_socket.as_pointer()
+            self.links[to_socket_key] = LinkPlan(self.nodes[link.from_node.as_pointer()],
+                                                 from_socket_key,
+                                                 socket_indices[from_socket_key])
+
+    def node(self, node: bpy.types.Node) -> NodePlan:
+        """Returns a node's plan, compiling the tree again if the node was added since,
+        such as between the time slices of a batch sharing one run.
+        """
+        node_plan = self.nodes.get(node.as_pointer())
+        if node_plan is None:
+            self._compile(node.id_data, tree_stamp(node.id_data))
+            node_plan = self.nodes[node.as_pointer()]
+        return node_plan
+
+
+_plans = {}
+
+
+def get_plan(node_tree: bpy.types.NodeTree, run_id=None) -> TreePlan:
+    """Returns the cached plan of a node tree, compiling it again if the tree changed.
+
+    :param node_tree: material or group node tree.
+    :param run_id: identifier of the current evaluation run.
+        A plan is only checked against its tree once per run, as trees do not change during a run.
+    """
+    key = node_tree.as_pointer()
+    plan = _plans.get(key)
+    if plan is not None and run_id is not None and plan.checked_run == run_id:
+        return plan
+
+    stamp = tree_stamp(node_tree)
+    if plan is None or plan.stamp != stamp:
+        plan = TreePlan(node_tree, stamp)
+        _plans[key] = plan
+
+    plan.checked_run = run_id
+    return plan
+
+
+def invalidate(node_tree: bpy.types.NodeTree = None):
+    """Drops a single tree's plan, or every plan if no tree is given."""
+    if node_tree is None:
+        _plans.clear()
+    else:
+        _plans.pop(node_tree.as_pointer(), None)
+
+
+@bpy.app.handlers.persistent
+def clear_on_load(_dummy):
+    """Plans hold node references, which do not survive loading another file."""
+    invalidate()
@@ -26,6 +26,16 @@ class GroupInputException(Exception):
         self.input_socket_index = input_socket_index
 
 
+class GroupInputRef:
+    """Result of a channel whose traversal ran into a group input node.
+    Carries the group input socket index, so the caller that entered the group can continue from the group node's inputs.
+    """
+    __slots__ = ('input_socket_index',)
+
+    def __init__(self, input_socket_index):
+        self.input_socket_index = input_socket_index
+
+
 def get_socket_index(socket):
     return int(socket.path_from_id().split('[')[-1][:-1])  # extracts index from str
 
@@ -33,3 +43,38 @@ def get_socket_index(socket):
 def find_outputs(node_tree: bpy.types.NodeTree) -> Iterator[bpy.types.Node]:
     """Returns all output nodes in a node tree."""
     return (node for node in node_tree.nodes if 'Output' in node.bl_idname)
+
+
+def walk_node_trees(node_tree: bpy.types.NodeTree, visited: set = None) -> Iterator[bpy.types.NodeTree]:
+    """Yields a node tree and every node group nested in it, each once."""
+    if visited is None:
+        visited = set()
+
+    stack = [node_tree]
+    while stack:
+        curr_tree = stack.pop()
+        if curr_tree.as_pointer() in visited:
+            continue
+        visited.add(curr_tree.as_pointer())
+
+        yield curr_tree
+        stack.extend(node.node_tree
+                     for node in curr_tree.nodes
+                     if getattr(node, 'node_tree', None) is not None)
+
+
+def find_images(materials) -> list:
+    """Returns every image used by image-like nodes of the materials, including inside nested node groups."""
+    images = {}
+    visited = set()
+    for material in materials:
+        if not material.use_nodes or material.node_tree is None:
+            continue
+
+        for node_tree in walk_node_trees(material.node_tree, visited):
+            for node in node_tree.nodes:
+                image = getattr(node, 'image', None)
+                if image is not None:
+                    images[image.name_full] = image
+
+    return list(images.values())
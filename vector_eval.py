@@ -0,0 +1,442 @@
+# Copyright (C) 2024 Spencer Magnusson
+# semagnum@gmail.com
+# Created by Spencer Magnusson
+#     This program is free software: you can redistribute it and/or modify
+#     it under the terms of the GNU General Public License as published by
+#     the Free Software Foundation, either version 3 of the License, or
+#     (at your option) any later version.
+#     This program is distributed in the hope that it will be useful,
+#     but WITHOUT ANY WARRANTY; without even the implied warranty of
+#     MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#     GNU General Public License for more details.
+#     You should have received a copy of the GNU General Public License
+#     along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Evaluates many materials at once, one NumPy kernel per node across every material sharing a node layout.
+
+Each material's channels are lowered into a program for a small stack machine: constants read from the tree,
+then the operations of the nodes between them and the output.
+Programs with the same operations form one group, whose constants are laid out as one array per slot,
+so each operation runs once for the whole group.
+Only what the node-by-node evaluator in node_eval does is lowered; node groups, cycles and unusual values
+are left to it.
+"""
+
+import bpy
+import numpy as np
+from mathutils import Vector
+
+from . import config, custom_node_eval as custom, image_sampling, node_eval, pixel_eval, tree_plan
+
+# operation codes, the first item of each operation
+_FLOAT = 0  # push a scalar constant: (_FLOAT, column)
+_VECTOR = 1  # push a vector constant: (_VECTOR, first column, length)
+_TO_FLOAT = 2  # vector to scalar, like node_eval.assert_float: (_TO_FLOAT,)
+_TO_COLOR = 3  # scalar to color, like node_eval.assert_color: (_TO_COLOR,)
+_CLAMP = 4  # (_CLAMP, is range)
+_MIX_FLOAT = 5  # (_MIX_FLOAT,)
+_MIX_COLOR = 6  # (_MIX_COLOR,)
+_RAMP = 7  # (_RAMP, ramp slot)
+
+# how a template loads each constant again, the first item of each load
+_LOAD_SOCKET = 0  # a socket's default value: (_LOAD_SOCKET, socket, None, kind)
+_LOAD_FIXED = 1  # a value from the config or a channel default: (_LOAD_FIXED, value, None, kind)
+_LOAD_IMAGE = 2  # the mean of an image node's image: (_LOAD_IMAGE, node, channel default, kind)
+_LOAD_RAMP = 3  # a color ramp node's ramp: (_LOAD_RAMP, node, None, None)
+_CHECK = 4  # a node setting the operations depend on: (_CHECK, node, attribute name, value when lowered)
+
+# value kinds, scalars or the length of a vector
+_SCALAR = 0
+
+_UNSUPPORTED = object()
+
+
+class Unsupported(Exception):
+    """Raised while lowering a material that only the node-by-node evaluator handles."""
+
+
+class Program:
+    """One channel of one material, lowered.
+
+    :param ops: operations, identical between materials with the same node layout.
+    :param floats: scalar constants.
+    :param vectors: vector constants, concatenated.
+    :param ramps: color ramps, in the order operations use them.
+    """
+    __slots__ = ('ops', 'floats', 'vectors', 'ramps')
+
+    def __init__(self):
+        self.ops = None
+        self.floats = []
+        self.vectors = []
+        self.ramps = []
+
+
+class Template:
+    """What lowering one channel of a node tree found, so the next lowering only loads the constants again.
+
+    :param ops: operations of the channel's program.
+    :param loads: how to load each constant and ramp, and the node settings to check first.
+    """
+    __slots__ = ('ops', 'loads')
+
+    def __init__(self, ops: tuple, loads: tuple):
+        self.ops = ops
+        self.loads = loads
+
+
+def _read(code: int, source, extra):
+    if code == _LOAD_SOCKET:
+        return source.default_value
+    if code == _LOAD_FIXED:
+        return source
+
+    # same values as custom_node_eval.image_node
+    image = getattr(source, 'image', None)
+    if image is None:
+        return 1.0, 0.0, 1.0, 1.0
+    color_mean = image_sampling.get_stat(image)
+    if color_mean is None:
+        return extra
+    return tuple(color_mean) + (1.0,)
+
+
+def _kind(val) -> int:
+    try:
+        return len(val)
+    except TypeError:
+        return _SCALAR
+
+
+def _put(program: Program, val, kind: int) -> bool:
+    """Adds a constant to a program, returning False if it is not a number of the given kind."""
+    try:
+        if kind == _SCALAR:
+            program.floats.append(float(val))
+        else:
+            program.vectors.extend([float(v) for v in val])
+    except (TypeError, ValueError):
+        return False
+    return True
+
+
+class _Lowering:
+    """Lowers a channel from one material node tree, following the same sockets as node_eval."""
+
+    def __init__(self, plan: tree_plan.TreePlan):
+        self.plan = plan
+        self.program = Program()
+        self.ops = []
+        self.loads = []
+        self.visiting = set()
+
+    def load(self, code: int, source, extra=None) -> int:
+        """Loads a constant and pushes it, returning its kind."""
+        program = self.program
+        val = _read(code, source, extra)
+        kind = _kind(val)
+        if not _put(program, val, kind):
+            raise Unsupported('not a number: {!r}'.format(val))
+
+        self.loads.append((code, source, extra, kind))
+        if kind == _SCALAR:
+            self.ops.append((_FLOAT, len(program.floats) - 1))
+        else:
+            self.ops.append((_VECTOR, len(program.vectors) - kind, kind))
+        return kind
+
+    def check(self, node, attribute: str):
+        """Reads a node setting the operations depend on."""
+        val = getattr(node, attribute)
+        self.loads.append((_CHECK, node, attribute, val))
+        return val
+
+    def to_float(self, kind: int):
+        if kind != _SCALAR:
+            if kind < 2:  # assert_float would take the max of nothing
+                raise Unsupported('vector of length {}'.format(kind))
+            self.ops.append((_TO_FLOAT,))
+
+    def to_color(self, kind: int) -> int:
+        if kind == _SCALAR:
+            self.ops.append((_TO_COLOR,))
+            return 4
+        return kind
+
+    def socket(self, socket, channel: tuple, depth: int) -> int:
+        link = self.plan.links.get(socket.as_pointer())
+        if link is None:
+            if hasattr(socket, 'default_value'):
+                return self.load(_LOAD_SOCKET, socket)
+            return self.load(_LOAD_FIXED, channel[1])
+        return self.node(link.from_node, channel, depth + 1)
+
+    def node(self, node_plan: tree_plan.NodePlan, channel: tuple, depth: int) -> int:
+        if node_plan.is_group or node_plan.bl_idname == 'NodeGroupInput':
+            raise Unsupported('node group')
+        if depth > config.VECTOR_MAX_DEPTH or node_plan in self.visiting:
+            raise Unsupported('cycle or deep chain')
+        if pixel_eval.active() and node_plan.bl_idname in pixel_eval.CHAIN_NODES:
+            raise Unsupported('may be evaluated per pixel')
+
+        node_key, default_val = channel
+        entry = node_key.get(node_plan.bl_idname)
+
+        self.visiting.add(node_plan)
+        try:
+            if entry is None:
+                if len(node_plan.inputs) == 1:
+                    return self.socket(node_plan.inputs[0], channel, depth)
+                return self.load(_LOAD_FIXED, default_val)
+            if callable(entry):
+                return self.handler(entry, node_plan, channel, depth)
+            if isinstance(entry, float):
+                return self.load(_LOAD_FIXED, entry)
+
+            direction, idx = entry
+            return self.socket(getattr(node_plan, direction)[idx], channel, depth)
+        finally:
+            self.visiting.discard(node_plan)
+
+    def handler(self, handler, node_plan: tree_plan.NodePlan, channel: tuple, depth: int) -> int:
+        """Lowers the nodes that custom_node_eval handlers evaluate, with the same defaults and conversions."""
+        node = node_plan.node
+        inputs = node_plan.inputs
+        node_key, default_val = channel
+        ops = self.ops
+
+        if handler is custom.image_node:
+            return self.load(_LOAD_IMAGE, node, default_val)
+
+        if handler is custom.clamp_node:
+            self.to_float(self.socket(inputs[0], channel, depth))
+            self.to_float(self.socket(inputs[1], (node_key, 0.0), depth))
+            self.to_float(self.socket(inputs[2], (node_key, 1.0), depth))
+            ops.append((_CLAMP, self.check(node, 'clamp_type') == 'RANGE'))
+            return _SCALAR
+
+        if handler is custom.mix_node:
+            data_type = self.check(node, 'data_type')
+            if data_type == 'RGBA':
+                a_socket, b_socket = inputs[6], inputs[7]
+            elif data_type == 'VECTOR':
+                a_socket, b_socket = inputs[4], inputs[5]
+            else:
+                a_socket, b_socket = inputs[2], inputs[3]
+
+            self.to_float(self.socket(inputs[0], (node_key, 0.0), depth))
+            if data_type == 'FLOAT':
+                self.to_float(self.socket(a_socket, channel, depth))
+                self.to_float(self.socket(b_socket, channel, depth))
+                ops.append((_MIX_FLOAT,))
+                return _SCALAR
+
+            a_kind = self.to_color(self.socket(a_socket, channel, depth))
+            b_kind = self.to_color(self.socket(b_socket, channel, depth))
+            ops.append((_MIX_COLOR,))
+            return min(a_kind, b_kind)
+
+        if handler is custom.color_ramp:
+            self.to_float(self.socket(inputs[0], (node_key, 0.5), depth))
+            ops.append((_RAMP, len(self.program.ramps)))
+            self.loads.append((_LOAD_RAMP, node, None, None))
+            self.program.ramps.append(node.color_ramp)
+            return 4
+
+        raise Unsupported('no kernel for {}'.format(handler.__name__))
+
+
+def _replay(template: Template, program: Program) -> bool:
+    """Loads a template's constants into a program, returning False if the tree no longer matches the template."""
+    for code, source, extra, expected in template.loads:
+        if code == _CHECK:
+            if getattr(source, extra) != expected:
+                return False
+        elif code == _LOAD_RAMP:
+            program.ramps.append(source.color_ramp)
+        else:
+            val = _read(code, source, extra)
+            if _kind(val) != expected or not _put(program, val, expected):
+                return False
+
+    program.ops = template.ops
+    return True
+
+
+def _template_key(name: str, channel: tuple) -> tuple:
+    node_key, default_val = channel
+    try:
+        default_val = tuple(default_val)
+    except TypeError:
+        pass
+    return __name__, name, id(node_key), default_val, pixel_eval.active()
+
+
+def lower(plan: tree_plan.TreePlan, name: str, channel: tuple) -> Program:
+    """Lowers one channel of a material, from its output node.
+
+    The first lowering of a tree keeps a template in its plan, and later ones only load the constants again,
+    unless a node setting the operations depend on has changed.
+
+    :raise Unsupported: if the channel needs the node-by-node evaluator.
+    """
+    key = _template_key(name, channel)
+    template = plan.derived.get(key)
+    if template is _UNSUPPORTED:
+        raise Unsupported('not supported when last lowered')
+    if template is not None:
+        program = Program()
+        if _replay(template, program):
+            return program
+
+    lowering = _Lowering(plan)
+    try:
+        kind = lowering.node(plan.output, channel, 0)
+        if name == 'diffuse_color':
+            if lowering.to_color(kind) != 4:
+                raise Unsupported('color of length {}'.format(kind))
+        else:
+            lowering.to_float(kind)
+    except Unsupported:
+        plan.derived[key] = _UNSUPPORTED
+        raise
+
+    template = plan.derived[key] = Template(tuple(lowering.ops), tuple(lowering.loads))
+    program = lowering.program
+    program.ops = template.ops
+    return program
+
+
+def ramp_tables(ramps) -> tuple:
+    """Lays out color ramp stops as arrays, padded to the ramp with the most stops by repeating the last one.
+
+    :return: (N, stops) positions, (N, stops, 4) colors,
+        and which ramps interpolate linearly in RGB, the only ones the tables reproduce exactly.
+    """
+    stops = max(len(ramp.elements) for ramp in ramps)
+    positions = np.empty((len(ramps), stops))
+    colors = np.empty((len(ramps), stops, 4))
+    linear = np.empty(len(ramps), dtype=bool)
+
+    for i, ramp in enumerate(ramps):
+        elements = ramp.elements
+        for j, element in enumerate(elements):
+            positions[i, j] = element.position
+            colors[i, j] = tuple(element.color)
+        positions[i, len(elements):] = positions[i, len(elements) - 1]
+        colors[i, len(elements):] = colors[i, len(elements) - 1]
+        linear[i] = ramp.interpolation == 'LINEAR' and ramp.color_mode == 'RGB'
+
+    return positions, colors, linear
+
+
+def eval_ramps(ramps, factors: np.ndarray) -> np.ndarray:
+    """Evaluates a color ramp per row: from the stop tables for linear RGB ramps, otherwise by calling Blender."""
+    positions, colors, linear = ramp_tables(ramps)
+    rows = np.arange(len(ramps))
+
+    # index of the stop at or before each factor, so the factor lies between stops lower and lower + 1
+    lower = np.clip((positions <= factors[:, None]).sum(axis=1) - 1, 0, max(positions.shape[1] - 2, 0))
+    upper = np.minimum(lower + 1, positions.shape[1] - 1)
+    span = positions[rows, upper] - positions[rows, lower]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        t = np.where(span > 0, (factors - positions[rows, lower]) / span, 0.0)
+    t = np.clip(t, 0.0, 1.0)[:, None]
+    result = colors[rows, lower] * (1.0 - t) + colors[rows, upper] * t
+
+    for i in np.flatnonzero(~linear):
+        result[i] = tuple(ramps[i].evaluate(float(factors[i])))
+    return result
+
+
+def run(ops: tuple, programs: list) -> np.ndarray:
+    """Runs the operations shared by programs, once across all of them.
+
+    :return: (N,) scalars or (N, length) vectors, one row per program.
+    """
+    floats = np.array([program.floats for program in programs], dtype=np.float64).reshape(len(programs), -1)
+    vectors = np.array([program.vectors for program in programs], dtype=np.float64).reshape(len(programs), -1)
+
+    stack = []
+    for op in ops:
+        code = op[0]
+        if code == _FLOAT:
+            stack.append(floats[:, op[1]])
+        elif code == _VECTOR:
+            stack.append(vectors[:, op[1]:op[1] + op[2]])
+        elif code == _TO_FLOAT:
+            stack.append(stack.pop()[:, :-1].max(axis=1))
+        elif code == _TO_COLOR:
+            val = stack.pop()
+            stack.append(np.stack((val, val, val, np.ones_like(val)), axis=1))
+        elif code == _CLAMP:
+            max_val = stack.pop()
+            min_val = stack.pop()
+            val = stack.pop()
+            if op[1]:
+                min_val, max_val = np.minimum(min_val, max_val), np.maximum(min_val, max_val)
+            stack.append(np.minimum(np.maximum(val, min_val), max_val))
+        elif code == _MIX_FLOAT:
+            b_val = stack.pop()
+            a_val = stack.pop()
+            factor = stack.pop()
+            stack.append(b_val * factor + a_val * (1 - factor))
+        elif code == _MIX_COLOR:
+            b_val = stack.pop()
+            a_val = stack.pop()
+            factor = stack.pop()[:, None]
+            length = min(a_val.shape[1], b_val.shape[1])
+            stack.append(a_val[:, :length] * (1 - factor) + b_val[:, :length] * factor)
+        elif code == _RAMP:
+            stack.append(eval_ramps([program.ramps[op[1]] for program in programs], stack.pop()))
+
+    return stack.pop()
+
+
+class MaterialBatch:
+    """Materials to evaluate together. Add materials, then evaluate them all at once.
+
+    :param channels: channel names mapped to their config key and default value, see operator.get_channels.
+    """
+
+    def __init__(self, channels: dict):
+        self.channels = channels
+        self.materials = []
+        self._groups = {}
+
+    def __len__(self):
+        return len(self.materials)
+
+    def add(self, material: bpy.types.Material) -> bool:
+        """Lowers a material into the batch, returning False if it must be evaluated node by node instead."""
+        if not material.use_nodes:
+            return False
+
+        plan = node_eval.get_tree_plan(material.node_tree)
+        if plan.output is None:
+            return False
+
+        try:
+            programs = [(name, lower(plan, name, channel)) for name, channel in self.channels.items()]
+        except Unsupported:
+            return False
+
+        index = len(self.materials)
+        self.materials.append(material)
+        for name, program in programs:
+            self._groups.setdefault((name, program.ops), []).append((index, program))
+        return True
+
+    def evaluate(self) -> list:
+        """Returns the viewport display values of each material, in the order materials were added."""
+        values = [{} for _material in self.materials]
+        for (name, ops), members in self._groups.items():
+            results = run(ops, [program for _index, program in members])
+            if name == 'diffuse_color':
+                for (index, _program), row in zip(members, results.tolist()):
+                    values[index][name] = Vector(row)
+            else:
+                for (index, _program), val in zip(members, results.tolist()):
+                    values[index][name] = val
+
+        return values